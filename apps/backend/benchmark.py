@@ -0,0 +1,188 @@
+"""
+    Reproducible benchmark of the simulation and optimization hot path, run from this directory:
+
+        python benchmark.py --output benchmark.json
+
+    All random draws are seeded and a fixed season of the Tamale weather is used, such that the machine-readable
+    output of two runs can be compared to catch regressions.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import tempfile
+from datetime import datetime
+from time import perf_counter, sleep, time
+
+import numpy as np
+
+CROP = 'Potato'
+SOIL = 'SandyLoam'
+SIM_START = '2021/06/01'
+SIM_END = '2021/12/31'
+BUDGET = 200  # mm
+
+
+def _summary(durations: list) -> dict:
+    durations = np.asarray(durations)
+    return {
+        'count': len(durations),
+        'mean': float(durations.mean()),
+        'median': float(np.median(durations)),
+        'p95': float(np.percentile(durations, 95)),
+        'min': float(durations.min()),
+        'max': float(durations.max()),
+    }
+
+
+def candidates(n: int, seed: int):
+    """ Fixed schedule dates with `n` seeded random depth vectors """
+    from irr_simulations import create_initial_irr_schedule
+
+    start_date, end_date = datetime.strptime(SIM_START, '%Y/%m/%d'), datetime.strptime(SIM_END, '%Y/%m/%d')
+    schedule = create_initial_irr_schedule(start_date, end_date, BUDGET)
+    depths = np.random.default_rng(seed).dirichlet(np.ones(len(schedule)), size=n) * BUDGET
+    return start_date, end_date, schedule, depths
+
+
+def bench_objective(n: int, seed: int) -> dict:
+    """ Latency of single evaluations in this process, the first (cold) call is reported separately """
+    from irr_simulations import objective
+
+    start_date, end_date, schedule, depths = candidates(n + 1, seed)
+    durations = []
+    for x in depths:
+        t0 = perf_counter()
+        objective(x, schedule, start_date, end_date, CROP, SOIL, BUDGET)
+        durations.append(perf_counter() - t0)
+
+    return {'cold': durations[0], 'warm': _summary(durations[1:])}
+
+
+def bench_scaling(workers: list, n: int, seed: int) -> list:
+    """ Throughput of a batch of evaluations on warm pools of increasing size """
+    from irr_pool import WarmPool
+    from irr_simulations import objective
+
+    start_date, end_date, schedule, depths = candidates(n, seed)
+    results = []
+    for size in workers:
+        pool = WarmPool(size, crops=(CROP,), soils=(SOIL,))
+        try:
+            # Warm up every worker on a schedule outside of the measured batch
+            warmup = np.full((size, len(schedule)), BUDGET / len(schedule))
+            pool.starmap(objective, [(x, schedule, start_date, end_date, CROP, SOIL, BUDGET) for x in warmup])
+
+            t0 = perf_counter()
+            pool.starmap(objective, [(x, schedule, start_date, end_date, CROP, SOIL, BUDGET) for x in depths])
+            duration = perf_counter() - t0
+        finally:
+            pool.shutdown()
+
+        results.append({
+            'workers': size,
+            'seconds': duration,
+            'evaluations_per_second': n / duration,
+            'evaluations_per_second_per_core': n / duration / size,
+        })
+    return results
+
+
+def bench_optimize(methods: list, num_searches: int, seed: int) -> list:
+    """ Duration and quality of a single budget level per optimizer """
+    from irr_simulations import objective, optimize
+
+    start_date, end_date = datetime.strptime(SIM_START, '%Y/%m/%d'), datetime.strptime(SIM_END, '%Y/%m/%d')
+    results = []
+    for method in methods:
+        np.random.seed(seed)
+        t0 = perf_counter()
+        solution = optimize(start_date, end_date, CROP, SOIL, BUDGET, num_searches, method,
+                            rng=np.random.default_rng(seed))
+        duration = perf_counter() - t0
+
+        yld, tirr, _ = objective(solution.Depth.values, solution, start_date, end_date, CROP, SOIL, BUDGET,
+                                 evaluate=True)
+        results.append({'method': method, 'seconds': duration, 'yield': yld, 'total_irrigation': tirr})
+    return results
+
+
+def bench_api(timeout: float = 3600) -> dict:
+    """
+        End-to-end latency of /create-simulation, with a local SQLite database standing in for Postgres. The request
+        derives its random streams from the root seed (IRR_SEED), see `main`.
+    """
+    # The simulation modules import the database module already, so its URL is replaced rather than read from the env
+    import database
+    database.DATABASE_URL = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+    database._engine = None
+
+    import irr_api
+
+    irr_api.init_database()
+    client = irr_api.create_app().test_client()
+
+    t0 = perf_counter()
+    response = client.post('/create-simulation', json={
+        'start_date': SIM_START, 'end_date': SIM_END, 'crop_type': CROP, 'crop_stage': 0,
+        'field_size': 1, 'max_water': BUDGET,
+    })
+    job = response.get_json()
+    while job['status'] not in ('done', 'failed') and perf_counter() - t0 < timeout:
+        sleep(.1)
+        job = client.get(f"/jobs/{job['id']}").get_json()
+
+    return {'seconds': perf_counter() - t0, 'status': job['status'], 'queued_seconds': job['queued_seconds'],
+            'run_seconds': job['run_seconds']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark.json', help='file to write the results to')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--evaluations', type=int, default=32, help='number of schedules per measurement')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, mp.cpu_count()} & set(range(1, mp.cpu_count() + 1))))
+    parser.add_argument('--methods', nargs='+', default=['random', 'cmaes', 'de', 'bayes'])
+    parser.add_argument('--searches', type=int, default=50, help='candidates per optimizer run')
+    parser.add_argument('--with-cache', action='store_true', help='keep the result cache and surrogate enabled')
+    parser.add_argument('--skip-api', action='store_true', help='skip the end-to-end API benchmark')
+    args = parser.parse_args()
+
+    # Measure the simulator itself: caches would turn repeated runs into lookups. This has to happen before the
+    # simulation modules are imported, also by spawned pool workers, just like seeding all their random streams.
+    if not args.with_cache:
+        os.environ['IRR_CACHE_SIZE'] = '0'
+        os.environ.pop('IRR_CACHE_DIR', None)
+        os.environ['IRR_SURROGATE'] = '0'
+    os.environ['IRR_SEED'] = str(args.seed)
+
+    results = {
+        'meta': {
+            'timestamp': time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': mp.cpu_count(),
+            'seed': args.seed,
+            'crop': CROP,
+            'soil': SOIL,
+            'start': SIM_START,
+            'end': SIM_END,
+            'budget': BUDGET,
+            'with_cache': args.with_cache,
+        },
+        'objective': bench_objective(args.evaluations, args.seed),
+        'scaling': bench_scaling(args.workers, args.evaluations, args.seed),
+        'optimize': bench_optimize(args.methods, args.searches, args.seed),
+    }
+    if not args.skip_api:
+        results['api'] = bench_api()
+
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
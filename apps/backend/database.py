@@ -1,10 +1,17 @@
 import json
 import os
+import struct
+import sys
 import zlib
+from array import array
+from datetime import datetime, timedelta
 
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, TypeDecorator, LargeBinary
+import dateutil.parser
+from sqlalchemy import create_engine, Column, String, DateTime, Float, ForeignKey, Integer, TypeDecorator, \
+    LargeBinary, Index
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import sessionmaker, declarative_base, defer, validates
 from urllib.parse import quote_plus
 
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
@@ -13,23 +20,115 @@ POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'local')
 
 Base = declarative_base()
 
-print(f"postgresql://{POSTGRES_USERNAME}:{quote_plus(POSTGRES_PASSWORD)}@"
-                       f"{POSTGRES_HOST}/lucas-test?sslmode=require")
-engine = create_engine(f"postgresql://{POSTGRES_USERNAME}:{quote_plus(POSTGRES_PASSWORD)}@"
-                       f"{POSTGRES_HOST}/lucas-test?sslmode=require")
+# Simulation-only nodes can run without a database
+DATABASE_ENABLED = os.getenv('DATABASE_ENABLED', '1') == '1'
 
-Session = sessionmaker(bind=engine)
+# Any SQLAlchemy URL can be used instead of Postgres, e.g. `sqlite:///simulations.db` for local benchmarks
+DATABASE_URL = os.getenv('DATABASE_URL', f"postgresql://{POSTGRES_USERNAME}:{quote_plus(POSTGRES_PASSWORD)}@"
+                                         f"{POSTGRES_HOST}/lucas-test?sslmode=require")
+
+# Connection pool of the engine, SQLite uses its own single connection pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # seconds, before idle connections are dropped upstream
+UPSERT_BATCH = 500  # rows per INSERT statement
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True,
+    }
+
+
+class DatabaseDisabled(Exception):
+    """Raised when the database is used on a node which runs without one"""
+
+
+_engine = None
+_session_factory = sessionmaker()
+
+
+def get_engine():
+    """ The engine is only created once the database is used, not when this module is imported """
+    global _engine
+    if not DATABASE_ENABLED:
+        raise DatabaseDisabled("This node runs without a database (DATABASE_ENABLED=0)")
+    if _engine is None:
+        _engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+    return _engine
+
+
+def Session():
+    """ New session bound to the lazily created engine """
+    return _session_factory(bind=get_engine())
+
+
+SCHEDULE_MAGIC = b'IRS'
+SCHEDULE_VERSION = 1
+SCHEDULE_HEADER = struct.Struct('<3sBiI')  # magic, version, base date (ordinal), number of days
+SCHEDULE_DATE_FORMAT = '%Y/%m/%d'
+
+
+def encode_schedule(schedule: dict) -> bytes:
+    """
+        Encode a schedule of date strings (yyyy/mm/dd) to liters as a header followed by the uint16 day offsets from
+        the first date and the float32 liters. Schedules which do not fit are stored as compressed JSON instead.
+    """
+    try:
+        dates = [datetime.strptime(date, SCHEDULE_DATE_FORMAT) for date in schedule]
+    except (TypeError, ValueError):
+        dates = None
+
+    base = min(dates) if dates else None
+    if dates is None or any((date - base).days > 0xFFFF for date in dates):
+        return zlib.compress(json.dumps(schedule).encode('utf-8'))
+
+    offsets = array('H', [(date - base).days for date in dates])
+    liters = array('f', [float(value) for value in schedule.values()])
+    if sys.byteorder == 'big':  # Always store little endian
+        offsets.byteswap()
+        liters.byteswap()
+
+    header = SCHEDULE_HEADER.pack(SCHEDULE_MAGIC, SCHEDULE_VERSION, base.toordinal() if base else 0, len(dates))
+    return header + offsets.tobytes() + liters.tobytes()
+
+
+def decode_schedule(value: bytes) -> dict:
+    """ Decode both the binary layout and the compressed JSON of older rows """
+    if not value.startswith(SCHEDULE_MAGIC):
+        return json.loads(zlib.decompress(value).decode('utf-8'))
+
+    _, version, base, count = SCHEDULE_HEADER.unpack_from(value)
+    if version != SCHEDULE_VERSION:
+        raise ValueError(f"Unsupported schedule version {version}")
+
+    offset = SCHEDULE_HEADER.size
+    offsets = array('H', value[offset:offset + 2 * count])
+    liters = array('f', value[offset + 2 * count:offset + 6 * count])
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+        liters.byteswap()
+
+    base_date = datetime.fromordinal(base) if count else None
+    return {(base_date + timedelta(days=days)).strftime(SCHEDULE_DATE_FORMAT): float(amount)
+            for days, amount in zip(offsets, liters)}
 
 
 class CustomLargeBinary(TypeDecorator):
     """We need this class to decode and encode the dictionaries to bytes"""
     impl = LargeBinary
+    cache_ok = True  # Stateless, so statements using it can be cached
 
     def process_bind_param(self, value, dialect):
-        return zlib.compress(json.dumps(value).encode('utf-8'))
+        return encode_schedule(value) if value is not None else None
 
     def process_result_value(self, value, dialect):
-        return json.loads(zlib.decompress(value).decode('utf-8'))
+        return decode_schedule(bytes(value)) if value is not None else None
 
     def coerce_compared_value(self, op, value):
         return self.impl.coerce_compared_value(op, value)
@@ -38,9 +137,12 @@ class CustomLargeBinary(TypeDecorator):
 class Simulation(Base):
     """ORM class for the featured results"""
     __tablename__ = 'simulations'
+    __table_args__ = (
+        Index('ix_simulations_mac_address_start_date', 'mac_address', 'start_date'),
+    )
 
     id = Column(String, autoincrement=False, primary_key=True)
-    mac_address = Column(String, nullable=False)
+    mac_address = Column(String, nullable=False, index=True)
     crop_type = Column(String, nullable=False)
     crop_stage = Column(Integer, nullable=False)
     start_date = Column(DateTime, nullable=False)
@@ -50,8 +152,13 @@ class Simulation(Base):
     schedule = Column(MutableDict.as_mutable(CustomLargeBinary), nullable=True)
     harvest_date = Column(DateTime, nullable=True)
 
-    def to_dict(self):
-        return {
+    @validates('start_date', 'end_date', 'harvest_date')
+    def validate_date(self, key, value):
+        """ Dates arrive as strings from the API, not every database driver parses those itself """
+        return dateutil.parser.parse(value) if isinstance(value, str) else value
+
+    def to_dict(self, include_schedule: bool = True):
+        sim = {
             'id': self.id,
             'mac_address': self.mac_address,
             'crop_type': self.crop_type,
@@ -60,45 +167,153 @@ class Simulation(Base):
             'end_date': self.end_date,
             'max_water': self.max_water,
             'field_size': self.field_size,
-            'schedule': self.schedule,
             'harvest_date': self.harvest_date
         }
+        if include_schedule:
+            sim['schedule'] = self.schedule
+        return sim
+
+
+class ParetoPoint(Base):
+    """ORM class of the alternative schedules of a simulation: the Pareto set its schedule was picked from"""
+    __tablename__ = 'pareto_points'
+
+    simulation_id = Column(String, ForeignKey('simulations.id', ondelete='CASCADE'), primary_key=True)
+    position = Column(Integer, primary_key=True, autoincrement=False)
+    yield_ = Column('yield', Float, nullable=True)
+    total_liters = Column(Float, nullable=False)
+    events = Column(Integer, nullable=False)
+    harvest_date = Column(DateTime, nullable=True)
+    schedule = Column(MutableDict.as_mutable(CustomLargeBinary), nullable=False)
+
+    def to_dict(self):
+        return {
+            'position': self.position,
+            'yield': self.yield_,
+            'total_liters': self.total_liters,
+            'events': self.events,
+            'harvest_date': self.harvest_date,
+            'schedule': self.schedule
+        }
 
 
 def init_database():
     """ Initialize the database """
+    engine = get_engine()
     Base.metadata.create_all(engine)
 
+    # create_all skips existing tables, so add indexes which were introduced later separately
+    for index in Simulation.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
 
-def create_simulation(session, sim: Simulation):
-    existing_sim = session.query(Simulation). \
-        filter(Simulation.id == sim.id).one_or_none()
-
-    if existing_sim:
-        # If the data is the same as present in the database
-        setattr(existing_sim, 'id', sim.id)
-        setattr(existing_sim, 'mac_address', sim.mac_address)
-        setattr(existing_sim, 'crop_type', sim.crop_type)
-        setattr(existing_sim, 'crop_stage', sim.crop_stage)
-        setattr(existing_sim, 'start_date', sim.start_date)
-        setattr(existing_sim, 'end_date', sim.end_date)
-        setattr(existing_sim, 'max_water', sim.max_water)
-        setattr(existing_sim, 'field_size', sim.field_size)
-        setattr(existing_sim, 'schedule', sim.schedule)
-        setattr(existing_sim, 'harvest_date', sim.harvest_date)
-
-        session.add(existing_sim)
-        session.commit()
-        return sim.id
+
+_write_listeners = []
+
+
+def on_write(listener):
+    """ Register `listener(ids, mac_addresses)` to be called after simulations were written """
+    _write_listeners.append(listener)
+    return listener
+
+
+def _notify_write(ids: list, mac_addresses: list):
+    for listener in _write_listeners:
+        listener(ids, mac_addresses)
+
+
+def upsert_simulations(session, sims: list, pareto: dict = None) -> list:
+    """
+        Insert or update many simulations at once. Postgres and SQLite get a native `INSERT ... ON CONFLICT DO UPDATE`
+        per batch of rows, other databases fall back to merging the simulations one by one.
+        :param pareto: Pareto sets by simulation id, which replace their stored ones in the same transaction. Every
+            point is a dict with the columns of `ParetoPoint` besides the simulation id and position.
+        :returns: ids of the simulations
+    """
+    columns = [column.name for column in Simulation.__table__.columns]
+    rows = [{column: getattr(sim, column) for column in columns} for sim in sims]
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        # SQLite limits the number of parameters of a single statement
+        batch = UPSERT_BATCH if dialect == 'postgresql' else 999 // len(columns)
+
+        for i in range(0, len(rows), batch):
+            stmt = insert(Simulation.__table__).values(rows[i:i + batch])
+            stmt = stmt.on_conflict_do_update(index_elements=[Simulation.id],
+                                              set_={column: stmt.excluded[column] for column in columns
+                                                    if column != 'id'})
+            session.execute(stmt)
     else:
-        session.add(sim)
-        session.commit()
-        return sim.id
+        for sim in sims:
+            session.merge(sim)
 
+    if pareto:
+        session.query(ParetoPoint).filter(ParetoPoint.simulation_id.in_(list(pareto))).delete(
+            synchronize_session=False)
+        session.add_all(ParetoPoint(simulation_id=sim_id, position=position, yield_=point['yield'],
+                                    total_liters=point['total_liters'], events=point['events'],
+                                    harvest_date=dateutil.parser.parse(point['harvest_date'])
+                                    if point['harvest_date'] else None, schedule=point['schedule'])
+                        for sim_id, points in pareto.items() for position, point in enumerate(points))
 
-def get_all_simulations(session, mac_address):
-    return session.query(Simulation). \
-        filter(Simulation.mac_address == mac_address).all()
+    session.commit()
+    ids = [row['id'] for row in rows]
+    _notify_write(ids, [row['mac_address'] for row in rows])
+    return ids
+
+
+def create_simulation(session, sim: Simulation):
+    return upsert_simulations(session, [sim])[0]
+
+
+def get_pareto_points(session, id_) -> list:
+    """ Pareto set of a simulation, in the order it was stored """
+    return session.query(ParetoPoint).filter(ParetoPoint.simulation_id == id_).order_by(ParetoPoint.position).all()
+
+
+def choose_pareto_point(session, id_, position: int):
+    """
+        Replace the schedule and harvest date of a simulation by those of a point of its Pareto set
+        :returns: The updated simulation, or None if it does not have that point
+    """
+    sim = get_simulation(session, id_)
+    point = session.get(ParetoPoint, (id_, position)) if sim is not None else None
+    if point is None:
+        return None
+
+    sim.schedule = dict(point.schedule)
+    sim.harvest_date = point.harvest_date
+    session.commit()
+    _notify_write([sim.id], [sim.mac_address])
+    return sim
+
+
+def get_all_simulations(session, mac_address, with_schedule: bool = True):
+    """ Simulations of a user, the schedules are only loaded from the database when `with_schedule` is set """
+    query = session.query(Simulation)
+    if not with_schedule:
+        query = query.options(defer(Simulation.schedule))
+    return query.filter(Simulation.mac_address == mac_address).all()
+
+
+def get_similar_simulations(session, mac_address, crop_type: str, start_date: datetime, max_days_apart: int,
+                            water_per_m2: float, max_water_ratio: float) -> list:
+    """
+        Simulations of a user with a schedule, of the same crop planted at most `max_days_apart` days from `start_date`
+        and with a water budget per m2 within a factor `max_water_ratio` of `water_per_m2`. The schedules are only
+        loaded from the database once they are accessed.
+    """
+    window = timedelta(days=max_days_apart)
+    return session.query(Simulation).options(defer(Simulation.schedule)).filter(
+        Simulation.mac_address == mac_address,
+        Simulation.start_date.between(start_date - window, start_date + window),
+        Simulation.crop_type == crop_type,
+        Simulation.schedule.isnot(None),
+        Simulation.field_size > 0,
+        Simulation.max_water >= water_per_m2 / max_water_ratio * Simulation.field_size,
+        Simulation.max_water <= water_per_m2 * max_water_ratio * Simulation.field_size,
+    ).all()
 
 
 def get_simulation(session, id_):
@@ -1,59 +1,414 @@
+import atexit
+import json
 import uuid
-from http.client import BAD_REQUEST
+import zlib
+from http.client import ACCEPTED, BAD_REQUEST, NOT_FOUND, SERVICE_UNAVAILABLE
 
-from flask import Flask, jsonify, request
+import dateutil.parser
+from flask import Blueprint, Flask, Response, abort, current_app, g, jsonify, request
 from flask_cors import CORS
-from database import init_database, Session, Simulation,\
-    get_all_simulations, get_simulation, create_simulation
-from irr_simulations import find_best_schedule
-from aquacrop.entities.crops.crop_params import crop_params
-from sys import platform
+from database import DATABASE_ENABLED, DatabaseDisabled, init_database, on_write, Session, Simulation,\
+    get_all_simulations, get_simulation, get_similar_simulations, upsert_simulations, get_pareto_points, \
+    choose_pareto_point
+from irr_cache import counter_stats
+from irr_jobs import JobQueue, QueueFull
+from irr_pool import get_pool
+from irr_response_cache import response_cache
+from irr_tracing import profile, tracer
 
-app = Flask(__name__)
-CORS(app)
+# The simulation modules (aquacrop, pandas, weather) are only imported by the first request which needs them, such that
+# the service starts and answers health checks right away
 
+api = Blueprint('api', __name__)
 
-@app.route("/get-simulations")
+SIMULATION_FIELDS = ['start_date', 'end_date', 'crop_type', 'crop_stage', 'field_size', 'max_water']
+
+jobs = JobQueue()
+atexit.register(jobs.shutdown, wait=False)
+
+
+@api.before_app_request
+def start_trace():
+    g.trace = tracer.span(f"http.{request.endpoint}")
+    g.trace.__enter__()
+    g.profile = profile(f"http.{request.endpoint}")
+    g.profile.__enter__()
+
+
+@api.teardown_app_request
+def stop_trace(exc):
+    if 'trace' in g:
+        g.profile.__exit__(None, None, None)
+        g.trace.__exit__(None, None, None)
+
+
+@api.app_errorhandler(DatabaseDisabled)
+def database_disabled(e):
+    return jsonify(error=str(e)), SERVICE_UNAVAILABLE
+
+
+@on_write
+def invalidate_simulations(ids: list, mac_addresses: list):
+    response_cache.invalidate(*(f"simulation:{uid}" for uid in ids), *(f"pareto:{uid}" for uid in ids),
+                              *(f"simulations:{mac}:{with_schedule}" for mac in mac_addresses
+                                for with_schedule in (False, True)))
+
+
+def cached_json(key: str, build, ttl: float = None) -> Response:
+    """
+        JSON response served from the response cache, `build()` creates the body on a miss. The ETag lets clients
+        revalidate, a request with a matching If-None-Match gets an empty 304 response.
+    """
+    body, etag = response_cache.get_or_create(key, lambda: build().get_data(), ttl)
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@api.route("/health")
+def health():
+    return jsonify({'status': 'ok', 'database': DATABASE_ENABLED})
+
+
+@api.route("/metrics")
+def get_metrics():
+    """ Spans and counters in the Prometheus text format """
+    return Response(tracer.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route("/metrics.json")
+def get_metrics_json():
+    """ Spans and counters, including the result cache lookups of the pool workers when tracing is enabled """
+    from irr_warehouse import warehouse
+
+    snapshot = tracer.snapshot()
+    return jsonify({**snapshot, 'result_cache': counter_stats(snapshot['counters']),
+                    'response_cache': response_cache.stats(),
+                    'warehouse': warehouse.stats() if warehouse is not None else None})
+
+
+@api.route("/get-simulations")
 def get_simulations():
-    with Session() as session:
-        sims = get_all_simulations(session, request.remote_addr)
-        return jsonify([s.to_dict() for s in sims])
+    # Listing only needs the metadata, so schedules are only loaded when asked for with `?schedule=true`
+    with_schedule = request.args.get('schedule', 'false').lower() in ('1', 'true')
+    ip = request.remote_addr
+
+    def build():
+        with Session() as session:
+            sims = get_all_simulations(session, ip, with_schedule=with_schedule)
+            return jsonify([s.to_dict(include_schedule=with_schedule) for s in sims])
 
+    return cached_json(f"simulations:{ip}:{with_schedule}", build)
 
-@app.route("/get-simulation/<uid>")
+
+@api.route("/get-simulation/<uid>")
 def get_simulation_by_id(uid):
+    def build():
+        with Session() as session:
+            sim = get_simulation(session, uid)
+            return jsonify(sim.to_dict())
+
+    return cached_json(f"simulation:{uid}", build)
+
+
+@api.route("/get-pareto/<uid>")
+def get_pareto(uid):
+    """ Pareto set of a simulation: the schedules it was picked from, ordered by their irrigation """
+    def build():
+        with Session() as session:
+            return jsonify([point.to_dict() for point in get_pareto_points(session, uid)])
+
+    return cached_json(f"pareto:{uid}", build)
+
+
+@api.route("/choose-pareto/<uid>/<int:position>", methods=['POST'])
+def choose_pareto(uid, position):
+    """ Use a schedule of the Pareto set of a simulation instead of the one picked for it """
     with Session() as session:
-        sim = get_simulation(session, uid)
+        sim = choose_pareto_point(session, uid, position)
+        if sim is None:
+            abort(NOT_FOUND)
         return jsonify(sim.to_dict())
 
 
-@app.route("/get-crop-harvest/<crop>")
+@api.route("/get-crop-harvest/<crop>")
 def get_crop_harvest(crop):
-    return jsonify(int(crop_params[crop]['MaturityCD']))
+    def build():
+        from aquacrop.entities.crops.crop_params import crop_params
+        return jsonify(int(crop_params[crop]['MaturityCD']))
+
+    # Crop parameters never change while the service runs
+    return cached_json(f"crop-harvest:{crop}", build, ttl=0)
+
+
+def warm_start_seeds(session, ip: str, params: dict, limit: int = 3, max_days_apart: int = 30,
+                     max_water_ratio: float = 2.) -> list:
+    """
+        Schedules of the closest previous simulations of the same user and crop, as irrigation depths (mm) indexed
+        by days after planting. Closest means nearest planting date first, then nearest water budget per m2. Only the
+        schedules of the chosen simulations are loaded, see `get_similar_simulations`.
+    """
+    import pandas as pd
+
+    start_date = dateutil.parser.parse(params['start_date'])
+    max_irr_mm = int(params['max_water']) / int(params['field_size'])
+
+    candidates = get_similar_simulations(session, ip, params['crop_type'], start_date, max_days_apart, max_irr_mm,
+                                         max_water_ratio)
+    candidates.sort(key=lambda sim: (abs((sim.start_date - start_date).days),
+                                     abs(sim.max_water / sim.field_size - max_irr_mm)))
+
+    seeds = []
+    for sim in candidates:
+        if len(seeds) == limit:
+            break
+        if not sim.schedule:
+            continue
+        liters = pd.Series(sim.schedule, dtype=float)
+        days = [(dateutil.parser.parse(date) - sim.start_date).days for date in liters.index]
+        seeds.append(pd.Series(liters.values / sim.field_size, index=days))
+    return seeds
+
+
+def pareto_points(front, field_size: int) -> list:
+    """
+        Every schedule of a Pareto front with its yield, irrigation in liters over the whole field, number of
+        irrigation events and harvest date, ordered by the irrigation. When optimized over weather scenarios, the
+        yield is the risk-adjusted yield the search used, and `ensemble` holds the mean and spread of the yield over
+        the scenarios and the yield in the season's own weather, see `irr_simulations.evaluate_solution`.
+    """
+    import pandas as pd
+    from irr_simulations import schedule_events
+
+    points = []
+    for solution, (yield_, total_irr, harvest_date) in front.items:
+        liters = solution.Depth.astype(int).values * field_size
+        points.append({'yield': None if pd.isna(yield_) else float(yield_),
+                       'total_liters': float(total_irr * field_size),
+                       'events': schedule_events(solution.Depth.values),
+                       'harvest_date': None if pd.isna(pd.Timestamp(harvest_date)) else str(harvest_date),
+                       'schedule': {date: int(l) for date, l in zip(solution.Date.dt.strftime('%Y/%m/%d'), liters)
+                                    if l > 0},
+                       'ensemble': solution.attrs.get('ensemble')})
+    return sorted(points, key=lambda point: point['total_liters'])
+
+
+def run_simulation(sim_id: str, ip: str, params: dict, pool=None, job=None, selection: str = None):
+    """
+        Job body of /create-simulation: optimize the schedule and store the resulting simulation with the Pareto set
+        it was picked from, see /get-pareto/<uid>. Whenever a budget level or generation finishes, the best schedule
+        so far is published as the progress of the job, and the schedules of the front so far as its Pareto set, see
+        /jobs/<job_id>/pareto.
+        :param selection: how the schedule is picked from the front, see `irr_simulations.best_result`
+    """
+    from irr_optimizers import derive_seed
+    from irr_simulations import SELECTION, best_result, find_best_schedule, select_best
+
+    selection = selection or SELECTION
+    field_size = int(params['field_size'])
+    # Equal requests search with equal random streams once a root seed (IRR_SEED) is set
+    seed = derive_seed(zlib.crc32(json.dumps(params, sort_keys=True).encode()))
+
+    fronts = []
+
+    def report(front, evaluations):
+        fronts[:] = [front]
+        if job is None:
+            return
 
+        schedule, harvest_date = select_best(front.items, field_size, selection=selection)
+        solution, (yield_, total_irr, _) = best_result(front.items, selection)
+        job.report({'evaluations': evaluations, 'yield': yield_, 'total_irrigation': total_irr * field_size,
+                    'schedule': schedule.Liters.to_dict(), 'harvest_date': str(harvest_date), 'front': front.to_list(),
+                    'ensemble': solution.attrs.get('ensemble')})
+        job.pareto = pareto_points(front, field_size)
 
-@app.route("/create-simulation", methods=['POST'])
+    with profile(f"job.{sim_id}"):
+        seeds = None
+        if DATABASE_ENABLED:
+            with tracer.span('db.warm_start_seeds'), Session() as session:
+                seeds = warm_start_seeds(session, ip, params)
+
+        opt_schedule, harvest_date = find_best_schedule(start=params['start_date'], end=params['end_date'],
+                                                        crop=params['crop_type'], field_size=field_size,
+                                                        max_irr_liters=int(params['max_water']), seeds=seeds,
+                                                        pool=pool, progress=report,
+                                                        cancel=job.cancel_event if job else None, seed=seed,
+                                                        selection=selection)
+        return store_simulation(sim_id, ip, params, opt_schedule, harvest_date,
+                                pareto_points(fronts[0], field_size) if fronts else [])
+
+
+def run_simulations(ids: list, ip: str, fields: list, pool=None, job=None, selections: list = None):
+    """
+        Job body of /create-simulations: optimize the schedules of all fields, see `find_best_schedules`, and store
+        every field with the Pareto set of its budget levels as soon as it finishes. The progress of the job lists the
+        stored simulations in the order of the fields, None for fields which did not finish yet, such that
+        /jobs/<job_id>/events streams every field as it comes in. Fields which finished before the job got cancelled
+        or failed stay stored.
+        :param selections: how the schedule of every field is picked, see `run_simulation`
+    """
+    from irr_simulations import find_best_schedules
+
+    batch = [dict(start=params['start_date'], end=params['end_date'], crop=params['crop_type'],
+                  field_size=int(params['field_size']), max_irr_liters=int(params['max_water']),
+                  **({'selection': selection} if selection else {}))
+             for params, selection in zip(fields, selections or [None] * len(fields))]
+    stored = [None] * len(fields)
+    with profile(f"job.{job.id if job else ids[0]}"):
+        cancel = job.cancel_event if job else None
+        for i, (opt_schedule, harvest_date), front in find_best_schedules(batch, pool=pool, cancel=cancel):
+            stored[i] = store_simulation(ids[i], ip, fields[i], opt_schedule, harvest_date,
+                                         pareto_points(front, int(fields[i]['field_size'])))
+            if job is not None:
+                job.report({'fields': len(fields), 'done': sum(sim is not None for sim in stored),
+                            'field': i, 'simulations': list(stored)})
+    return stored
+
+
+def store_simulations(ip: str, results: list) -> list:
+    """
+        Store finished simulations with a single upsert
+        :param results: (id, params, schedule, harvest date, Pareto set) of every simulation, see `pareto_points`
+        :returns: their ids, nodes without a database return the whole simulations
+    """
+    if not DATABASE_ENABLED:
+        return [{'id': sim_id, 'schedule': opt_schedule.Liters.to_dict(), 'harvest_date': str(harvest_date), **params,
+                 'pareto': points, 'ensemble': opt_schedule.attrs.get('ensemble')}
+                for sim_id, params, opt_schedule, harvest_date, points in results]
+
+    sims = [Simulation(id=sim_id, mac_address=ip, schedule=opt_schedule.Liters.to_dict(),
+                       harvest_date=str(harvest_date), **params)
+            for sim_id, params, opt_schedule, harvest_date, _ in results]
+    with tracer.span('db.upsert_simulations'), Session() as session:
+        return upsert_simulations(session, sims, pareto={sim_id: points for sim_id, *_, points in results})
+
+
+def store_simulation(sim_id: str, ip: str, params: dict, opt_schedule, harvest_date, pareto: list):
+    """ Store a finished simulation, see `store_simulations` """
+    return store_simulations(ip, [(sim_id, params, opt_schedule, harvest_date, pareto)])[0]
+
+
+def request_selection(body: dict) -> str:
+    """ The optional `selection` of a request, see `irr_simulations.best_result` """
+    from irr_simulations import SELECTIONS
+
+    selection = body.get('selection')
+    if selection is not None and selection not in SELECTIONS:
+        raise ValueError(f"Unknown selection '{selection}'")
+    return selection
+
+
+@api.route("/create-simulation", methods=['POST'])
 def create_update_simulation():
     try:
         ip = request.remote_addr
-        start_date = request.json['start_date']
-        end_date = request.json['end_date']
-        crop_type = request.json['crop_type']
-        crop_stage = request.json['crop_stage']
-        field_size = request.json['field_size']
-        max_water = request.json['max_water']
+        params = {key: request.json[key] for key in SIMULATION_FIELDS}
+        selection = request_selection(request.json)
     except Exception as e:
         return BAD_REQUEST
 
-    opt_schedule, harvest_date = find_best_schedule(start=start_date, end=end_date, crop=crop_type,
-                                                    field_size=int(field_size), max_irr_liters=int(max_water))
-    sim = Simulation(id=str(uuid.uuid4()), mac_address=ip, schedule=opt_schedule.Liters.to_dict(),
-                     harvest_date=str(harvest_date), **request.json)
+    try:
+        job = jobs.submit(run_simulation, str(uuid.uuid4()), ip, params, selection=selection)
+    except QueueFull:
+        abort(SERVICE_UNAVAILABLE)
 
-    with Session() as session:
-        return jsonify(create_simulation(session, sim))
+    return jsonify(job.to_dict()), ACCEPTED
+
+
+@api.route("/create-simulations", methods=['POST'])
+def create_update_simulations():
+    """ Optimize many fields in one job, its result lists the simulations in the order of the fields """
+    try:
+        ip = request.remote_addr
+        fields = [{key: field[key] for key in SIMULATION_FIELDS} for field in request.json['fields']]
+        selections = [request_selection(field) for field in request.json['fields']]
+    except Exception as e:
+        return BAD_REQUEST
+
+    try:
+        job = jobs.submit(run_simulations, [str(uuid.uuid4()) for _ in fields], ip, fields, selections=selections)
+    except QueueFull:
+        abort(SERVICE_UNAVAILABLE)
+
+    return jsonify(job.to_dict()), ACCEPTED
+
+
+@api.route("/jobs")
+def get_jobs():
+    return jsonify(jobs.stats())
+
+
+@api.route("/jobs/<job_id>")
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(NOT_FOUND)
+
+    return jsonify(job.to_dict())
+
+
+@api.route("/jobs/<job_id>/events")
+def get_job_events(job_id):
+    """
+        Server-Sent Events of a job: an event with the job, including its progress, whenever it changes, until it
+        is finished. The last event is named after the final status (done, failed or cancelled).
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        abort(NOT_FOUND)
+
+    def stream():
+        version = -1
+        while True:
+            changed, version = version, job.wait(version, timeout=15)
+            if changed == version:
+                yield ': keep-alive\n\n'
+                continue
+
+            finished = job.finished is not None
+            yield f"event: {job.status if finished else 'progress'}\ndata: {json.dumps(job.to_dict())}\n\n"
+            if finished:
+                return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                    'X-Accel-Buffering': 'no'})
+
+
+@api.route("/jobs/<job_id>/cancel", methods=['POST'])
+def cancel_job(job_id):
+    """ Stop a job, levels which are already running finish but no further work is started for it """
+    job = jobs.cancel(job_id)
+    if job is None:
+        abort(NOT_FOUND)
+
+    return jsonify(job.to_dict()), ACCEPTED
+
+
+@api.route("/jobs/<job_id>/pareto")
+def get_job_pareto(job_id):
+    """
+        Pareto set of a running job so far, see `pareto_points`. Once the job is done the set is stored with its
+        simulation, see /get-pareto/<uid>.
+    """
+    job = jobs.get(job_id)
+    if job is None or job.pareto is None:
+        abort(NOT_FOUND)
+
+    return jsonify(job.pareto)
+
+
+def create_app() -> Flask:
+    """ Application factory, also picked up by `flask --app irr_api run` """
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(api)
+    return app
 
 
-if platform != 'win32' or __name__ == "__main__":
-    init_database()
-    app.run(host='0.0.0.0', port=5555)
+if __name__ == "__main__":
+    if DATABASE_ENABLED:
+        init_database()
+    get_pool().pool  # Start the workers before the first request needs them
+    create_app().run(host='0.0.0.0', port=5555)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from irr_tracing import tracer
+
+CACHE_VERSION = 3
+CACHE_SIZE = int(os.getenv('IRR_CACHE_SIZE', 4096))
+CACHE_DIR = os.getenv('IRR_CACHE_DIR')
+
+
+def make_key(**inputs) -> str:
+    """
+        Canonical hash of the simulation inputs. Keys are sorted and dumped without whitespace, such that equal
+        inputs always hash to the same key regardless of the order they were passed in.
+    """
+    payload = json.dumps({'version': CACHE_VERSION, **inputs}, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+        Two tiered cache for simulation results: an in-memory LRU per process and an optional directory on disk that
+        is shared by all processes pointing to it (pool workers, API restarts). Lookups are counted by the tracer as
+        well, such that the counts of the pool workers add up in the API process, see `counter_stats`.
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, directory: str = None):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        """ Look up a key in memory first and on disk second; returns None on a miss """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                tracer.count('result_cache.hits')
+                return self._entries[key]
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'r') as fp:
+                    value = tuple(json.load(fp))
+            except (OSError, ValueError):
+                pass
+            else:
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                tracer.count('result_cache.disk_hits')
+                return value
+
+        with self._lock:
+            self.misses += 1
+        tracer.count('result_cache.misses')
+        return None
+
+    def put(self, key: str, value: tuple):
+        self._remember(key, value)
+
+        if self.directory is not None:
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Write to a temporary file first and move it in place, such that concurrent readers never see partial data
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(list(value), fp)
+                os.replace(tmp_path, path)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def clear(self):
+        """ Clear the in-memory tier and the counters; the disk tier is left untouched """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), **_lookup_stats(self.hits, self.disk_hits, self.misses)}
+
+
+def _lookup_stats(hits: int, disk_hits: int, misses: int) -> dict:
+    lookups = hits + disk_hits + misses
+    return {
+        'hits': hits,
+        'disk_hits': disk_hits,
+        'misses': misses,
+        'hit_rate': (hits + disk_hits) / lookups if lookups else 0.,
+    }
+
+
+def counter_stats(counters: dict) -> dict:
+    """ Lookups of the result caches of all processes, from the counters of a tracer snapshot """
+    return _lookup_stats(*(int(counters.get(f'result_cache.{name}', 0)) for name in ('hits', 'disk_hits', 'misses')))
+
+
+result_cache = ResultCache(directory=CACHE_DIR)
@@ -0,0 +1,158 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from irr_pool import get_pool
+
+MAX_JOBS = int(os.getenv('IRR_MAX_JOBS', 2))
+MAX_QUEUED = int(os.getenv('IRR_MAX_QUEUED', 32))
+MAX_FINISHED = 1000
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at its maximum depth"""
+
+
+class Job:
+    """Bookkeeping of a single submitted job"""
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.pareto = None  # Schedules of the front so far, not part of `to_dict`
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self.version = 0
+        self.cancel_event = threading.Event()
+        self._changed = threading.Condition()
+
+    def _notify(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def report(self, progress: dict):
+        """ Publish the progress of the running job, e.g. its best result so far """
+        self.progress = progress
+        self._notify()
+
+    def cancel(self):
+        """ Ask the job to stop, a job which did not start yet is cancelled right away """
+        self.cancel_event.set()
+        if self.status == 'queued':
+            self.status = 'cancelled'
+            self.finished = time()
+        self._notify()
+
+    def wait(self, version: int, timeout: float = None) -> int:
+        """ Block until the job changed since `version` or the timeout passed, :returns: the current version """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def to_dict(self):
+        now = time()
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'progress': self.progress,
+            'queued_seconds': (self.started or now) - self.submitted,
+            'run_seconds': (self.finished or now) - self.started if self.started else None,
+        }
+
+
+class JobQueue:
+    """
+        Bounded job queue which lives for the whole service. Jobs are run by a small number of threads, which hand
+        the actual simulation work to the warm process pool shared by all jobs.
+    """
+
+    def __init__(self, max_jobs: int = MAX_JOBS, max_queued: int = MAX_QUEUED, pool=None):
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.pool = pool or get_pool()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='irr-job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Job:
+        """
+            Queue `fn(*args, pool=<shared pool>, job=<job>, **kwargs)`, its return value is stored as the job result.
+            The function can publish progress with `job.report` and should stop once `job.cancel_event` is set.
+        """
+        with self._lock:
+            if sum(job.status == 'queued' for job in self._jobs.values()) >= self.max_queued:
+                raise QueueFull(f"Job queue is full ({self.max_queued} jobs waiting)")
+
+            job = Job()
+            self._jobs[job.id] = job
+            self._evict()
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job: Job, fn, args, kwargs):
+        if job.cancel_event.is_set():
+            return
+
+        job.status = 'running'
+        job.started = time()
+        job._notify()
+        try:
+            job.result = fn(*args, pool=self.pool, job=job, **kwargs)
+            job.status = 'done'
+        except Exception as e:
+            if job.cancel_event.is_set():
+                job.status = 'cancelled'
+            else:
+                job.error = repr(e)
+                job.status = 'failed'
+        finally:
+            job.finished = time()
+            job._notify()
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Job:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        """ :returns: The cancelled job, or None if it does not exist """
+        job = self._jobs.get(job_id)
+        if job is not None and job.finished is None:
+            job.cancel()
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        run_times = [job.finished - job.started for job in jobs if job.status == 'done']
+        return {
+            'queued': sum(job.status == 'queued' for job in jobs),
+            'running': sum(job.status == 'running' for job in jobs),
+            'done': sum(job.status == 'done' for job in jobs),
+            'failed': sum(job.status == 'failed' for job in jobs),
+            'cancelled': sum(job.status == 'cancelled' for job in jobs),
+            'max_jobs': self.max_jobs,
+            'max_queued': self.max_queued,
+            'pool_size': self.pool.size,
+            'mean_run_seconds': sum(run_times) / len(run_times) if run_times else None,
+            'jobs': [job.to_dict() for job in jobs if job.finished is None],
+        }
+
+    def shutdown(self, wait: bool = True):
+        """ Stop the job threads, the warm pool is shut down by its owner """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,187 @@
+"""
+    Precomputed best schedules of common requests, looked up by `find_best_schedule` before it optimizes. Build or
+    extend the table offline, from this directory:
+
+        python irr_lookup.py --output lookup.sqlite --year 2021 --months 4 5 6
+
+    and point the service to it with `IRR_LOOKUP_PATH=lookup.sqlite`. The planting dates have to be covered by the
+    weather of the station, so `--year` defaults to its last year of measured weather.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from database import decode_schedule, encode_schedule, SCHEDULE_DATE_FORMAT
+from irr_tracing import tracer
+
+LOOKUP_PATH = os.getenv('IRR_LOOKUP_PATH')
+LOOKUP_MAX_DAYS = int(os.getenv('IRR_LOOKUP_MAX_DAYS', 3))  # days a planting or end date may be off a grid point
+LOOKUP_MAX_GAP = int(os.getenv('IRR_LOOKUP_MAX_GAP', 25))  # mm a budget may be above the largest grid budget below it
+MAX_BUDGET = 500  # mm, larger budgets are not optimized either
+DATE_FORMAT = '%Y-%m-%d'
+DAY_FORMAT = '%m-%d'
+ENSEMBLE_YEAR = 0  # weather year of levels optimized over weather scenarios, which are the same in every year
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS levels (
+        crop TEXT NOT NULL,
+        soil TEXT NOT NULL,
+        day TEXT NOT NULL,
+        weather_year INTEGER NOT NULL,
+        budget INTEGER NOT NULL,
+        start TEXT NOT NULL,
+        "end" TEXT NOT NULL,
+        yield REAL,
+        total_irrigation REAL NOT NULL,
+        harvest_days INTEGER,
+        schedule BLOB NOT NULL,
+        PRIMARY KEY (crop, soil, day, weather_year, budget)
+    ) WITHOUT ROWID
+"""
+
+
+class LookupTable:
+    """
+        SQLite table of optimized budget levels by crop, soil, day of the year of planting, weather year and budget
+        (mm). The weather year is the year whose weather the levels were optimized with, or `ENSEMBLE_YEAR`. A request
+        is answered from the grid point of its weather year with the nearest planting day, with the schedules shifted
+        onto its own planting date, if that point is within `LOOKUP_MAX_DAYS` and has a budget level close enough
+        below the requested budget.
+    """
+
+    def __init__(self, path: str, readonly: bool = True):
+        uri = f"file:{path}?mode=ro" if readonly else f"file:{path}"
+        self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        if not readonly:
+            with self._lock, self._connection:
+                self._connection.execute(SCHEMA)
+        elif not self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'levels'").fetchone():
+            raise ValueError(f"{path} has no budget levels, (re)build it with irr_lookup.py")
+
+    def put(self, crop: str, soil: str, start_date: datetime, end_date: datetime, budget: int, result: tuple,
+            weather_year: int):
+        """ Store the `optimize_level` result of a budget level """
+        solution, (yield_, total_irr, harvest_date) = result
+        harvest = pd.Timestamp(harvest_date)
+        schedule = dict(zip(solution.Date.dt.strftime(SCHEDULE_DATE_FORMAT), solution.Depth.astype(float)))
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO levels VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (crop, soil, start_date.strftime(DAY_FORMAT), int(weather_year), int(budget),
+                 start_date.strftime(DATE_FORMAT), end_date.strftime(DATE_FORMAT),
+                 None if np.isnan(yield_) else float(yield_), float(total_irr),
+                 None if pd.isna(harvest) else (harvest - pd.Timestamp(start_date)).days, encode_schedule(schedule)))
+
+    def keys(self) -> set:
+        """ (crop, soil, planting day, weather year, budget) of all stored levels """
+        with self._lock:
+            return set(self._connection.execute('SELECT crop, soil, day, weather_year, budget FROM levels'))
+
+    def lookup(self, crop: str, soil: str, start_date: datetime, end_date: datetime, max_irr_mm: float,
+               weather_year: int) -> list:
+        """
+            :param weather_year: year whose weather the request is optimized with, or `ENSEMBLE_YEAR`
+            :returns: `optimize_level` results of the budget levels up to `max_irr_mm` of the nearest grid point,
+                dated from `start_date`, or None if the table has no grid point close enough
+        """
+        # Planting days around the requested one, by their distance, which also works across the turn of the year
+        offsets = {(start_date + timedelta(days=offset)).strftime(DAY_FORMAT): abs(offset)
+                   for offset in range(LOOKUP_MAX_DAYS, -LOOKUP_MAX_DAYS - 1, -1)}
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT day, start, "end", budget, yield, total_irrigation, harvest_days, schedule FROM levels '
+                'WHERE crop = ? AND soil = ? AND weather_year = ? AND budget <= ? '
+                f'AND day IN ({", ".join("?" * len(offsets))})',
+                (crop, soil, int(weather_year), int(min(max_irr_mm, MAX_BUDGET)), *offsets)).fetchall()
+
+        season = (end_date - start_date).days
+        rows = [row for row in rows
+                if abs((datetime.strptime(row[2], DATE_FORMAT) - datetime.strptime(row[1], DATE_FORMAT)).days - season)
+                <= LOOKUP_MAX_DAYS]
+        if not rows:
+            tracer.count('lookup.miss')
+            return None
+
+        nearest = min({row[0] for row in rows}, key=offsets.get)
+        rows = [row for row in rows if row[0] == nearest]
+        if max(row[3] for row in rows) < min(max_irr_mm, MAX_BUDGET) - LOOKUP_MAX_GAP:
+            tracer.count('lookup.miss')
+            return None
+
+        results = []
+        for _, start, _, _, yield_, total_irr, harvest_days, schedule in rows:
+            shift = start_date - datetime.strptime(start, DATE_FORMAT)
+            schedule = decode_schedule(schedule)
+            solution = pd.DataFrame({'Date': pd.to_datetime(list(schedule), format=SCHEDULE_DATE_FORMAT) + shift,
+                                     'Depth': np.array(list(schedule.values()), dtype=int)})
+            harvest = (np.datetime64(start_date + timedelta(days=harvest_days), 'ns') if harvest_days is not None
+                       else np.datetime64('NaT', 'ns'))
+            results.append((solution, (np.nan if yield_ is None else yield_, total_irr, str(harvest))))
+
+        tracer.count('lookup.hit')
+        return results
+
+
+lookup_table = LookupTable(LOOKUP_PATH) if LOOKUP_PATH else None
+
+
+def grid(year: int, months: list, crops: list, budgets: list, soil: str) -> list:
+    """ (planting date, end date, crop, soil, budget) of every weekly planting date in the months """
+    from aquacrop.entities.crops.crop_params import crop_params
+
+    starts = [day.to_pydatetime() for month in months
+              for day in pd.date_range(datetime(year, month, 1), periods=5, freq='7D') if day.month == month]
+    return [(start, start + timedelta(days=int(crop_params[crop]['MaturityCD'])), crop, soil, int(budget))
+            for crop in crops for start in starts for budget in budgets]
+
+
+def last_measured_year(station) -> int:
+    """ Last year of which the station has measured weather until the end of the year """
+    last = pd.Timestamp(station.days[np.flatnonzero(station.measured)[-1]], unit='D')
+    return last.year if (last.month, last.day) == (12, 31) else last.year - 1
+
+
+def main():
+    from irr_pool import get_pool
+    from irr_simulations import OPTIMIZER, _optimize_task, lookup_year, simulation_horizon
+    from weather_store import weather_store
+
+    station = weather_store.station()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='lookup.sqlite', help='table to create or extend')
+    parser.add_argument('--year', type=int, default=last_measured_year(station), help='year of the planting dates')
+    parser.add_argument('--months', type=int, nargs='+', default=[4, 5, 6], help='months of the planting dates')
+    parser.add_argument('--crops', nargs='+', default=['Maize', 'Tomato', 'DryBean', 'Potato'])
+    parser.add_argument('--soil', default='SandyLoam')
+    parser.add_argument('--budgets', type=int, nargs='+', default=list(range(0, MAX_BUDGET + 1, 25)), help='mm')
+    parser.add_argument('--searches', type=int, default=100, help='candidate schedules per budget level')
+    args = parser.parse_args()
+
+    levels = grid(args.year, args.months, args.crops, args.budgets, args.soil)
+    for start, end, crop, _, _ in levels:
+        if start < station.first_date or start + timedelta(days=simulation_horizon(crop, start, end)) > station.last_date:
+            parser.error(f"--year {args.year}: {crop} planted on {start:%Y-%m-%d} is not covered by the weather "
+                         f"from {station.first_date:%Y-%m-%d} to {station.last_date:%Y-%m-%d}")
+
+    table = LookupTable(args.output, readonly=False)
+    done = table.keys()
+    tasks = [(start, end, crop, soil, budget, args.searches, OPTIMIZER, None)
+             for start, end, crop, soil, budget in levels
+             if (crop, soil, start.strftime(DAY_FORMAT), lookup_year(start), budget) not in done]
+
+    # Every level is stored as soon as it is optimized, such that an interrupted run continues where it stopped
+    print(f"Optimizing {len(tasks)} budget levels, {len(done)} are stored already")
+    for i, (task, result) in enumerate(get_pool().imap_unordered(_optimize_task, tasks)):
+        start, end, crop, soil, budget = task[:5]
+        table.put(crop, soil, start, end, budget, result, lookup_year(start))
+        print(f"[{i + 1}/{len(tasks)}] {crop} {start:%Y/%m/%d} {budget} mm: {result[1][0]:.2f} tonne/ha")
+
+
+if __name__ == "__main__":
+    main()
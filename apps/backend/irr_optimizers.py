@@ -0,0 +1,475 @@
+import os
+import warnings
+
+import numpy as np
+from scipy.stats import norm, qmc
+
+from irr_pareto import crowding_distance, non_dominated_sort
+
+SAMPLER = os.getenv('IRR_SAMPLER', 'random')  # random, sobol or halton samples of the simplex
+ROOT_SEED = int(os.environ['IRR_SEED']) if os.getenv('IRR_SEED') else None
+
+# Every process draws its streams from its own seed sequence, see `seed_process`
+_seed_sequence = np.random.SeedSequence(ROOT_SEED)
+
+
+def seed_process(*keys: int):
+    """
+        Derive the random streams of this process from the root seed (`IRR_SEED`, fresh entropy if not set) and
+        `keys`, e.g. the identity of a pool worker, such that forked processes never continue the same state.
+        The legacy global `np.random` functions are seeded as well.
+    """
+    global _seed_sequence
+    _seed_sequence = np.random.SeedSequence(ROOT_SEED, spawn_key=keys)
+    np.random.seed(_seed_sequence.generate_state(1)[0])
+
+
+def derive_seed(*keys: int) -> int:
+    """ Seed derived from the root seed and `keys`, e.g. of a request; None if no root seed is set """
+    if ROOT_SEED is None:
+        return None
+    return int(np.random.SeedSequence(ROOT_SEED, spawn_key=keys).generate_state(1, np.uint64)[0])
+
+
+def make_rng(seed=None) -> np.random.Generator:
+    """ Generator of `seed`, or of the next independent stream of this process if it is None """
+    return np.random.default_rng(seed if seed is not None else _seed_sequence.spawn(1)[0])
+
+
+def simplex_points(u: np.ndarray) -> np.ndarray:
+    """ Map points of the unit hypercube to uniformly distributed points on the unit simplex """
+    e = -np.log(np.clip(u, 1e-12, 1))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+class Optimizer:
+    """
+        Gradient-free ask/tell optimizer over the water-budget simplex: every asked schedule is a vector of
+        non-negative irrigation depths which sums up to the budget. Objective values are minimized.
+    """
+
+    def __init__(self, dim: int, budget: float, popsize: int = 8, rng: np.random.Generator = None, seeds=None,
+                 tol: float = 1e-3, patience: int = 40, sampler: str = SAMPLER):
+        """
+            :param dim: number of irrigation days in the schedule
+            :param budget: total irrigation depth (mm) to divide over the days
+            :param popsize: number of schedules asked at once
+            :param rng: random generator, a fresh one is created if not given
+            :param seeds: schedules to start the search from
+            :param tol: relative improvement of the best objective value which counts as progress
+            :param patience: number of evaluations without progress after which the search has converged
+            :param sampler: `random` for independent samples of the simplex, or the low-discrepancy sequence `sobol`
+                or `halton` which covers it more evenly
+        """
+        self.dim = dim
+        self.budget = float(budget)
+        self.popsize = popsize
+        self.rng = rng if rng is not None else make_rng()
+        self.seeds = [self.fractions(seed) for seed in seeds] if seeds is not None else []
+        self.tol = tol
+        self.patience = patience
+        self.best_x = None
+        self.best_f = np.inf
+        self.evaluations = 0
+        self._history = []  # Evaluations and best objective value after every batch
+
+        if sampler == 'sobol':
+            self._qmc = qmc.Sobol(dim, seed=self.rng)
+        elif sampler == 'halton':
+            self._qmc = qmc.Halton(dim, seed=self.rng)
+        elif sampler == 'random':
+            self._qmc = None
+        else:
+            raise ValueError(f"Unknown sampler '{sampler}', choose from random, sobol, halton")
+
+    def fractions(self, x: np.ndarray) -> np.ndarray:
+        """ Map a schedule to the unit simplex """
+        x = np.clip(np.asarray(x, dtype=float), 0, None)
+        total = x.sum()
+        return x / total if total > 0 else np.full(self.dim, 1 / self.dim)
+
+    def to_schedule(self, fractions: np.ndarray) -> np.ndarray:
+        fractions = np.clip(fractions, 0, None)
+        total = fractions.sum(axis=-1, keepdims=True)
+        return np.where(total > 0, fractions / np.where(total > 0, total, 1), 1 / self.dim) * self.budget
+
+    def sample(self, n: int) -> np.ndarray:
+        """ Uniform samples on the simplex, as fractions """
+        if self._qmc is None:
+            return self.rng.dirichlet(np.ones(self.dim), size=n)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Sobol points are best balanced in powers of two, any n is fine here
+            return simplex_points(self._qmc.random(n))
+
+    def initial(self, n: int) -> np.ndarray:
+        """ First `n` fractions to evaluate: the seeds, filled up with random samples """
+        seeds = np.array(self.seeds[:n]).reshape(-1, self.dim)
+        return np.vstack([seeds, self.sample(n - len(seeds))])
+
+    def ask(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def tell(self, xs: np.ndarray, fs: np.ndarray):
+        """ Report the objective values of (a prefix of) the last asked schedules """
+        fs = np.asarray(fs, dtype=float)
+        if len(fs):
+            i = int(np.argmin(fs))
+            if fs[i] < self.best_f:
+                self.best_f = float(fs[i])
+                self.best_x = np.asarray(xs[i], dtype=float)
+
+        self.evaluations += len(fs)
+        self._history.append((self.evaluations, self.best_f))
+
+    @property
+    def converged(self) -> bool:
+        before = [f for evaluations, f in self._history if evaluations <= self.evaluations - self.patience]
+        if not before or not np.isfinite(self.best_f):
+            return False
+
+        progress = before[-1] - self.best_f
+        return progress <= self.tol * max(1., abs(self.best_f))
+
+
+class RandomSearch(Optimizer):
+    """Independent uniform samples on the simplex, never converges on its own"""
+
+    def ask(self) -> np.ndarray:
+        fractions = self.initial(self.popsize) if self.evaluations == 0 else self.sample(self.popsize)
+        return self.to_schedule(fractions)
+
+    @property
+    def converged(self) -> bool:
+        return False
+
+
+class CMAES(Optimizer):
+    """
+        Covariance matrix adaptation evolution strategy. Searches a latent space which is mapped onto the simplex by
+        a softmax, such that the budget constraint always holds.
+    """
+
+    def __init__(self, dim: int, budget: float, popsize: int = None, sigma: float = 1., **kwargs):
+        super().__init__(dim, budget, popsize or 4 + int(3 * np.log(max(dim, 1))), **kwargs)
+        n = dim
+        self.mu = self.popsize // 2
+        weights = np.log(self.mu + .5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0., np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+        self.mean = np.log(self.seeds[0] + 1e-3) if self.seeds else np.zeros(n)
+        self.mean -= self.mean.mean()
+        self.sigma = sigma * .3 if self.seeds else sigma  # A seed only needs local refinement
+        self.C = np.eye(n)
+        self.B = np.eye(n)
+        self.D = np.ones(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.generation = 0
+        self._latent = None
+
+    def _softmax(self, latent: np.ndarray) -> np.ndarray:
+        e = np.exp(latent - latent.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+
+    def ask(self) -> np.ndarray:
+        z = self.rng.standard_normal((self.popsize, self.dim))
+        self._latent = self.mean + self.sigma * (z * self.D) @ self.B.T
+        return self.to_schedule(self._softmax(self._latent))
+
+    def tell(self, xs: np.ndarray, fs: np.ndarray):
+        super().tell(xs, fs)
+
+        # A truncated generation (end of the evaluation budget) is too small to update the distribution from
+        if len(fs) < self.popsize:
+            return
+
+        self.generation += 1
+        best = self._latent[np.argsort(fs)[:self.mu]]
+        old_mean = self.mean
+        self.mean = self.weights @ best
+        y_w = (self.mean - old_mean) / self.sigma
+
+        inv_sqrt_c = self.B @ np.diag(1 / self.D) @ self.B.T
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_c @ y_w
+        h_sig = (np.linalg.norm(self.ps) / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chi_n
+                 < 1.4 + 2 / (self.dim + 1))
+        self.pc = (1 - self.cc) * self.pc + h_sig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+
+        steps = (best - old_mean) / self.sigma
+        self.C = ((1 - self.c1 - self.cmu) * self.C
+                  + self.c1 * (np.outer(self.pc, self.pc) + (1 - h_sig) * self.cc * (2 - self.cc) * self.C)
+                  + self.cmu * steps.T @ np.diag(self.weights) @ steps)
+        self.sigma *= np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1))
+
+        self.C = np.triu(self.C) + np.triu(self.C, 1).T
+        eigenvalues, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.clip(eigenvalues, 1e-20, None))
+
+    @property
+    def converged(self) -> bool:
+        return super().converged or self.sigma * self.D.max() < self.tol
+
+
+class DifferentialEvolution(Optimizer):
+    """DE/rand/1/bin on the unit hypercube, where every point is normalized onto the simplex"""
+
+    def __init__(self, dim: int, budget: float, popsize: int = 10, mutation: float = .7, crossover: float = .9,
+                 **kwargs):
+        super().__init__(dim, budget, max(popsize, 4), **kwargs)
+        self.mutation = mutation
+        self.crossover = crossover
+        self.population = self.initial(self.popsize)
+        self.fitness = None
+        self._trials = None
+
+    def ask(self) -> np.ndarray:
+        if self.fitness is None:
+            self._trials = self.population
+        else:
+            n = self.popsize
+            others = np.array([self.rng.choice(np.delete(np.arange(n), i), 3, replace=False) for i in range(n)])
+            a, b, c = (self.population[others[:, k]] for k in range(3))
+            mutants = np.clip(a + self.mutation * (b - c), 0, 1)
+
+            cross = self.rng.random((n, self.dim)) < self.crossover
+            cross[np.arange(n), self.rng.integers(0, self.dim, n)] = True
+            self._trials = np.where(cross, mutants, self.population)
+
+        return self.to_schedule(self._trials)
+
+    def tell(self, xs: np.ndarray, fs: np.ndarray):
+        super().tell(xs, fs)
+        fs = np.asarray(fs, dtype=float)
+        k = len(fs)
+
+        if self.fitness is None:
+            self.fitness = np.full(self.popsize, np.inf)
+            self.fitness[:k] = fs
+            self.population = self._trials
+        else:
+            improved = fs <= self.fitness[:k]
+            self.population[:k][improved] = self._trials[:k][improved]
+            self.fitness[:k][improved] = fs[improved]
+
+
+class GaussianProcess:
+    """Gaussian process regression with an RBF kernel and normalized targets"""
+
+    def __init__(self, length_scale: float = None, noise: float = 1e-4):
+        self.length_scale = length_scale
+        self.noise = noise
+
+    def _kernel(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        sq_dist = np.sum(a ** 2, 1)[:, None] + np.sum(b ** 2, 1)[None, :] - 2 * a @ b.T
+        return np.exp(-.5 * np.clip(sq_dist, 0, None) / self._length_scale ** 2)
+
+    def fit(self, X: np.ndarray, y: np.ndarray):
+        self.X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean = y.mean()
+        self.y_std = y.std() or 1.
+
+        if self.length_scale is None:
+            # Median heuristic on the pairwise distances
+            dist = np.sqrt(np.clip(np.sum((self.X[:, None] - self.X[None]) ** 2, -1), 0, None))
+            self._length_scale = float(np.median(dist[dist > 0])) if np.any(dist > 0) else 1.
+        else:
+            self._length_scale = self.length_scale
+
+        K = self._kernel(self.X, self.X) + self.noise * np.eye(len(self.X))
+        self.L = np.linalg.cholesky(K)
+        self.alpha = np.linalg.solve(self.L.T, np.linalg.solve(self.L, (y - self.y_mean) / self.y_std))
+        return self
+
+    def predict(self, X: np.ndarray) -> (np.ndarray, np.ndarray):
+        """ :returns: predicted mean and standard deviation """
+        K_s = self._kernel(np.asarray(X, dtype=float), self.X)
+        mean = K_s @ self.alpha
+        v = np.linalg.solve(self.L, K_s.T)
+        std = np.sqrt(np.clip(1 - np.sum(v ** 2, 0), 1e-12, None))
+        return mean * self.y_std + self.y_mean, std * self.y_std
+
+
+class BayesianOptimization(Optimizer):
+    """
+        Gaussian process surrogate with expected improvement. Batches are filled with the constant liar heuristic:
+        every picked point is added to the model with the current best value before picking the next one.
+    """
+
+    def __init__(self, dim: int, budget: float, popsize: int = 8, initial_samples: int = None,
+                 candidates: int = 1000, **kwargs):
+        super().__init__(dim, budget, popsize, **kwargs)
+        self.initial_samples = initial_samples or 2 * popsize
+        self.candidates = candidates
+        self.X = np.empty((0, dim))
+        self.y = np.empty(0)
+        self.max_ei = np.inf
+
+    def _candidates(self) -> np.ndarray:
+        """ Uniform samples plus samples concentrated around the best fractions found so far """
+        n_local = self.candidates // 2
+        best = self.X[np.argmin(self.y)]
+        local = self.rng.dirichlet(50 * best + .1, size=n_local)
+        return np.vstack([self.sample(self.candidates - n_local), local])
+
+    def ask(self) -> np.ndarray:
+        if len(self.y) < self.initial_samples:
+            n = min(self.popsize, self.initial_samples - len(self.y))
+            return self.to_schedule(self.initial(n) if len(self.y) == 0 else self.sample(n))
+
+        candidates = self._candidates()
+        X, y = self.X, self.y
+        picked = []
+        for _ in range(self.popsize):
+            mean, std = GaussianProcess().fit(X, y).predict(candidates)
+            improvement = y.min() - mean
+            z = improvement / std
+            ei = improvement * norm.cdf(z) + std * norm.pdf(z)
+
+            i = int(np.argmax(ei))
+            if not picked:
+                self.max_ei = float(ei[i])
+            picked.append(candidates[i])
+            X, y = np.vstack([X, candidates[i]]), np.append(y, y.min())
+            candidates = np.delete(candidates, i, axis=0)
+
+        return self.to_schedule(np.array(picked))
+
+    def tell(self, xs: np.ndarray, fs: np.ndarray):
+        super().tell(xs, fs)
+        xs = np.asarray(xs)[:len(fs)]
+        self.X = np.vstack([self.X, [self.fractions(x) for x in xs]]) if len(xs) else self.X
+        self.y = np.append(self.y, fs)
+
+    @property
+    def converged(self) -> bool:
+        return super().converged or self.max_ei < self.tol * max(1., abs(self.best_f))
+
+
+class NSGA2(Optimizer):
+    """
+        NSGA-II over several minimized objectives at once. Besides how the water is divided over the days, every
+        schedule has a gene for the fraction of the budget it uses, such that the population spreads over budgets
+        instead of always using all water. Parents are picked by binary tournaments on front and crowding distance,
+        children are made by simulated binary crossover, polynomial mutation and by dropping irrigation days.
+        `tell` takes a row of objective values per schedule, the search runs until its evaluations are spent.
+    """
+
+    def __init__(self, dim: int, budget: float, popsize: int = 16, crossover: float = .9, eta_crossover: float = 15.,
+                 eta_mutation: float = 20., drop: float = None, **kwargs):
+        """
+            :param crossover: probability that two parents are recombined
+            :param eta_crossover: distribution index of the crossover, larger values make children closer to parents
+            :param eta_mutation: distribution index of the mutation
+            :param drop: probability per irrigation day that a child skips it, one day per child on average by default
+        """
+        seeds = kwargs.get('seeds')
+        super().__init__(dim, budget, popsize + popsize % 2, **kwargs)
+        self.crossover = crossover
+        self.eta_crossover = eta_crossover
+        self.eta_mutation = eta_mutation
+        self.drop = drop if drop is not None else 1 / max(dim, 1)
+        self._seed_scales = [min(1., np.sum(np.clip(seed, 0, None)) / self.budget) if self.budget > 0 else 1.
+                             for seed in seeds] if seeds is not None else []
+        self.population = None
+        self.F = None
+        self._rank = None
+        self._crowding = None
+        self._offspring = None
+
+    def schedules(self, genes: np.ndarray) -> np.ndarray:
+        """ Map genes, the day fractions followed by the used fraction of the budget, to irrigation depths """
+        return self.to_schedule(genes[:, :self.dim]) * genes[:, self.dim:]
+
+    def _initial_genes(self) -> np.ndarray:
+        # The budget fractions are stratified, such that the first generation covers all budgets evenly
+        n = self.popsize
+        fractions = self.initial(n)
+        scales = self.rng.permutation((np.arange(n) + self.rng.random(n)) / n)
+        scales[:len(self._seed_scales)] = self._seed_scales[:n]
+        return np.column_stack([fractions, scales])
+
+    def _tournament(self, n: int) -> np.ndarray:
+        a, b = self.rng.integers(0, len(self.population), (2, n))
+        a_wins = (self._rank[a] < self._rank[b]) | ((self._rank[a] == self._rank[b])
+                                                    & (self._crowding[a] >= self._crowding[b]))
+        return np.where(a_wins, a, b)
+
+    def _crossover(self, p1: np.ndarray, p2: np.ndarray) -> (np.ndarray, np.ndarray):
+        u = self.rng.random(p1.shape)
+        beta = np.where(u <= .5, (2 * u) ** (1 / (self.eta_crossover + 1)),
+                        (1 / (2 * (1 - u))) ** (1 / (self.eta_crossover + 1)))
+        beta[self.rng.random(len(p1)) >= self.crossover] = 1  # Pairs which are not recombined are copied
+        mean, half = (p1 + p2) / 2, np.abs(p1 - p2) / 2
+        return mean - beta * half, mean + beta * half
+
+    def _mutate(self, genes: np.ndarray) -> np.ndarray:
+        u = self.rng.random(genes.shape)
+        delta = np.where(u < .5, (2 * u) ** (1 / (self.eta_mutation + 1)) - 1,
+                         1 - (2 * (1 - u)) ** (1 / (self.eta_mutation + 1)))
+        mutate = self.rng.random(genes.shape) < 1 / genes.shape[1]
+        genes = np.clip(genes + mutate * delta, 0, 1)
+        genes[:, :self.dim][self.rng.random((len(genes), self.dim)) < self.drop] = 0
+        return genes
+
+    def ask(self) -> np.ndarray:
+        if self.population is None:
+            self._offspring = self._initial_genes()
+        else:
+            parents = self.population[self._tournament(self.popsize)]
+            c1, c2 = self._crossover(parents[0::2], parents[1::2])
+            self._offspring = self._mutate(np.clip(np.vstack([c1, c2]), 0, 1))
+        return self.schedules(self._offspring)
+
+    def tell(self, xs: np.ndarray, F: np.ndarray):
+        """ :param F: objective values of (a prefix of) the last asked schedules, a row per schedule """
+        F = np.asarray(F, dtype=float).reshape(len(xs[:len(F)]), -1)
+        self.evaluations += len(F)
+        genes = self._offspring[:len(F)]
+        if self.population is not None:
+            genes, F = np.vstack([self.population, genes]), np.vstack([self.F, F])
+
+        # The next population is filled front by front, the last front that fits only partly by crowding distance
+        ranks = non_dominated_sort(F)
+        crowding = np.zeros(len(F))
+        survivors = []
+        for rank in range(ranks.max() + 1):
+            members = np.flatnonzero(ranks == rank)
+            crowding[members] = crowding_distance(F[members])
+            if len(survivors) + len(members) > self.popsize:
+                members = members[np.argsort(-crowding[members], kind='stable')][:self.popsize - len(survivors)]
+            survivors.extend(members)
+            if len(survivors) >= self.popsize:
+                break
+
+        survivors = np.array(survivors)
+        self.population, self.F = genes[survivors], F[survivors]
+        self._rank, self._crowding = ranks[survivors], crowding[survivors]
+
+    @property
+    def converged(self) -> bool:
+        return False
+
+
+OPTIMIZERS = {
+    'random': RandomSearch,
+    'cmaes': CMAES,
+    'de': DifferentialEvolution,
+    'bayes': BayesianOptimization,
+}
+
+
+def make_optimizer(method: str, dim: int, budget: float, **kwargs) -> Optimizer:
+    if method not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer '{method}', choose from {', '.join(OPTIMIZERS)}")
+
+    return OPTIMIZERS[method](dim, budget, **kwargs)
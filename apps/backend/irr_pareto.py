@@ -0,0 +1,127 @@
+import threading
+
+import numpy as np
+
+
+def dominates(a, b) -> bool:
+    """ Whether objective vector `a` is at least as good as `b` everywhere and better somewhere, all minimized """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return bool(np.all(a <= b) and np.any(a < b))
+
+
+def non_dominated_sort(F: np.ndarray) -> np.ndarray:
+    """
+        Front number of every row of `F`, all objectives minimized: 0 for the non-dominated rows, 1 for the rows which
+        are only dominated by those, and so on
+    """
+    F = np.nan_to_num(np.asarray(F, dtype=float), nan=np.inf)
+    better_eq = np.all(F[:, None] <= F[None], axis=2)
+    dominated_by = better_eq & np.any(F[:, None] < F[None], axis=2)  # [i, j]: i dominates j
+    count = dominated_by.sum(axis=0)
+    ranks = np.full(len(F), -1)
+    rank = 0
+    current = np.flatnonzero(count == 0)
+    while len(current):
+        ranks[current] = rank
+        count -= dominated_by[current].sum(axis=0)
+        count[ranks >= 0] = -1
+        current = np.flatnonzero(count == 0)
+        rank += 1
+    return ranks
+
+
+def crowding_distance(F: np.ndarray) -> np.ndarray:
+    """ Crowding distance of every row of a single front `F`, the extremes of every objective are infinite """
+    F = np.nan_to_num(np.asarray(F, dtype=float), nan=np.inf, posinf=np.finfo(float).max)
+    n, m = F.shape
+    distance = np.zeros(n)
+    if n <= 2:
+        return np.full(n, np.inf)
+
+    for k in range(m):
+        order = np.argsort(F[:, k], kind='stable')
+        values = F[order, k]
+        span = values[-1] - values[0]
+        distance[order[[0, -1]]] = np.inf
+        if span > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / span
+    return distance
+
+
+class ParetoArchive:
+    """
+        Non-dominated set of items by their objective vectors. Items which are dominated by a newly added one are
+        dropped, such that the archive always holds the current front. The minimized objectives of the front are kept
+        in one array, such that every insert is a single vectorized comparison against the whole front.
+    """
+
+    def __init__(self, names: tuple = None, maximize: tuple = None):
+        """
+            :param names: names of the objectives, used by `to_list`
+            :param maximize: per objective whether it is maximized instead of minimized
+        """
+        self.names = tuple(names) if names else None
+        self.maximize = tuple(maximize) if maximize else None
+        self._keys = None
+        self._objectives = []
+        self._items = []
+        self._lock = threading.Lock()
+
+    def _key(self, objectives) -> np.ndarray:
+        """ Objectives as minimized values, missing values are worst """
+        key = np.asarray(objectives, dtype=float)
+        if self.maximize is not None:
+            key = np.where(self.maximize, -key, key)
+        return np.nan_to_num(key, nan=np.inf)
+
+    def add(self, objectives, item=None) -> bool:
+        """ :returns: Whether the item is on the front, i.e. not dominated by nor equal to an archived one """
+        key = self._key(objectives)
+        with self._lock:
+            if self._keys is None:
+                self._keys = np.empty((0, len(key)))
+
+            covered = np.all(self._keys <= key, axis=1)  # Archived points which dominate or equal the new one
+            if covered.any():
+                return False
+
+            keep = ~(np.all(key <= self._keys, axis=1) & np.any(key < self._keys, axis=1))
+            self._keys = np.vstack([self._keys[keep], key])
+            self._objectives = [o for o, k in zip(self._objectives, keep) if k] + [tuple(float(f) for f in objectives)]
+            self._items = [it for it, k in zip(self._items, keep) if k] + [item]
+            return True
+
+    def update(self, entries):
+        """ Add many (objectives, item) pairs """
+        for objectives, item in entries:
+            self.add(objectives, item)
+
+    def _order(self) -> np.ndarray:
+        # Ordered by the first objective, then the next ones
+        return np.lexsort(self._keys.T[::-1]) if self._keys is not None else np.arange(0)
+
+    @property
+    def objectives(self) -> np.ndarray:
+        with self._lock:
+            return np.array([self._objectives[i] for i in self._order()])
+
+    @property
+    def items(self) -> list:
+        with self._lock:
+            return [self._items[i] for i in self._order()]
+
+    def __iter__(self):
+        """ (objectives, item) pairs, ordered by the first objective """
+        with self._lock:
+            return iter([(self._objectives[i], self._items[i]) for i in self._order()])
+
+    def __len__(self):
+        return len(self._items)
+
+    def to_list(self) -> list:
+        """ Objective values of the front, as dicts if the objectives are named """
+        with self._lock:
+            objectives = [self._objectives[i] for i in self._order()]
+        if self.names is None:
+            return [list(o) for o in objectives]
+        return [dict(zip(self.names, o)) for o in objectives]
@@ -0,0 +1,180 @@
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sys
+import threading
+from collections import deque
+from multiprocessing import util
+
+from irr_tracing import merge_trace, traced_call, traces_workers, tracer
+
+POOL_SIZE = int(os.getenv('IRR_POOL_SIZE', mp.cpu_count()))
+PRELOAD_CROPS = tuple(filter(None, os.getenv('IRR_PRELOAD_CROPS', 'Maize,Tomato,DryBean,Potato').split(',')))
+PRELOAD_SOILS = tuple(filter(None, os.getenv('IRR_PRELOAD_SOILS', 'SandyLoam').split(',')))
+
+
+def _exit_worker(signum, frame):
+    # Leave through the regular exit of the process, which runs the finalizers, e.g. the warehouse flush
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def _init_worker(crops, soils):
+    """ Runs once in every worker: load the weather, aquacrop and the crop/soil parameters before any task arrives """
+    # Forked workers start with a copy of the parent's trace data, which must not be sent back to it
+    tracer.drain()
+    # Terminating the pool would otherwise kill the workers without flushing the rows they buffered. Workers which
+    # already exit, e.g. after the sentinel of the pool, must not be interrupted while they run their finalizers.
+    signal.signal(signal.SIGTERM, _exit_worker)
+    util.Finalize(None, signal.signal, args=(signal.SIGTERM, signal.SIG_IGN), exitpriority=100)
+    with tracer.span('pool.worker_init'):
+        from irr_optimizers import seed_process
+        seed_process(*mp.current_process()._identity)
+
+        import irr_simulations
+        irr_simulations.preload(crops, soils)
+
+
+def _traced_single(task):
+    fn, arg = task
+    return traced_call(fn, (arg,))
+
+
+class WarmPool:
+    """
+        Long-lived process pool whose workers are initialized once and reused across optimizations.
+        Resizing starts a new pool and lets the old one finish its running tasks in the background.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, crops=PRELOAD_CROPS, soils=PRELOAD_SOILS):
+        self.size = size
+        self.crops = tuple(crops)
+        self.soils = tuple(soils)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _start(self, size: int):
+        with tracer.span('pool.start'):
+            return mp.Pool(size, initializer=_init_worker, initargs=(self.crops, self.soils))
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._start(self.size)
+            return self._pool
+
+    def starmap(self, fn, iterable):
+        if not traces_workers():
+            return self.pool.starmap(fn, iterable)
+
+        # Workers send their trace data and sampled stacks back with every result
+        results = []
+        for result, trace in self.pool.starmap(traced_call, [(fn, tuple(args)) for args in iterable]):
+            merge_trace(trace)
+            results.append(result)
+        return results
+
+    def imap_unordered(self, fn, iterable, chunksize: int = 1):
+        if not traces_workers():
+            yield from self.pool.imap_unordered(fn, iterable, chunksize)
+            return
+
+        for result, trace in self.pool.imap_unordered(_traced_single, ((fn, arg) for arg in iterable), chunksize):
+            merge_trace(trace)
+            yield result
+
+    def apply_async(self, fn, args=(), kwds=None, callback=None, error_callback=None):
+        return self.pool.apply_async(fn, args, kwds or {}, callback, error_callback)
+
+    def resize(self, size: int):
+        """ Swap in a pool of the new size, tasks already submitted to the old pool still finish """
+        with self._lock:
+            old, self._pool = self._pool, self._start(size)
+            self.size = size
+
+        if old is not None:
+            old.close()
+            threading.Thread(target=old.join, daemon=True).start()
+
+    def shutdown(self, wait: bool = True):
+        """ Stop accepting tasks and wait for the running ones, or terminate them right away if `wait` is false """
+        with self._lock:
+            old, self._pool = self._pool, None
+
+        if old is not None:
+            if wait:
+                old.close()
+            else:
+                old.terminate()
+            old.join()
+
+
+class TaskScheduler:
+    """
+        Queue of independent tasks for a warm pool, which can grow while results come in. At most `max_pending` tasks
+        (defaults to twice the pool size) are handed to the pool at a time: idle workers always find a task waiting,
+        the workers are shared fairly with the schedulers of other requests, and cancelling leaves little queued work
+        behind.
+    """
+
+    def __init__(self, pool: WarmPool, max_pending: int = None):
+        self.pool = pool
+        self.max_pending = max_pending or 2 * pool.size
+        self.pending = 0
+        self._queued = deque()
+        self._finished = queue.Queue()
+
+    def submit(self, key, fn, *args):
+        """ Queue `fn(*args)`, its result is returned together with `key` """
+        self._queued.append((key, fn, args))
+
+    def __len__(self):
+        return len(self._queued) + self.pending
+
+    def _dispatch(self):
+        while self._queued and self.pending < self.max_pending:
+            key, fn, args = self._queued.popleft()
+            if traces_workers():
+                fn, args = traced_call, (fn, args)
+            self.pool.apply_async(fn, args, callback=lambda result, key=key: self._finished.put((key, True, result)),
+                                  error_callback=lambda e, key=key: self._finished.put((key, False, e)))
+            self.pending += 1
+
+    def results(self, cancel: threading.Event = None):
+        """
+            Generator of (key, result) tuples in the order the tasks finish, until no task is left or `cancel` is
+            set. Queued tasks which were not handed to the pool yet are dropped on cancel.
+        """
+        while not (cancel and cancel.is_set()):
+            self._dispatch()
+            if not self.pending:
+                return
+
+            try:
+                key, ok, result = self._finished.get(timeout=.5)
+            except queue.Empty:
+                continue
+            self.pending -= 1
+            if not ok:
+                raise result
+            if traces_workers():
+                result, trace = result
+                merge_trace(trace)
+            yield key, result
+
+
+_warm_pool = None
+_warm_pool_lock = threading.Lock()
+
+
+def get_pool() -> WarmPool:
+    """ The warm pool shared by the whole process, it is started on first use """
+    global _warm_pool
+    with _warm_pool_lock:
+        if _warm_pool is None:
+            _warm_pool = WarmPool()
+            atexit.register(_warm_pool.shutdown, wait=False)
+        return _warm_pool
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+RESPONSE_CACHE_SIZE = int(os.getenv('IRR_RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = float(os.getenv('IRR_RESPONSE_CACHE_TTL', 300))  # seconds
+
+
+class ResponseCache:
+    """
+        In-process cache of serialized responses with a bounded size (LRU) and a time to live per entry. Every entry
+        keeps the ETag of its body, such that clients can revalidate without downloading it again. Every invalidation
+        bumps the generation of the cache, bodies which were built under an older generation might predate the write
+        and are not stored.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """ :returns: Tuple of the body and its ETag, or None on a miss or an expired entry """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[2] is not None and entry[2] < monotonic()):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def put(self, key: str, body: bytes, ttl: float = None, generation: int = None) -> (bytes, str):
+        """
+            :param ttl: seconds the entry stays valid, defaults to the TTL of the cache; 0 keeps it until evicted
+            :param generation: generation the body was built under, it is only stored if nothing was invalidated since
+            :returns: Tuple of the body and its ETag
+        """
+        ttl = self.ttl if ttl is None else ttl
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return body, etag
+            self._entries[key] = (body, etag, monotonic() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def get_or_create(self, key: str, build, ttl: float = None) -> (bytes, str):
+        """ Cached body of `key`, or the body returned by `build()` which is cached first """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        generation = self.generation
+        return self.put(key, build(), ttl, generation)
+
+    def invalidate(self, *keys: str):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+response_cache = ResponseCache()
@@ -1,21 +1,86 @@
 # SET ENVIRONMENT VARIABLE `DEVELOPMENT=1` FOR THE PROGRAMME TO WORK!
-import multiprocessing as mp
+import os
+from copy import deepcopy
 from datetime import datetime, timedelta
-from time import time
+from functools import lru_cache
+from time import perf_counter, time
 
 import dateutil.parser
 import numpy as np
 import pandas as pd
 from aquacrop import AquaCropModel, Soil, Crop, InitialWaterContent, IrrigationManagement
+from aquacrop.entities.crops.crop_params import crop_params
 from aquacrop.utils import get_filepath, prepare_weather
-from matplotlib import pyplot as plt
 
-weather_df = pd.read_csv('./data/tamale_weather.csv', parse_dates=['Date'])[['MinTemp', 'MaxTemp', 'Precipitation', 'ReferenceET', 'Date']]
+from irr_cache import make_key, result_cache
+from irr_lookup import ENSEMBLE_YEAR, lookup_table
+from irr_optimizers import NSGA2, make_optimizer, make_rng
+from irr_pareto import ParetoArchive
+from irr_pool import TaskScheduler, get_pool
+from irr_surrogate import SURROGATE_ENABLED, get_surrogate, schedule_features
+from irr_tracing import tracer
+from irr_warehouse import warehouse
+from irr_waterbalance import BATCH_ENABLED, CALIBRATION_SAMPLES, BatchWaterBalance
+from weather_store import DEFAULT_STATION, weather_store
+
+MAX_HORIZON = 367  # sim should run at most a year, after which the crop is planted again
+HORIZON_MARGIN = 21  # days of slack after maturity, e.g. for late harvests
+GDD_MARGIN = 1.25  # maturity of growing degree day crops is only an estimate in calendar days
+OPTIMIZER = os.getenv('IRR_OPTIMIZER', 'cmaes')
+REFINE_SEARCHES = 30  # candidates per budget level when starting from previous schedules
+BUDGET_LEVELS = 8  # budget levels of a fixed sweep
+SWEEP_LEVELS = int(os.getenv('IRR_SWEEP_LEVELS', 5))  # budget levels the adaptive sweep starts with
+SWEEP_MAX_EVALUATIONS = int(os.getenv('IRR_SWEEP_MAX_EVALUATIONS', 2000))  # candidate schedules over all levels
+SWEEP_MIN_GAP = 10  # mm between neighbouring levels below which the sweep stops refining
+SWEEP_MIN_CHANGE = .25  # tonne/ha yield difference between neighbouring levels worth refining
+ENSEMBLE_SIZE = int(os.getenv('IRR_ENSEMBLE_SIZE', 0))  # weather scenarios per candidate, 0 uses the season's weather
+ENSEMBLE_RISK = float(os.getenv('IRR_ENSEMBLE_RISK', 0.))  # standard deviations of yield subtracted from its mean
+MULTI_OBJECTIVE = os.getenv('IRR_MULTI_OBJECTIVE', '0') == '1'  # search all objectives at once, see `pareto_search`
+PARETO_POPSIZE = int(os.getenv('IRR_PARETO_POPSIZE', 32))  # schedules per generation of the multi-objective search
+PARETO_MAX_EVALUATIONS = int(os.getenv('IRR_PARETO_MAX_EVALUATIONS', 1000))  # candidate schedules of that search
+SELECTIONS = ('efficiency', 'yield', 'knee')
+SELECTION = os.getenv('IRR_SELECTION', 'efficiency')  # how a schedule is picked from the front, see `best_result`
+
+
+class Cancelled(Exception):
+    """Raised when an optimization stops because it was cancelled"""
+
+
+@lru_cache(maxsize=None)
+def _soil_template(soil: str) -> Soil:
+    return Soil(soil_type=soil)
+
+
+@lru_cache(maxsize=None)
+def _crop_base(crop: str) -> Crop:
+    """ Parameters of a crop, which do not depend on its planting date """
+    return Crop(crop, planting_date='01/01')
+
+
+@lru_cache(maxsize=256)
+def _crop_template(crop: str, planting_date: str) -> Crop:
+    template = deepcopy(_crop_base(crop))
+    template.planting_date = planting_date
+    return template
+
+
+def preload(crops=(), soils=()):
+    """
+        Build the crop and soil parameters up front, such that warm pool workers do not pay for it on first use
+    """
+    for soil in soils:
+        _soil_template(soil)
+    for crop in crops:
+        _crop_base(crop)
 
+    weather_store.station()
 
-def create_initial_irr_schedule(start_date: datetime, end_date: datetime, max_irr: int, irrs_per_month: int = 4):
+
+def create_initial_irr_schedule(start_date: datetime, end_date: datetime, max_irr: int, irrs_per_month: int = 4,
+                                rng: np.random.Generator = None):
     """
         Create randomized starting schedule based on irrigating a maximum of twice a week
+        :param rng: random generator of the depths, the next stream of this process if not given
     """
     month_diff = int(round((end_date - start_date).days / (365 / 12)))
 
@@ -23,7 +88,7 @@ def create_initial_irr_schedule(start_date: datetime, end_date: datetime, max_ir
     irr_days = pd.date_range(start_date, end_date, periods=month_diff * irrs_per_month)
 
     # TODO: add bounds such that watering will not be less than 1L per m2
-    x0 = np.random.dirichlet(np.ones(len(irr_days)), size=1)[0] * max_irr
+    x0 = (rng or make_rng()).dirichlet(np.ones(len(irr_days)), size=1)[0] * max_irr
 
     schedule = pd.DataFrame({
         'Date': irr_days,
@@ -33,96 +98,390 @@ def create_initial_irr_schedule(start_date: datetime, end_date: datetime, max_ir
     return schedule
 
 
-def objective(x: np.ndarray, schedule: pd.DataFrame, start_date: datetime, end_date: datetime, crop: str, soil: str,
-              max_irr_season: int, evaluate: bool = False, verbose: bool = False):
-    schedule.Depth = x.astype(int)  # Update the initial/start irrigation schedule with the model optimization step
+@lru_cache(maxsize=1024)
+def simulation_horizon(crop: str, start_date: datetime, end_date: datetime) -> int:
+    """
+        Shortest number of days to simulate such that the crop reaches maturity and the whole schedule is covered
+    """
+    params = crop_params.get(crop, {})
+    if 'MaturityCD' not in params:
+        return MAX_HORIZON
+
+    maturity = float(params['MaturityCD'])
+    if params.get('CalendarType') == 2:
+        maturity *= GDD_MARGIN
+
+    horizon = max((end_date - start_date).days, int(np.ceil(maturity))) + HORIZON_MARGIN
+    return min(horizon, MAX_HORIZON)
+
+
+@lru_cache(maxsize=1024)
+def weather_scenarios(start_date: datetime, size: int = ENSEMBLE_SIZE, station: str = DEFAULT_STATION) -> tuple:
+    """
+        Historical years whose weather serves as scenarios of a season starting at `start_date` (analog years). A
+        seeded sample is taken if there are more than `size`, such that the same season always gets the same scenarios.
+    """
+    years = weather_store.station(station).analog_years(start_date, start_date + timedelta(days=MAX_HORIZON))
+    if len(years) > size:
+        years = sorted(np.random.default_rng(0).choice(years, size, replace=False).tolist())
+    return tuple(years)
+
+
+@lru_cache(maxsize=64)
+def _scenario_weather(start_date: datetime, end_date: datetime, year: int, station: str) -> pd.DataFrame:
+    return weather_store.window(start_date, end_date, station, year=year)
 
+
+def lookup_year(start_date: datetime) -> int:
+    """ Weather year of the budget levels of a season in the lookup table, see `LookupTable` """
+    return ENSEMBLE_YEAR if ENSEMBLE_SIZE else start_date.year
+
+
+def seed_depths(seed: pd.Series, days: np.ndarray, max_irr_season: int, rescale: bool = True) -> np.ndarray:
+    """
+        Map a previous schedule onto new irrigation days, rescaled such that it uses the whole budget
+        :param seed: irrigation depths (mm) indexed by days after planting
+        :param days: days after planting of the new irrigation days
+        :param rescale: if False, the schedule keeps its own total and is only scaled down to fit the budget
+    """
+    depths = np.zeros(len(days))
+    if len(seed) and len(days):
+        nearest = np.abs(np.asarray(days)[None, :] - seed.index.values[:, None]).argmin(axis=1)
+        np.add.at(depths, nearest, seed.values)
+
+    total = depths.sum()
+    if not rescale:
+        total = max(total, max_irr_season)
+    return depths / total * max_irr_season if total > 0 else depths
+
+
+def result_key(schedule: pd.DataFrame, start_date: datetime, crop: str, soil: str, max_irr_season: int,
+               scenario: int = None, station: str = DEFAULT_STATION) -> str:
+    """
+        Cache key of a single simulation, the depths are already quantized to whole mm by the objective
+    """
+    return make_key(crop=crop, soil=soil, start=start_date.strftime('%Y/%m/%d'),
+                    dates=schedule.Date.dt.strftime('%Y/%m/%d').tolist(),
+                    depths=schedule.Depth.astype(int).tolist(), max_irr_season=int(max_irr_season),
+                    **({'scenario': scenario} if scenario is not None else {}),
+                    **({'station': station} if station != DEFAULT_STATION else {}))
+
+
+def simulate(schedule: pd.DataFrame, start_date: datetime, crop: str, soil: str, max_irr_season: int,
+             horizon: int = MAX_HORIZON, scenario: int = None, station: str = DEFAULT_STATION):
+    """
+        Run AquaCrop for a single irrigation schedule
+        :param horizon: number of days to simulate, the full horizon is used if the crop is not harvested by then
+        :param scenario: year whose weather to simulate with, see `weather_scenarios`; the season's own if not given
+        :param station: weather station of the field
+        :returns: Tuple of yield (tonne/ha), seasonal irrigation (mm) and harvest date
+    """
     irrigate_schedule = IrrigationManagement(irrigation_method=3, Schedule=schedule, MaxIrrSeason=max_irr_season)
+    sim_end_date = start_date + timedelta(days=horizon)
 
     # TODO: define crop stage (emergence, anthesis, max rooting depth, canopy senescence, maturity)
-    model = AquaCropModel(
-        sim_start_time=start_date.strftime('%Y/%m/%d'),
-        sim_end_time=(start_date + timedelta(days=367)).strftime('%Y/%m/%d'),  # sim should run at least for a year
-        weather_df=weather_df,
-        soil=Soil(soil_type=soil),
-        crop=Crop(crop, planting_date=start_date.strftime('%m/%d')),
-        initial_water_content=InitialWaterContent(wc_type='Pct', value=[50]),
-        irrigation_management=irrigate_schedule,
-    )
-
-    model.run_model(till_termination=True)
-    results = model.get_simulation_results()
-
-    yield_ = results['Yield (tonne/ha)'].mean()
-    total_irr = results['Seasonal irrigation (mm)'].mean()
+    with tracer.span('aquacrop.construct'):
+        model = AquaCropModel(
+            sim_start_time=start_date.strftime('%Y/%m/%d'),
+            sim_end_time=sim_end_date.strftime('%Y/%m/%d'),
+            weather_df=(weather_store.window(start_date, sim_end_date, station) if scenario is None else
+                        _scenario_weather(start_date, sim_end_date, scenario, station).copy()),
+            soil=deepcopy(_soil_template(soil)),  # The model mutates its inputs, so never hand out the cached templates
+            crop=deepcopy(_crop_template(crop, start_date.strftime('%m/%d'))),
+            initial_water_content=InitialWaterContent(wc_type='Pct', value=[50]),
+            irrigation_management=irrigate_schedule,
+        )
+
+    with tracer.span('aquacrop.run'):
+        model.run_model(till_termination=True)
+
+    with tracer.span('aquacrop.results'):
+        results = model.get_simulation_results()
+
+    if horizon < MAX_HORIZON and (results.empty or results['Yield (tonne/ha)'].isna().all()):
+        return simulate(schedule, start_date, crop, soil, max_irr_season, scenario=scenario, station=station)
+
+    return (float(results['Yield (tonne/ha)'].mean()), float(results['Seasonal irrigation (mm)'].mean()),
+            str(results['Harvest Date (YYYY/MM/DD)'].values[-1]))
+
+
+def objective(x: np.ndarray, schedule: pd.DataFrame, start_date: datetime, end_date: datetime, crop: str, soil: str,
+              max_irr_season: int, evaluate: bool = False, verbose: bool = False, scenario: int = None,
+              station: str = DEFAULT_STATION):
+    schedule.Depth = x.astype(int)  # Update the initial/start irrigation schedule with the model optimization step
+
+    # Identical schedules are common among the random searches, so only simulate the ones not seen before
+    key = result_key(schedule, start_date, crop, soil, max_irr_season, scenario, station)
+    result = result_cache.get(key)
+    tracer.count('objective.cache_hit' if result is not None else 'objective.simulated')
+    if result is None:
+        t0 = perf_counter()
+        result = simulate(schedule, start_date, crop, soil, max_irr_season,
+                          horizon=simulation_horizon(crop, start_date, end_date), scenario=scenario, station=station)
+        result_cache.put(key, result)
+
+        if warehouse is not None:
+            warehouse.record(crop, soil, start_date.strftime('%Y-%m-%d'), max_irr_season,
+                             (schedule.Date - start_date).dt.days.values, schedule.Depth.values, *result,
+                             seconds=perf_counter() - t0, scenario=scenario, station=station)
+
+    yield_, total_irr, harvest_date = result
 
     if verbose:
         print(f"Total irr: {total_irr}; harvest: {yield_}")
 
     if evaluate:
-        return yield_, total_irr, results['Harvest Date (YYYY/MM/DD)'].values[-1]
+        return yield_, total_irr, harvest_date
     else:
         return -yield_  # Invert in order to maximize the yield
 
 
-def optimize(start_date: datetime, end_date: datetime, crop: str, soil: str,
-             max_irr_season: int, num_searches: int = 100):
-    schedules = []
-    yields = []
-    for i in range(num_searches):
-        irrigation_schedule = create_initial_irr_schedule(start_date, end_date, max_irr_season)
-        schedules.append(irrigation_schedule)
-
-        yld = objective(irrigation_schedule.Depth.values, irrigation_schedule,
-                        start_date, end_date, crop, soil, max_irr_season)
-        yields.append(yld)
+def ensemble_score(results: list, n: int) -> np.ndarray:
+    """
+        Risk-adjusted yield of `n` candidates over the weather scenarios: the mean minus `ENSEMBLE_RISK` standard
+        deviations
+        :param results: evaluations of every candidate in every scenario, grouped by candidate
+    """
+    yields = np.nan_to_num([yield_ for yield_, _, _ in results], nan=0.).reshape(n, -1)
+    return yields.mean(axis=1) - ENSEMBLE_RISK * yields.std(axis=1)
 
-    # Save best schedule
-    solution = schedules[np.argmin(yields)]
-    return solution
 
+def batch_engine(schedule: pd.DataFrame, start_date: datetime, end_date: datetime, crop: str, soil: str,
+                 max_irr_season: int, pool=None, station: str = DEFAULT_STATION):
+    """
+        Vectorized water balance of the schedule's season, calibrated on a few AquaCrop simulations
+        :returns: The engine, or None if the crop is not supported or the engine is not within its tolerance
+    """
+    horizon = simulation_horizon(crop, start_date, end_date)
+    # AquaCrop only applies the depths of schedule dates which fall exactly on a simulated day
+    days = np.where(schedule.Date == schedule.Date.dt.normalize(), (schedule.Date - start_date).dt.days, -1)
+    try:
+        engine = BatchWaterBalance(_crop_template(crop, start_date.strftime('%m/%d')), _soil_template(soil),
+                                   weather_store.station(station).arrays(start_date,
+                                                                         start_date + timedelta(days=horizon)),
+                                   days, max_irr_season)
+    except ValueError:
+        return None
+
+    X = np.random.default_rng(0).dirichlet(np.ones(len(days)), size=CALIBRATION_SAMPLES) * max_irr_season
+    args = [(x, schedule, start_date, end_date, crop, soil, max_irr_season, True, False, None, station) for x in X]
+    results = pool.starmap(objective, args) if pool is not None else [objective(*a) for a in args]
+    engine.calibrate(X, [yield_ for yield_, _, _ in results])
+
+    tracer.count('batch.trusted' if engine.trusted else 'batch.rejected')
+    return engine if engine.trusted else None
+
+
+class LevelSearch:
+    """
+        Search of the schedule with the highest yield which uses `max_irr_season` mm of water, in ask/tell steps: `ask`
+        returns the `objective` arguments of the simulations the next candidates need, and `tell` takes their results
+        in the same order. The caller decides where the simulations run. Candidates which are equal to one simulated
+        before once quantized to whole mm, like the objective does, get the earlier result instead of a simulation.
+    """
 
-def find_best_schedule(start: str, end: str, crop: str, soil: str = 'SandyLoam', field_size: int = 1,
-                       max_irr_liters: int = 500, verbose: bool = False) -> (pd.DataFrame, str):
+    def __init__(self, start_date: datetime, end_date: datetime, crop: str, soil: str, max_irr_season: int,
+                 num_searches: int = 100, method: str = OPTIMIZER, seeds=None, pool=None,
+                 rng: np.random.Generator = None, station: str = DEFAULT_STATION):
+        """
+            :param num_searches: maximum number of candidate schedules, screened ones included
+            :param method: optimizer backend, one of `irr_optimizers.OPTIMIZERS`
+            :param seeds: previous schedules to start from, as irrigation depths (mm) indexed by days after planting
+            :param pool: process pool to calibrate the batch engine on
+            :param rng: random generator of the optimizer, for reproducible searches. Those are not screened by the
+                surrogate, which is shared with other searches, such that they do not depend on them.
+            :param station: weather station of the field
+        """
+        self.start_date, self.end_date = start_date, end_date
+        self.crop, self.soil, self.station = crop, soil, station
+        self.max_irr_season = max_irr_season
+        self.num_searches = num_searches
+        rng = rng if rng is not None else make_rng()
+        self.schedule = create_initial_irr_schedule(start_date, end_date, max_irr_season, rng=rng)
+        self.days = (self.schedule.Date - start_date).dt.days.values
+        self.optimizer = make_optimizer(method, len(self.schedule), max_irr_season,
+                                        seeds=[seed_depths(seed, self.days, max_irr_season) for seed in seeds]
+                                        if seeds else None, rng=rng)
+
+        # Scenario yields are neither modelled by the batch engine nor learned by the surrogate
+        self.scenarios = weather_scenarios(start_date, station=station) if ENSEMBLE_SIZE else ()
+        self.engine = None
+        if BATCH_ENABLED and not self.scenarios:
+            self.engine = batch_engine(self.schedule, start_date, end_date, crop, soil, max_irr_season, pool, station)
+        self.surrogate = get_surrogate(crop, soil, station) if SURROGATE_ENABLED and not self.scenarios else None
+        self.screen = rng is None
+        self.duplicates = 0
+        self._seen = {}  # Objective value by quantized candidate
+        self._asked = None
+
+    @property
+    def done(self) -> bool:
+        return self.optimizer.evaluations >= self.num_searches or self.optimizer.converged
+
+    def ask(self) -> list:
+        """ :returns: `objective` arguments of the next simulations, empty once the search is done """
+        while not self.done:
+            xs = self.optimizer.ask()[:self.num_searches - self.optimizer.evaluations]
+            if self.engine is not None:
+                # The whole population in a single call, the caller evaluates the best schedule with AquaCrop
+                self.optimizer.tell(xs, -self.engine.evaluate(xs))
+                tracer.count('batch.evaluated', len(xs))
+                continue
+
+            # Only simulate the candidates the surrogate can not rule out, the others get their predicted yield
+            ys = np.zeros(len(xs))
+            keep = np.ones(len(xs), dtype=bool)
+            features = None
+            if self.surrogate is not None:
+                features = [schedule_features(self.days, x.astype(int), self.start_date, self.station) for x in xs]
+                if self.screen:
+                    keep, predicted = self.surrogate.screen(features, -self.optimizer.best_f)
+                    if predicted is not None:
+                        ys[~keep] = -predicted[~keep]
+
+            # Only the first of equal candidates is simulated
+            keys = [x.astype(int).tobytes() for x in xs]
+            unique = {}
+            for i in np.flatnonzero(keep):
+                if keys[i] not in self._seen:
+                    unique.setdefault(keys[i], i)
+            self.duplicates += int(keep.sum()) - len(unique)
+            tracer.count('search.duplicates', int(keep.sum()) - len(unique))
+
+            self._asked = (xs, ys, keep, keys, features, list(unique.values()))
+            if not unique:
+                self.tell([])
+                continue
+
+            args = (self.schedule, self.start_date, self.end_date, self.crop, self.soil, self.max_irr_season, True)
+            if self.scenarios:
+                return [(xs[i], *args, False, year, self.station) for i in unique.values() for year in self.scenarios]
+            return [(xs[i], *args, False, None, self.station) for i in unique.values()]
+        return []
+
+    def tell(self, results: list):
+        """ :param results: `objective` evaluations of the arguments returned by the last `ask` """
+        xs, ys, keep, keys, features, simulated = self._asked
+        if self.scenarios:
+            fs = -ensemble_score(results, len(simulated)) if simulated else []
+        else:
+            fs = [-yield_ for yield_, _, _ in results]
+
+        for i, f in zip(simulated, fs):
+            self._seen[keys[i]] = f
+            if self.surrogate is not None:
+                self.surrogate.observe(features[i], -f)
+
+        for i in np.flatnonzero(keep):
+            ys[i] = self._seen[keys[i]]
+        self.optimizer.tell(xs, np.nan_to_num(ys, nan=0.))  # No yield at all when the crop never got harvested
+        self._asked = None
+
+    @property
+    def evaluations(self) -> int:
+        return self.optimizer.evaluations
+
+    def solution(self) -> pd.DataFrame:
+        """ The best schedule found so far """
+        solution = self.schedule.copy()
+        solution.Depth = self.optimizer.best_x.astype(int)
+        return solution
+
+
+@tracer.traced('optimize')
+def optimize(start_date: datetime, end_date: datetime, crop: str, soil: str,
+             max_irr_season: int, num_searches: int = 100, method: str = OPTIMIZER, seeds=None, pool=None,
+             rng: np.random.Generator = None, station: str = DEFAULT_STATION):
     """
-        Find best watering schedule for a crop over a given season
+        Search the schedule with the highest yield which uses `max_irr_season` mm of water, see `LevelSearch`
 
-        :param start: start date of planting (yyyy/mm/dd)
-        :param end: approx. end date of simulation (yyyy/mm/dd)
-        :param crop: crop type growing
-        :param field_size: size of field in square meters
-        :param soil: predefined soil type
-        :param max_irr_liters: maximum watering available over season in liters
-        :param verbose: draw plots if true
-        :returns: Tuple consisting of
-            DataFrame containing scheduled watering dates and watering amounts in liters,
-            Harvest date (str)
+        :param pool: process pool to evaluate each batch of schedules on, evaluated one by one if not given
     """
-    t0 = time()
-    start_date = dateutil.parser.parse(start)
-    end_date = dateutil.parser.parse(end)
+    search = LevelSearch(start_date, end_date, crop, soil, max_irr_season, num_searches, method, seeds, pool, rng,
+                         station)
+    args = search.ask()
+    while args:
+        search.tell(pool.starmap(objective, args) if pool is not None else [objective(*a) for a in args])
+        args = search.ask()
+    return search.solution()
 
-    max_irr_mm = max_irr_liters / field_size
-    max_irrs = np.linspace(0, min(500, max_irr_mm), max(8, mp.cpu_count()), dtype=int)
 
-    # Run objective function optimization for several max irrigation usages
-    with mp.Pool(mp.cpu_count()) as pool:
-        results = pool.starmap(optimize,
-                               [(start_date, end_date, crop, soil, max_irr_season) for max_irr_season in max_irrs])
+def budget_levels(max_irr_mm: float, n: int = BUDGET_LEVELS) -> np.ndarray:
+    """ `n` seasonal irrigation budgets (mm) to optimize, from no irrigation up to all available water """
+    return np.unique(np.linspace(0, min(500, max_irr_mm), n, dtype=int))
 
-    print(f"Done. Time taken: {time() - t0}")
 
-    yld_list = []
-    total_irr_list = []
-    harvest_list = []
-    for schedule, max_irr_season in zip(results, max_irrs):
-        yld, tirr, harvest_date = objective(schedule.Depth.values, schedule, start_date, end_date, crop, soil,
-                                            max_irr_season, evaluate=True, verbose=True)
-        yld_list.append(yld)
-        total_irr_list.append(max_irr_season)
-        harvest_list.append(harvest_date)
+def optimize_level(start_date: datetime, end_date: datetime, crop: str, soil: str, max_irr_season: int,
+                   num_searches: int = 100, method: str = OPTIMIZER, seeds=None, station: str = DEFAULT_STATION):
+    """
+        Optimize a single budget level and evaluate its best schedule in the same process, where it is still cached
+        :returns: Tuple of the best schedule and its yield, seasonal irrigation and harvest date. With weather
+            scenarios the yield is the risk-adjusted yield over them, the others are of the season's own weather.
+    """
+    solution = optimize(start_date, end_date, crop, soil, max_irr_season, num_searches, method, seeds,
+                        station=station)
+    return evaluate_solution(solution, start_date, end_date, crop, soil, max_irr_season, station)
+
+
+def evaluate_solution(solution: pd.DataFrame, start_date: datetime, end_date: datetime, crop: str, soil: str,
+                      max_irr_season: int, station: str = DEFAULT_STATION):
+    """
+        The best schedule of a budget level with its evaluation, see `optimize_level`. With weather scenarios the
+        yield the search scored it by is reported in `solution.attrs['ensemble']` as well, next to the mean and
+        standard deviation of its yield over the scenarios and its yield in the season's own weather.
+    """
+    yield_, total_irr, harvest_date = objective(solution.Depth.values, solution, start_date, end_date, crop, soil,
+                                                max_irr_season, evaluate=True, verbose=True, station=station)
+    scenarios = weather_scenarios(start_date, station=station) if ENSEMBLE_SIZE else ()
+    if scenarios:
+        results = [objective(solution.Depth.values, solution, start_date, end_date, crop, soil, max_irr_season, True,
+                             False, year, station) for year in scenarios]
+        yields = np.nan_to_num([yield_ for yield_, _, _ in results], nan=0.)
+        score = float(ensemble_score(results, 1)[0])
+        solution.attrs['ensemble'] = {'years': list(scenarios), 'score': score, 'mean_yield': float(yields.mean()),
+                                      'std_yield': float(yields.std()),
+                                      'season_yield': None if pd.isna(yield_) else float(yield_)}
+        yield_ = score
+    return solution, (yield_, total_irr, harvest_date)
+
+
+def best_result(results: list, selection: str = SELECTION) -> tuple:
+    """
+        The optimized budget level picked by `selection`: `efficiency` has the least water per squared yield, `yield`
+        has the highest yield and the least water of those, and `knee` is closest to the highest yield with the least
+        water, with both scaled to their range over the results
+        :param results: best schedule and its evaluation per budget level, as returned by `optimize_level`
+    """
+    total_irr = np.array([evaluation[1] for _, evaluation in results], dtype=float)
+    yld = np.nan_to_num([evaluation[0] for _, evaluation in results], nan=0.)
+    if selection == 'efficiency':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score_list = np.nan_to_num(total_irr / (yld ** 2), nan=np.inf)
+        # argmin but score cannot be 0
+        return results[int(np.where(score_list != 0, score_list, score_list.max() + 1).argmin())]
+    if selection == 'yield':
+        return results[int(np.lexsort((total_irr, -yld))[0])]
+    if selection == 'knee':
+        def scaled(values):
+            return (values - values.min()) / (np.ptp(values) or 1.)
+        return results[int(np.argmin(np.hypot(1 - scaled(yld), scaled(total_irr))))]
+    raise ValueError(f"Unknown selection '{selection}', choose from {', '.join(SELECTIONS)}")
+
+
+def select_best(results: list, field_size: int, verbose: bool = False,
+                selection: str = SELECTION) -> (pd.DataFrame, str):
+    """
+        Pick the best schedule out of the optimized budget levels, see `best_result`
+        :param results: best schedule and its evaluation per budget level, as returned by `optimize_level`
+        :returns: Tuple of the watering dates and amounts in liters over the field, and the harvest date
+    """
+    results = sorted(results, key=lambda result: result[1][1])
 
     if verbose:
+        from matplotlib import pyplot as plt  # Only needed for plotting, so keep it out of every worker's startup
+
+        yld_list = np.nan_to_num([evaluation[0] for _, evaluation in results], nan=0.)
+        total_irr_list = [evaluation[1] for _, evaluation in results]
         fig, ax = plt.subplots(1, 1, figsize=(13, 8))
 
         # plot results
@@ -137,10 +496,8 @@ def find_best_schedule(start: str, end: str, crop: str, soil: str = 'SandyLoam',
 
         plt.show()
 
-    score_list = np.array(total_irr_list) / (np.array(yld_list) ** 2)
-    # argmin but score cannot be 0
-    i = np.unravel_index(np.where(score_list != 0, score_list, score_list.max() + 1).argmin(), score_list.shape)[0]
-    opt_solution = results[i].copy()
+    solution, (_, _, harvest_date) = best_result(results, selection)
+    opt_solution = solution.copy()
 
     # Convert raining in mm back to liters over the whole field
     opt_solution['Liters'] = opt_solution.Depth * field_size
@@ -148,7 +505,274 @@ def find_best_schedule(start: str, end: str, crop: str, soil: str = 'SandyLoam',
     opt_solution.index = opt_solution.index.strftime('%Y/%m/%d')
 
     # Only return the scheduled days where watering is required
-    return opt_solution[opt_solution.Liters > 0], harvest_list[i]
+    return opt_solution[opt_solution.Liters > 0], harvest_date
+
+
+def refine_levels(results: dict, max_new: int, active=()) -> list:
+    """
+        New budget levels halfway between the neighbouring levels whose yields differ the most
+        :param results: `optimize_level` results by budget level
+        :param max_new: most levels to return
+        :param active: levels which are still being optimized, the gaps around them are not refined again
+    """
+    budgets = np.array(sorted(results))
+    yields = np.nan_to_num([results[budget][1][0] for budget in budgets], nan=0.)
+    gaps, change = np.diff(budgets), np.abs(np.diff(yields))
+    active = np.asarray(list(active), dtype=float)
+    busy = ((budgets[:-1, None] < active) & (active < budgets[1:, None])).any(axis=1)
+
+    steep = np.where((gaps >= 2 * SWEEP_MIN_GAP) & (change >= SWEEP_MIN_CHANGE) & ~busy)[0]
+    steep = steep[np.argsort(-change[steep], kind='stable')][:max(max_new, 0)]
+    return [int(budgets[i] + gaps[i] // 2) for i in steep]
+
+
+@tracer.traced('budget_sweep')
+def budget_sweep(start_date: datetime, end_date: datetime, crop: str, soil: str, max_irr_mm: float,
+                 num_searches: int = 100, seeds=None, pool=None, max_evaluations: int = SWEEP_MAX_EVALUATIONS,
+                 progress=None, cancel=None, seed: int = None, station: str = DEFAULT_STATION) -> ParetoArchive:
+    """
+        Optimize budget levels from no irrigation up to `max_irr_mm`, starting from a coarse grid which is only refined
+        where the yield changes steeply with the water, until neighbouring levels are close or similar enough or
+        `max_evaluations` candidate schedules are spent. At most one level per pool worker is searched at a time.
+
+        The searches of all levels run in this process and hand every single simulation to the pool through one task
+        queue, such that the workers stay busy with the candidates of any level instead of idling behind the slowest
+        level. Whenever a level finishes, a refined level can take its place.
+
+        :param num_searches: candidate schedules per level
+        :param progress: called with the front and the number of evaluated candidates whenever a level finishes
+        :param cancel: event which stops the sweep, no further simulations are started and `Cancelled` is raised
+        :param seed: seed of the optimizers, every level derives its own generator from it and its budget, such that
+            the result does not depend on the order in which the simulations finish. Seeded sweeps refine in rounds,
+            once all running levels finished, and are not screened by the shared surrogate, see `LevelSearch`.
+        :returns: Pareto front of seasonal irrigation (mm) against yield, the items are `optimize_level` results
+    """
+    pool = pool or get_pool()
+    scheduler = TaskScheduler(pool)
+    max_levels = max(2, max_evaluations // num_searches)
+    front = ParetoArchive(names=('irrigation', 'yield'), maximize=(False, True))
+    results, searches, batches = {}, {}, {}
+    evaluations = 0
+
+    def step(level: int):
+        """ Queue the simulations of the next candidates of a level, or the evaluation of its best schedule """
+        search = searches[level]
+        args = search.ask()
+        for i, arg in enumerate(args):
+            scheduler.submit((level, i), objective, *arg)
+        batches[level] = [None] * len(args)
+        if not args:
+            scheduler.submit((level, None), evaluate_solution, search.solution(), start_date, end_date, crop, soil,
+                             level, station)
+
+    def start(levels):
+        for level in levels:
+            rng = np.random.default_rng([seed, level]) if seed is not None else None
+            searches[level] = LevelSearch(start_date, end_date, crop, soil, level, num_searches, OPTIMIZER, seeds,
+                                          pool, rng, station)
+            step(level)
+
+    start(int(level) for level in budget_levels(max_irr_mm, min(SWEEP_LEVELS, max_levels)))
+    for (level, i), result in scheduler.results(cancel):
+        if i is not None:
+            batch = batches[level]
+            batch[i] = result
+            if all(r is not None for r in batch):
+                searches[level].tell(batch)
+                step(level)
+            continue
+
+        evaluations += searches.pop(level).evaluations
+        results[level] = result
+        yield_, total_irr, _ = result[1]
+        front.add((total_irr, yield_), result)
+        tracer.count('budget_sweep.levels')
+        if progress is not None:
+            progress(front, evaluations)
+
+        if seed is None or not searches:
+            start(refine_levels(results, min(max_levels - len(results) - len(searches), pool.size - len(searches)),
+                                active=searches))
+
+    if cancel is not None and cancel.is_set():
+        raise Cancelled(f"Budget sweep cancelled after {len(results)} levels")
+    return front
+
+
+def schedule_events(depths: np.ndarray) -> int:
+    """ Number of days on which a schedule irrigates, once quantized to whole mm """
+    return int(np.count_nonzero(np.asarray(depths).astype(int)))
+
+
+def pareto_front(results: list) -> ParetoArchive:
+    """ Front of yield, seasonal irrigation and events of `optimize_level` results, see `pareto_search` """
+    front = ParetoArchive(names=('yield', 'irrigation', 'events'), maximize=(True, False, False))
+    front.update(((yield_, total_irr, schedule_events(solution.Depth.values)), (solution, (yield_, total_irr, harvest)))
+                 for solution, (yield_, total_irr, harvest) in results)
+    return front
+
+
+@tracer.traced('pareto_search')
+def pareto_search(start_date: datetime, end_date: datetime, crop: str, soil: str, max_irr_mm: float,
+                  max_evaluations: int = PARETO_MAX_EVALUATIONS, seeds=None, pool=None, progress=None, cancel=None,
+                  seed: int = None, station: str = DEFAULT_STATION) -> ParetoArchive:
+    """
+        Search the trade-off between yield, seasonal irrigation and the number of irrigation events of schedules using
+        at most `max_irr_mm` mm with `NSGA2`, instead of one search per budget level. Every generation is simulated
+        through one task queue, candidates equal to one simulated before once quantized to whole mm are not simulated
+        again.
+
+        :param max_evaluations: candidate schedules to evaluate, duplicates included
+        :param seeds: previous schedules to start from, as irrigation depths (mm) indexed by days after planting
+        :param progress: called with the front and the number of evaluated candidates after every generation
+        :param cancel: event which stops the search, no further simulations are started and `Cancelled` is raised
+        :param seed: seed of the optimizer
+        :returns: Pareto front of (yield, seasonal irrigation, events), the items are `optimize_level` results, such
+            that `select_best` picks from the front like from budget levels
+    """
+    pool = pool or get_pool()
+    scheduler = TaskScheduler(pool)
+    max_irr_season = int(min(500, max_irr_mm))
+    rng = make_rng(seed)
+    schedule = create_initial_irr_schedule(start_date, end_date, max_irr_season, rng=rng)
+    days = (schedule.Date - start_date).dt.days.values
+    optimizer = NSGA2(len(schedule), max_irr_season, PARETO_POPSIZE, rng=rng,
+                      seeds=[seed_depths(s, days, max_irr_season, rescale=False) for s in seeds] if seeds else None)
+    front = pareto_front([])
+    seen = {}  # Evaluation by quantized candidate
+
+    while optimizer.evaluations < max_evaluations:
+        xs = optimizer.ask()[:max_evaluations - optimizer.evaluations]
+        keys = [x.astype(int).tobytes() for x in xs]
+        unique = {key: x for key, x in zip(keys, xs) if key not in seen}
+        tracer.count('search.duplicates', len(xs) - len(unique))
+        for key, x in unique.items():
+            scheduler.submit(key, objective, x, schedule, start_date, end_date, crop, soil, max_irr_season, True, False,
+                             None, station)
+        seen.update(scheduler.results(cancel))
+        if cancel is not None and cancel.is_set():
+            raise Cancelled(f"Pareto search cancelled after {optimizer.evaluations} candidates")
+
+        F = []
+        for key, x in zip(keys, xs):
+            yield_, total_irr, harvest_date = seen[key]
+            events = schedule_events(x)
+            if key in unique:
+                solution = schedule.copy()
+                solution.Depth = x.astype(int)
+                front.add((yield_, total_irr, events), (solution, seen[key]))
+            F.append((-np.nan_to_num(yield_, nan=0.), total_irr, events))  # No yield when never harvested
+        optimizer.tell(xs, F)
+
+        tracer.count('pareto_search.generations')
+        if progress is not None:
+            progress(front, optimizer.evaluations)
+    return front
+
+
+@tracer.traced('find_best_schedule')
+def find_best_schedule(start: str, end: str, crop: str, soil: str = 'SandyLoam', field_size: int = 1,
+                       max_irr_liters: int = 500, verbose: bool = False, seeds=None, pool=None, progress=None,
+                       cancel=None, seed: int = None, station: str = DEFAULT_STATION,
+                       selection: str = SELECTION) -> (pd.DataFrame, str):
+    """
+        Find best watering schedule for a crop over a given season
+
+        :param start: start date of planting (yyyy/mm/dd)
+        :param end: approx. end date of simulation (yyyy/mm/dd)
+        :param crop: crop type growing
+        :param field_size: size of field in square meters
+        :param soil: predefined soil type
+        :param max_irr_liters: maximum watering available over season in liters
+        :param verbose: draw plots if true
+        :param seeds: previous schedules to refine instead of searching from scratch, as irrigation depths (mm)
+            indexed by days after planting
+        :param pool: process pool to run the optimizations on, defaults to the shared warm pool
+        :param progress: called with the Pareto front so far and the number of evaluated schedules, see `budget_sweep`
+            and `pareto_search`
+        :param cancel: event which stops the optimization with `Cancelled`
+        :param seed: seed of the optimizers for reproducible schedules, see `budget_sweep`
+        :param station: weather station of the field
+        :param selection: how the schedule is picked from the front, see `best_result`
+        :returns: Tuple consisting of
+            DataFrame containing scheduled watering dates and watering amounts in liters,
+            Harvest date (str)
+    """
+    t0 = time()
+    start_date = dateutil.parser.parse(start)
+    end_date = dateutil.parser.parse(end)
+
+    # Common requests are answered from the precomputed budget levels of the nearest planting date
+    if lookup_table is not None and station == DEFAULT_STATION:
+        results = lookup_table.lookup(crop, soil, start_date, end_date, max_irr_liters / field_size,
+                                      lookup_year(start_date))
+        if results:
+            if progress is not None:
+                progress(pareto_front(results), 0)
+            return select_best(results, field_size, verbose, selection)
+
+    if MULTI_OBJECTIVE:
+        front = pareto_search(start_date, end_date, crop, soil, max_irr_liters / field_size,
+                              PARETO_MAX_EVALUATIONS // 3 if seeds else PARETO_MAX_EVALUATIONS, seeds=seeds, pool=pool,
+                              progress=progress, cancel=cancel, seed=seed, station=station)
+        print(f"Done. Time taken: {time() - t0}")
+        return select_best(front.items, field_size, verbose, selection)
+
+    # Run objective function optimization for several max irrigation usages
+    front = budget_sweep(start_date, end_date, crop, soil, max_irr_liters / field_size,
+                         num_searches=REFINE_SEARCHES if seeds else 100, seeds=seeds, pool=pool,
+                         progress=progress, cancel=cancel, seed=seed, station=station)
+
+    print(f"Done. Time taken: {time() - t0}")
+
+    return select_best(front.items, field_size, verbose, selection)
+
+
+def _optimize_task(task: tuple):
+    """ Unpack an `optimize_level` task for imap_unordered and return it with its result """
+    return task, optimize_level(*task)
+
+
+def find_best_schedules(batch: list, pool=None, cancel=None):
+    """
+        Find the best watering schedules of many fields at once. Fields are grouped by crop, soil and season, every
+        distinct budget level of a group is optimized only once, and all levels of all fields share one task queue.
+
+        :param batch: fields as dicts with the arguments of `find_best_schedule`: start, end, crop and optionally
+            soil, field_size, max_irr_liters, station and selection
+        :param pool: process pool to run the optimizations on, defaults to the shared warm pool
+        :param cancel: event which stops the batch, no further levels are started and `Cancelled` is raised
+        :returns: Generator of (index in batch, (schedule, harvest date), Pareto front of its levels) tuples, in the
+            order the fields finish, see `pareto_front`
+    """
+    fields = []
+    for field in batch:
+        problem = (dateutil.parser.parse(field['start']), dateutil.parser.parse(field['end']), field['crop'],
+                   field.get('soil', 'SandyLoam'))
+        field_size = field.get('field_size', 1)
+        station = field.get('station', DEFAULT_STATION)
+        fields.append(([(*problem, int(level), 100, OPTIMIZER, None, station)
+                        for level in budget_levels(field.get('max_irr_liters', 500) / field_size)], field_size))
+
+    pending = {i: set(field_tasks) for i, (field_tasks, _) in enumerate(fields)}
+    scheduler = TaskScheduler(pool or get_pool())
+    for task in sorted(set.union(*pending.values())) if pending else []:
+        scheduler.submit(task, optimize_level, *task)
+
+    done = {}
+    for task, result in scheduler.results(cancel):
+        done[task] = result
+        for i in [i for i, waiting in pending.items() if task in waiting]:
+            pending[i].discard(task)
+            if not pending[i]:
+                del pending[i]
+                field_tasks, field_size = fields[i]
+                results = [done[t] for t in field_tasks]
+                yield i, select_best(results, field_size, selection=batch[i].get('selection', SELECTION)), \
+                    pareto_front(results)
+
+    if cancel is not None and cancel.is_set():
+        raise Cancelled(f"Batch cancelled with {len(pending)} of {len(fields)} fields left")
 
 
 if __name__ == "__main__":
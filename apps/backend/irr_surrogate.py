@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from irr_optimizers import GaussianProcess
+from weather_store import DEFAULT_STATION, weather_store
+
+SURROGATE_ENABLED = os.getenv('IRR_SURROGATE', '1') == '1'
+SURROGATE_DIR = os.getenv('IRR_SURROGATE_DIR')
+MAX_ERROR = float(os.getenv('IRR_SURROGATE_MAX_ERROR', .5))  # mean absolute yield error (tonne/ha) to be trusted
+BINS = 12
+BIN_DAYS = 15
+
+
+@lru_cache(maxsize=256)
+def weather_features(start_date: datetime, station: str = DEFAULT_STATION) -> np.ndarray:
+    """ Rainfall and reference ET (mm) summed over the same windows after planting as the irrigation features """
+    arrays = weather_store.station(station).arrays(start_date, start_date + timedelta(days=BINS * BIN_DAYS - 1))
+    bins = np.minimum((arrays['Day'] - arrays['Day'][:1].sum()) // BIN_DAYS, BINS - 1).astype(int)
+    rain = np.bincount(bins, weights=arrays['Precipitation'], minlength=BINS)
+    eto = np.bincount(bins, weights=arrays['ReferenceET'], minlength=BINS)
+    return np.concatenate([rain, eto])
+
+
+def schedule_features(days: np.ndarray, depths: np.ndarray, start_date: datetime,
+                      station: str = DEFAULT_STATION) -> np.ndarray:
+    """
+        Fixed-length description of a schedule which is comparable across requests: the irrigation (mm) per window of
+        days after planting, the total irrigation, the season of planting and the weather in every window
+        :param days: days after planting of every irrigation
+        :param depths: irrigation depths (mm)
+    """
+    bins = np.minimum(np.asarray(days) // BIN_DAYS, BINS - 1).astype(int)
+    irrigation = np.bincount(bins, weights=np.asarray(depths, dtype=float), minlength=BINS)
+    doy = 2 * np.pi * start_date.timetuple().tm_yday / 365
+    return np.concatenate([irrigation, [irrigation.sum(), np.sin(doy), np.cos(doy)],
+                           weather_features(start_date, station)])
+
+
+class Surrogate:
+    """
+        Gaussian process model of the yield, trained incrementally from the simulations of a single crop and soil.
+        It only discards candidates once its own recent prediction error is small enough.
+    """
+
+    def __init__(self, path: str = None, min_samples: int = 30, max_samples: int = 500, refit_every: int = 10,
+                 max_error: float = MAX_ERROR, kappa: float = 2.):
+        """
+            :param path: file to persist the observations to, shared by all processes
+            :param min_samples: number of observations before the model is used
+            :param max_samples: most recent observations to train on
+            :param refit_every: number of new observations after which the model is refitted
+            :param max_error: mean absolute error (tonne/ha) of recent predictions above which the model is not used
+            :param kappa: number of standard deviations a candidate has to be below the incumbent to be discarded
+        """
+        self.path = Path(path) if path else None
+        self.min_samples = min_samples
+        self.refit_every = refit_every
+        self.max_error = max_error
+        self.kappa = kappa
+        self.X = deque(maxlen=max_samples)
+        self.y = deque(maxlen=max_samples)
+        self.errors = deque(maxlen=100)
+        self.screened = 0
+        self.discarded = 0
+        self._model = None
+        self._scale = None
+        self._unfitted = 0
+        self._lock = threading.Lock()
+
+        if self.path is not None and self.path.exists():
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.X.append(np.array(row['x']))
+                    self.y.append(row['y'])
+            self._unfitted = len(self.y)
+
+    def _fit(self):
+        X = np.array(self.X)
+        self._scale = (X.mean(0), X.std(0) + 1e-9)
+        self._model = GaussianProcess(noise=1e-2).fit((X - self._scale[0]) / self._scale[1], np.array(self.y))
+        self._unfitted = 0
+
+    def predict(self, X: np.ndarray) -> (np.ndarray, np.ndarray):
+        """ :returns: predicted yield and its standard deviation """
+        with self._lock:
+            if len(self.y) < self.min_samples:
+                return None, None
+            if self._model is None or self._unfitted >= self.refit_every:
+                self._fit()
+            return self._model.predict((np.asarray(X) - self._scale[0]) / self._scale[1])
+
+    def observe(self, x: np.ndarray, y: float):
+        """ Add a simulated yield, after scoring the prediction the model would have made for it """
+        if not np.isfinite(y):
+            return
+
+        mean, _ = self.predict([x])
+        with self._lock:
+            if mean is not None:
+                self.errors.append(abs(mean[0] - y))
+            self.X.append(np.asarray(x, dtype=float))
+            self.y.append(float(y))
+            self._unfitted += 1
+
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps({'x': np.asarray(x).tolist(), 'y': float(y)}) + '\n')
+
+    @property
+    def error(self) -> float:
+        return float(np.mean(self.errors)) if self.errors else np.inf
+
+    @property
+    def trusted(self) -> bool:
+        return len(self.y) >= self.min_samples and len(self.errors) >= 10 and self.error <= self.max_error
+
+    def screen(self, X: np.ndarray, incumbent: float) -> (np.ndarray, np.ndarray):
+        """
+            Select the candidates worth simulating: all of them while the model is not trusted, otherwise only those
+            which could still beat the incumbent yield within `kappa` standard deviations
+            :returns: Tuple of the boolean mask of candidates to simulate and the predicted yields (None if not trusted)
+        """
+        keep = np.ones(len(X), dtype=bool)
+        if not self.trusted or not np.isfinite(incumbent) or not len(X):
+            return keep, None
+
+        mean, std = self.predict(X)
+        keep = mean + self.kappa * std >= incumbent
+        keep[np.argmax(mean + self.kappa * std)] = True  # Always simulate the most promising candidate
+
+        self.screened += len(X)
+        self.discarded += int((~keep).sum())
+        return keep, mean
+
+    def stats(self) -> dict:
+        return {
+            'samples': len(self.y),
+            'error': self.error if self.errors else None,
+            'trusted': self.trusted,
+            'screened': self.screened,
+            'discarded': self.discarded,
+        }
+
+
+_surrogates = {}
+
+
+def get_surrogate(crop: str, soil: str, station: str = DEFAULT_STATION) -> Surrogate:
+    """ Surrogate of a crop, soil and weather station, shared within the process """
+    if (crop, soil, station) not in _surrogates:
+        name = f"{crop}-{soil}" if station == DEFAULT_STATION else f"{crop}-{soil}-{station}"
+        path = Path(SURROGATE_DIR) / f"{name}.jsonl" if SURROGATE_DIR else None
+        _surrogates[crop, soil, station] = Surrogate(path)
+    return _surrogates[crop, soil, station]
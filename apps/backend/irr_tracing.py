@@ -0,0 +1,213 @@
+import functools
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import perf_counter, sleep, time
+
+TRACING_ENABLED = os.getenv('IRR_TRACING', '0') == '1'
+PROFILE_DIR = os.getenv('IRR_PROFILE_DIR')
+PROFILE_INTERVAL = float(os.getenv('IRR_PROFILE_INTERVAL', .005))  # seconds between stack samples
+
+
+class _NoopSpan:
+    """Span handed out while tracing is disabled, such that instrumented code pays next to nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, perf_counter() - self.t0)
+        return False
+
+
+class Tracer:
+    """
+        Named spans (count, total and max duration) and counters of a single process. Pool workers drain their
+        state after every task, such that the parent process can merge it into its own.
+    """
+
+    def __init__(self, enabled: bool = TRACING_ENABLED):
+        self.enabled = enabled
+        self._spans = defaultdict(lambda: [0, 0., 0.])
+        self._counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        """ Context manager timing the enclosed block under `name` """
+        return _Span(self, name) if self.enabled else NOOP_SPAN
+
+    def traced(self, name: str):
+        """ Decorator timing every call of the function under `name` """
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, duration: float, count: int = 1):
+        with self._lock:
+            span = self._spans[name]
+            span[0] += count
+            span[1] += duration
+            span[2] = max(span[2], duration)
+
+    def count(self, name: str, value: float = 1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += value
+
+    def _snapshot(self) -> dict:
+        return {
+            'spans': {name: {'count': c, 'seconds': s, 'max_seconds': m} for name, (c, s, m) in self._spans.items()},
+            'counters': dict(self._counters),
+        }
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return self._snapshot()
+
+    def drain(self) -> dict:
+        """ Snapshot and reset """
+        with self._lock:
+            snapshot = self._snapshot()
+            self._spans.clear()
+            self._counters.clear()
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for name, stats in snapshot['spans'].items():
+                span = self._spans[name]
+                span[0] += stats['count']
+                span[1] += stats['seconds']
+                span[2] = max(span[2], stats['max_seconds'])
+            for name, value in snapshot['counters'].items():
+                self._counters[name] += value
+
+    def to_prometheus(self) -> str:
+        """ Prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = ['# TYPE irr_span_seconds summary']
+        for name, stats in sorted(snapshot['spans'].items()):
+            lines.append(f'irr_span_seconds_count{{span="{name}"}} {stats["count"]}')
+            lines.append(f'irr_span_seconds_sum{{span="{name}"}} {stats["seconds"]}')
+        lines.append('# TYPE irr_span_seconds_max gauge')
+        for name, stats in sorted(snapshot['spans'].items()):
+            lines.append(f'irr_span_seconds_max{{span="{name}"}} {stats["max_seconds"]}')
+        lines.append('# TYPE irr_events_total counter')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'irr_events_total{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+tracer = Tracer()
+
+
+_active = threading.local()
+
+
+class SamplingProfiler:
+    """
+        Samples the stack of a single thread at a fixed interval and writes the counts in the collapsed stack
+        format (`frame;frame;frame count` per line), which flame graph tools read directly. Stacks sampled in pool
+        workers on behalf of the thread are merged into its innermost active profiler, see `merge_trace`.
+    """
+
+    def __init__(self, name: str, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.name = name
+        self.directory = Path(directory) if directory else None
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._outer = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            sleep(self.interval)
+
+    def merge(self, stacks: dict):
+        self.stacks.update(stacks)
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._outer, _active.profiler = getattr(_active, 'profiler', None), self
+        self._sampler = threading.Thread(target=self._sample, name=f'irr-profile-{self.name}', daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+        _active.profiler = self._outer
+        if self.directory is None:
+            return False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in self.name)
+        with open(self.directory / f"{time():.3f}-{safe_name}.folded", 'w') as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write(f"{stack} {count}\n")
+        return False
+
+
+def profile(name: str):
+    """ Profile the current thread until the block exits, if profiling is enabled through IRR_PROFILE_DIR """
+    return SamplingProfiler(name, PROFILE_DIR) if PROFILE_DIR else NOOP_SPAN
+
+
+def traces_workers() -> bool:
+    """ Whether pool tasks should be run through `traced_call` """
+    return tracer.enabled or bool(PROFILE_DIR)
+
+
+def traced_call(fn, args: tuple):
+    """
+        Run a pool task and return its result together with the trace data the worker gathered for it, including
+        the stacks sampled while it ran if profiling is enabled
+    """
+    if not PROFILE_DIR:
+        return fn(*args), tracer.drain()
+
+    with SamplingProfiler(getattr(fn, '__name__', 'task'), directory=None) as profiler:
+        result = fn(*args)
+    return result, {**tracer.drain(), 'stacks': dict(profiler.stacks)}
+
+
+def merge_trace(trace: dict):
+    """ Merge the trace data of a pool task into this process, and its stacks into the active profiler of the thread """
+    tracer.merge(trace)
+    profiler = getattr(_active, 'profiler', None)
+    if profiler is not None and trace.get('stacks'):
+        profiler.merge(trace['stacks'])
@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+import uuid
+from multiprocessing import util
+from pathlib import Path
+from time import monotonic, time
+
+import numpy as np
+
+from irr_tracing import tracer
+from weather_store import DEFAULT_STATION
+
+# pyarrow is only imported once something is written or scanned, nodes without a warehouse never need it
+WAREHOUSE_DIR = os.getenv('IRR_WAREHOUSE_DIR')
+FLUSH_ROWS = int(os.getenv('IRR_WAREHOUSE_FLUSH_ROWS', 10000))
+FLUSH_SECONDS = float(os.getenv('IRR_WAREHOUSE_FLUSH_SECONDS', 30))
+PARTITIONS = ['crop', 'start']
+
+
+def _schema(partitions: bool = False):
+    """ Columns of the Parquet files, followed by the partition columns if asked for """
+    import pyarrow as pa
+
+    return pa.schema([
+        ('soil', pa.string()),
+        ('station', pa.string()),  # Missing in files written before stations were recorded, which are the default
+        ('scenario', pa.int16()),
+        ('budget', pa.int32()),
+        ('days', pa.list_(pa.int16())),
+        ('depths', pa.list_(pa.int16())),
+        ('yield', pa.float64()),
+        ('total_irrigation', pa.float32()),
+        ('harvest_date', pa.string()),
+        ('seconds', pa.float32()),
+        ('recorded', pa.timestamp('ms')),
+        *([(name, pa.string()) for name in PARTITIONS] if partitions else []),
+    ])
+
+
+class ResultsWarehouse:
+    """
+        Append-only store of every simulated schedule in Parquet files, partitioned by crop and planting date as
+        `crop=<crop>/start=<yyyy-mm-dd>/part-*.parquet`. Rows are buffered and written by a background thread of the
+        recording process, such that recording never waits for the disk. Every flush writes new files, so readers and
+        the writers of other processes never see partial data.
+    """
+
+    def __init__(self, directory: str, flush_rows: int = FLUSH_ROWS, flush_seconds: float = FLUSH_SECONDS):
+        self.directory = Path(directory)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.files = 0
+        self._rows = queue.SimpleQueue()
+        self._writer = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_writer(self):
+        # A forked or spawned pool worker has to start its own writer
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._rows = queue.SimpleQueue()
+                    self._writer = threading.Thread(target=self._run, name='irr-warehouse', daemon=True)
+                    self._writer.start()
+                    self._pid = os.getpid()
+                    util.Finalize(self, self.flush, exitpriority=10)
+
+    def record(self, crop: str, soil: str, start: str, budget: int, days, depths, yield_: float,
+               total_irrigation: float, harvest_date: str, seconds: float, scenario: int = None,
+               station: str = DEFAULT_STATION):
+        """
+            Queue a single simulation for writing
+            :param start: planting date (yyyy-mm-dd)
+            :param days: days after planting of the scheduled irrigations
+            :param depths: irrigation depths (mm) of the schedule
+        """
+        self._ensure_writer()
+        self._rows.put(((crop, start), {
+            'soil': soil, 'station': station, 'scenario': scenario, 'budget': int(budget),
+            'days': np.asarray(days, dtype=np.int16), 'depths': np.asarray(depths, dtype=np.int16),
+            'yield': yield_, 'total_irrigation': total_irrigation, 'harvest_date': harvest_date,
+            'seconds': seconds, 'recorded': int(time() * 1000),
+        }))
+        tracer.count('warehouse.recorded')
+
+    def _run(self):
+        pending = {}
+        count = 0
+        deadline = monotonic() + self.flush_seconds
+        while True:
+            try:
+                item = self._rows.get(timeout=max(0., deadline - monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is not None and item[0] is not None:
+                partition, row = item
+                pending.setdefault(partition, []).append(row)
+                count += 1
+
+            # A None partition asks for a flush of everything buffered so far
+            if count >= self.flush_rows or monotonic() >= deadline or (item is not None and item[0] is None):
+                try:
+                    self._write(pending)
+                except Exception as e:
+                    print(f"Dropped {count} simulations, writing them to the warehouse failed: {e!r}")
+                pending, count = {}, 0
+                deadline = monotonic() + self.flush_seconds
+                if item is not None and item[0] is None:
+                    item[1].set()
+
+    def _write(self, partitions: dict):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = _schema()
+        for (crop, start), rows in partitions.items():
+            directory = self.directory / f"crop={crop}" / f"start={start}"
+            directory.mkdir(parents=True, exist_ok=True)
+            table = pa.Table.from_pylist(rows, schema=schema)
+
+            path = directory / f"part-{os.getpid()}-{uuid.uuid4().hex}.parquet"
+            tmp_path = directory / f".{path.name}.tmp"  # Hidden from scans until it is complete
+            pq.write_table(table, tmp_path, compression='zstd')
+            os.replace(tmp_path, path)
+            self.written += len(rows)
+            self.files += 1
+
+    def flush(self, timeout: float = None):
+        """ Write everything recorded so far by this process and wait until it is on disk """
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+
+        done = threading.Event()
+        self._rows.put((None, done))
+        done.wait(timeout)
+
+    def scan(self, columns: list = None, filter=None, **partitions):
+        """
+            Read the simulations as a pyarrow table, only the matching partitions and row groups are read
+            :param columns: columns to read, all of them by default; `crop` and `start` are partition columns
+            :param filter: pyarrow compute expression on the rows, e.g. `pyarrow.dataset.field('budget') > 100`
+            :param partitions: equality filters on the partition columns, e.g. `crop='Potato', start='2021-06-01'`
+        """
+        import pyarrow.dataset as ds
+
+        if not self.directory.exists():
+            return _schema(partitions=True).empty_table()
+
+        dataset = ds.dataset(self.directory, schema=_schema(partitions=True), format='parquet', partitioning='hive',
+                             ignore_prefixes=['.', '_'])
+        for name, value in partitions.items():
+            if name not in PARTITIONS:
+                raise ValueError(f"Unknown partition column '{name}', expected one of {PARTITIONS}")
+            expression = ds.field(name) == value
+            filter = expression if filter is None else filter & expression
+        return dataset.to_table(columns=columns, filter=filter)
+
+    def yield_curve(self, crop: str, start: str, soil: str = None, station: str = DEFAULT_STATION):
+        """ Best yield and its irrigation per budget of a single season, as a DataFrame ordered by budget """
+        import pyarrow.dataset as ds
+
+        filter = ds.field('station') == station
+        if station == DEFAULT_STATION:
+            filter = filter | ds.field('station').is_null()
+        if soil:
+            filter = filter & (ds.field('soil') == soil)
+        table = self.scan(columns=['budget', 'yield', 'total_irrigation', 'scenario'], filter=filter,
+                          crop=crop, start=start)
+        df = table.to_pandas()
+        df = df[df.scenario.isna()].sort_values('yield', ascending=False).drop_duplicates('budget')
+        return df.drop(columns='scenario').sort_values('budget').reset_index(drop=True)
+
+    def stats(self) -> dict:
+        return {'written': self.written, 'files': self.files, 'pending': self._rows.qsize()}
+
+
+warehouse = ResultsWarehouse(WAREHOUSE_DIR) if WAREHOUSE_DIR else None
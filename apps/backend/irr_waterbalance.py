@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+
+BATCH_ENABLED = os.getenv('IRR_BATCH_ENGINE', '0') == '1'
+TOLERANCE = float(os.getenv('IRR_BATCH_TOLERANCE', .1))  # mean yield error relative to AquaCrop to be trusted
+CALIBRATION_SAMPLES = 8
+INITIAL_WC = .5  # initial water content as fraction of the available water, as used by `simulate`
+MAX_IRR_EVENT = 25.  # mm AquaCrop applies at most per day, its default
+
+
+def _growth_curve(crop, t: np.ndarray) -> np.ndarray:
+    """ Canopy cover without stress at `t` calendar days after planting, following AquaCrop's growth curve """
+    cc0 = crop.PlantPop * crop.SeedSize * 1e-8
+    t = np.maximum(t - crop.EmergenceCD, 0)
+    cc = cc0 * np.exp(crop.CGC_CD * t)
+    cc = np.where(cc <= crop.CCx / 2, cc, crop.CCx - .25 * crop.CCx ** 2 / cc0 * np.exp(-crop.CGC_CD * t))
+    return np.clip(cc, 0, crop.CCx)
+
+
+def _decline(ccx, cdc, t):
+    """ AquaCrop's canopy decline from `ccx` after `t` days """
+    return np.clip(ccx * (1 - .05 * (np.exp(t * cdc * 3.33 / (ccx + 2.29)) - 1)), 0, 1)
+
+
+def _root_depth(crop, t: np.ndarray) -> np.ndarray:
+    z_ini = crop.Zmin * crop.PctZmin / 100
+    t0 = round(crop.EmergenceCD / 2)
+    x = np.clip((t - t0) / (crop.MaxRootingCD - t0), 0, 1)
+    return np.maximum(z_ini + (crop.Zmax - z_ini) * x ** (1 / crop.fshape_r), crop.Zmin)
+
+
+def _harvest_index(crop, t: np.ndarray) -> np.ndarray:
+    """ Logistic harvest index which reaches 98% of HI0 at the end of yield formation """
+    growth = np.log((crop.HI0 - crop.HIini) / (crop.HIini * (1 / .98 - 1))) / crop.YldFormCD
+    t = np.maximum(t - crop.HIstartCD, 0)
+    hi = crop.HIini * crop.HI0 / (crop.HIini + (crop.HI0 - crop.HIini) * np.exp(-growth * t))
+    return np.where(t > 0, np.minimum(hi, crop.HI0), 0)
+
+
+def _stress(depletion, p_up, p_lo, fshape):
+    """ Water stress coefficient (1 is no stress) of a relative root zone depletion """
+    rel = np.clip((depletion - p_up) / (p_lo - p_up), 0, 1)
+    return 1 - (np.exp(rel * fshape) - 1) / (np.exp(fshape) - 1)
+
+
+class BatchWaterBalance:
+    """
+        Daily soil water balance of many irrigation schedules at once for a single crop, soil and season, advanced in
+        lockstep as arrays. It follows AquaCrop's core: germination, canopy development with expansion stress and early
+        senescence, root growth, transpiration under stomatal stress and biomass from the normalized water
+        productivity. Temperature stress, aging and harvest index adjustments are left out, so yields are scaled to
+        AquaCrop with `calibrate`, after which the engine is only `trusted` within `TOLERANCE`.
+    """
+
+    def __init__(self, crop, soil, weather: dict, days: np.ndarray, max_irr_season: float,
+                 max_irr: float = MAX_IRR_EVENT, tolerance: float = TOLERANCE):
+        """
+            :param crop: aquacrop `Crop` with calendar day parameters
+            :param soil: aquacrop `Soil`
+            :param weather: daily 'Precipitation' and 'ReferenceET' (mm) arrays from the planting date onwards, the
+                season ends at the last day if the crop did not mature by then
+            :param days: day after planting (0-based) of every column of the schedules, negative if never applied
+        """
+        if crop.CalendarType != 1:
+            raise ValueError(f"{crop.Name} is timed in growing degree days, only calendar days are supported")
+
+        self.crop = crop
+        self.horizon = len(weather['ReferenceET'])
+        self.days = np.asarray(days, dtype=int)
+        self.max_irr_season = float(max_irr_season)
+        self.max_irr = max_irr
+        self.tolerance = tolerance
+        self.scale = 1.
+        self.error = np.inf
+
+        self.eto = np.asarray(weather['ReferenceET'], dtype=float)
+        rain = np.asarray(weather['Precipitation'], dtype=float)
+        s = 25400 / soil.cn - 254  # Curve number runoff of the rainfall, irrigation infiltrates completely
+        self.rain = rain - np.where(rain > .2 * s, (rain - .2 * s) ** 2 / (rain + .8 * s), 0)
+
+        # Crop development by calendar days after planting, shifted per schedule while germination is delayed
+        t = np.arange(self.horizon + 2)
+        self.cc0 = crop.PlantPop * crop.SeedSize * 1e-8
+        self.growth = _growth_curve(crop, t)
+        self.senescence = _decline(crop.CCx, crop.CDC_CD, np.maximum(t - crop.SenescenceCD, 0))
+        self.canopy_dev_end = (round(crop.HIstartCD + crop.FloweringCD / 2) if crop.Determinant == 1
+                               else crop.SenescenceCD)
+        self.harvest_index = _harvest_index(crop, t)
+
+        profile = soil.profile
+        self.dz = profile.dz.values * 1000  # mm
+        self.fc = profile.th_fc.values * self.dz
+        self.wp = profile.th_wp.values * self.dz
+        self.dry = self.wp / 2
+        z_top = profile.dzsum.values - profile.dz.values
+        self.roots = np.clip((_root_depth(crop, t)[:, None] - z_top) / profile.dz.values, 0, 1)
+        self.evap_layer = np.clip((soil.evap_z_min - z_top) / profile.dz.values, 0, 1)
+        self.germ_layer = np.clip((soil.z_germ - z_top) / profile.dz.values, 0, 1)
+        self.top_layer = np.clip((soil.z_top - z_top) / profile.dz.values, 0, 1)
+        self.top_taw = ((self.fc - self.wp) * self.top_layer).sum()
+        self.kex = soil.kex
+        self.f_evap = soil.f_evap
+
+        # Thresholds of expansion, stomatal and senescence stress, adjusted for the evaporative demand
+        p_up = np.array([crop.p_up1, crop.p_up2, crop.p_up3])[:, None]
+        p_lo = np.array([crop.p_lo1, crop.p_lo2, crop.p_lo3])[:, None]
+        self.p_up = np.clip(p_up + .04 * (5 - self.eto) * np.log10(10 - 9 * p_up), 0, 1)
+        self.p_lo = np.clip(p_lo + .04 * (5 - self.eto) * np.log10(10 - 9 * p_lo), 0, 1)
+        self.fshape_w = [crop.fshape_w1, crop.fshape_w2, crop.fshape_w3]
+
+    def irrigation(self, X: np.ndarray) -> np.ndarray:
+        """ Irrigation (mm) per schedule and day, capped per day but not yet by the seasonal maximum """
+        X = np.atleast_2d(np.asarray(X, dtype=float)).astype(int)  # AquaCrop gets whole mm, like in `objective`
+        daily = np.zeros((len(X), self.horizon))
+        valid = (self.days >= 0) & (self.days < self.horizon)
+        np.add.at(daily, (slice(None), self.days[valid]), X[:, valid])
+        return np.minimum(daily, self.max_irr)
+
+    def run(self, X: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+            Advance all schedules through the season in lockstep
+            :param X: irrigation depths (mm), one schedule per row
+            :returns: Tuple of the uncalibrated yields (tonne/ha), seasonal irrigation (mm) and the harvest day after
+                planting of every schedule
+        """
+        crop = self.crop
+        irrigation = self.irrigation(X)
+        n = len(irrigation)
+
+        water = np.tile(self.wp + INITIAL_WC * (self.fc - self.wp), (n, 1))  # mm per compartment
+        delay = np.zeros(n, dtype=int)
+        germinated = np.zeros(n, dtype=bool)
+        growing = np.ones(n, dtype=bool)
+        cc = np.zeros(n)
+        ccx_sen = np.zeros(n)
+        t_sen = np.zeros(n)
+        biomass = np.zeros(n)
+        irrigated = np.zeros(n)
+        yields = np.zeros(n)
+        harvest = np.full(n, self.horizon)
+
+        for day in range(self.horizon):
+            # Irrigation stops at the end of the season and once the seasonal maximum is reached
+            irr = np.where(growing, np.minimum(irrigation[:, day], self.max_irr_season - irrigated), 0)
+            irrigated += irr
+
+            # Infiltration fills the compartments up to field capacity from the top, the rest percolates
+            room = np.maximum(self.fc - water, 0)
+            filled = np.cumsum(room, axis=1) - room
+            water += np.clip((self.rain[day] + irr)[:, None] - filled, 0, room)
+
+            # The crop calendar only starts once the seed layer is wet enough
+            germ = ((water - self.wp) * self.germ_layer).sum(axis=1) / ((self.fc - self.wp) * self.germ_layer).sum()
+            germinated |= growing & (germ >= crop.GermThr)
+            delay += growing & ~germinated
+            t = day + 1 - delay
+
+            # Stress follows the wetter of the root zone and the top soil
+            roots = self.roots[t]
+            available = np.maximum(water - self.wp, 0)
+            depletion = np.minimum(1 - (available * roots).sum(axis=1) / ((self.fc - self.wp) * roots).sum(axis=1),
+                                   1 - (available * self.top_layer).sum(axis=1) / self.top_taw)
+            ks_exp, ks_sen = (_stress(depletion, self.p_up[i, day], self.p_lo[i, day], self.fshape_w[i])
+                              for i in (0, 2))
+            # Transpiration uses the linear stomatal stress, like AquaCrop does
+            ks_sto = 1 - np.clip((depletion - self.p_up[1, day]) / (self.p_lo[1, day] - self.p_up[1, day]), 0, 1)
+
+            # Canopy development, slowed down by expansion stress and cut short by water stress induced senescence
+            emerged = growing & germinated & (t >= crop.EmergenceCD)
+            developing = emerged & (t < self.canopy_dev_end)
+            previous = cc
+            cc = np.where(developing, np.where(cc > 0, cc, self.cc0) + ks_exp * (self.growth[t] - self.growth[t - 1]), cc)
+            cc = np.where(emerged & (t > crop.SenescenceCD), np.minimum(cc, self.senescence[t]), cc)
+
+            # Senescence stress declines the canopy from where it was when the stress started, a crop which is
+            # stressed before it has any canopy dies
+            early_sen = emerged & (ks_sen < 1)
+            ccx_sen = np.where(early_sen & (t_sen == 0), previous, ccx_sen)
+            cdc = np.maximum((1 - ks_sen ** 8) * crop.CDC_CD, 1e-4)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                k = cdc * 3.33 / (ccx_sen + 2.29)
+                elapsed = np.log(1 + np.clip(1 - cc / ccx_sen, 0, None) / .05) / k
+                declined = np.where(ccx_sen < .001, 0, _decline(ccx_sen, cdc, elapsed + 1))
+            cc = np.where(early_sen, np.minimum(cc, declined), cc)
+            t_sen = np.where(early_sen, t_sen + 1, 0)
+            dead = emerged & (cc < .001)
+
+            # Soil evaporation from the surface layer, reduced as it dries out
+            cc_adj = np.where(emerged, 1.72 * cc - cc ** 2 + .3 * cc ** 3, 0)  # Micro-advective effects
+            evap_water = np.maximum(water - self.dry, 0) * self.evap_layer
+            rel = np.clip(evap_water.sum(axis=1) / ((self.fc - self.dry) * self.evap_layer).sum(), 0, 1)
+            es = self.kex * (1 - cc_adj) * self.eto[day] * (np.exp(self.f_evap * rel) - 1) / (np.exp(self.f_evap) - 1)
+            water -= evap_water * (es / np.maximum(evap_water.sum(axis=1), 1e-9))[:, None]
+
+            # Transpiration from the root zone under stomatal stress
+            available = np.maximum(water - self.wp, 0) * roots
+            tr = np.where(emerged & ~dead, np.minimum(ks_sto * crop.Kcb * cc_adj * self.eto[day], available.sum(axis=1)),
+                          0)
+            water -= available * (tr / np.maximum(available.sum(axis=1), 1e-9))[:, None]
+            if self.eto[day] > 0:
+                biomass += crop.WP * tr / self.eto[day]
+
+            # Harvest at maturity or when the canopy died
+            done = growing & (dead | (t >= crop.MaturityCD))
+            yields[done] = self.harvest_index[t[done]] * biomass[done] / 100
+            harvest[done] = day + 1
+            growing &= ~done
+
+        yields[growing] = self.harvest_index[(self.horizon - delay)[growing]] * biomass[growing] / 100
+        return yields, irrigated, harvest
+
+    def evaluate(self, X: np.ndarray) -> np.ndarray:
+        """ Calibrated yields (tonne/ha) of all schedules """
+        return self.scale * self.run(X)[0]
+
+    def calibrate(self, X: np.ndarray, reference: np.ndarray) -> float:
+        """
+            Fit the yield scale to AquaCrop yields of the same schedules. The error is measured on every other schedule
+            with the scale fitted to the remaining ones, after which the scale is fitted to all of them.
+            :returns: mean absolute yield error of the held out schedules, relative to their mean AquaCrop yield
+        """
+        raw = self.run(X)[0]
+        reference = np.nan_to_num(np.asarray(reference, dtype=float), nan=0.)
+
+        def fit(mask):
+            return float(raw[mask] @ reference[mask] / (raw[mask] @ raw[mask])) if raw[mask] @ raw[mask] > 0 else 1.
+
+        held_out = np.arange(len(raw)) % 2 == 1
+        if held_out.any():
+            error = np.mean(np.abs(fit(~held_out) * raw[held_out] - reference[held_out]))
+            self.error = float(error / max(reference[held_out].mean(), 1e-9))
+        else:
+            self.error = np.inf  # A single schedule leaves nothing to validate the scale on
+        self.scale = fit(np.ones(len(raw), dtype=bool))
+        return self.error
+
+    @property
+    def trusted(self) -> bool:
+        return self.error <= self.tolerance
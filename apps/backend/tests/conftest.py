@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The backend modules are flat and imported by name, like `python irr_api.py` does from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DEVELOPMENT', '1')
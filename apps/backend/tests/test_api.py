@@ -0,0 +1,243 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import pytest
+from sqlalchemy import event
+
+import database
+import irr_api
+import irr_simulations
+from irr_jobs import JobQueue
+
+from test_simulations import SerialPool
+
+FIELD = {'start_date': '2021/06/01', 'end_date': '2021/10/01', 'crop_type': 'Potato', 'crop_stage': 0,
+         'field_size': 2, 'max_water': 400}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE_URL', f"sqlite:///{tmp_path / 'simulations.db'}")
+    monkeypatch.setattr(database, '_engine', None)
+    database.init_database()
+
+    jobs = JobQueue(pool=SerialPool())
+    monkeypatch.setattr(irr_api, 'jobs', jobs)
+    irr_api.response_cache.clear()
+    yield irr_api.create_app().test_client()
+    jobs.shutdown()
+
+
+def wait(client, job_id: str) -> dict:
+    for _ in range(100):
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(.05)
+    raise TimeoutError(job_id)
+
+
+def levels(field_size: int = 1) -> list:
+    """ `optimize_level` results of three budget levels on a front, as (schedule, (yield, irrigation, harvest)) """
+    dates = pd.date_range('2021/06/01', periods=3, freq='7D')
+    return [(pd.DataFrame({'Date': dates, 'Depth': depths}), (yield_, float(sum(depths)), '2021-09-20'))
+            for depths, yield_ in [([0, 0, 0], 4.), ([20, 0, 30], 7.), ([50, 50, 50], 9.)]]
+
+
+def find_best_schedule(start, end, crop, field_size=1, progress=None, selection=None, **kwargs):
+    """ Optimizes the `levels` right away """
+    results = levels()
+    progress(irr_simulations.pareto_front(results), 30)
+    return irr_simulations.select_best(results, field_size, selection=selection)
+
+
+def test_simulation_without_database_returns_its_pareto_set(client, monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'find_best_schedule', find_best_schedule)
+    monkeypatch.setattr(irr_api, 'DATABASE_ENABLED', False)
+    job = wait(client, client.post('/create-simulation', json={**FIELD, 'selection': 'yield'}).get_json()['id'])
+    assert job['status'] == 'done'
+    assert job['result']['schedule'] == {'2021/06/01': 100, '2021/06/08': 100, '2021/06/15': 100}
+    assert [point['total_liters'] for point in job['result']['pareto']] == [0, 100, 300]
+
+
+def test_pareto_set_is_stored_and_chosen_from(client, monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'find_best_schedule', find_best_schedule)
+    job = wait(client, client.post('/create-simulation', json={**FIELD, 'selection': 'yield'}).get_json()['id'])
+    assert job['status'] == 'done'
+    uid = job['result']
+
+    points = client.get(f"/get-pareto/{uid}").get_json()
+    assert [(point['yield'], point['total_liters'], point['events']) for point in points] == \
+        [(4., 0., 0), (7., 100., 2), (9., 300., 3)]
+    assert client.get(f"/get-simulation/{uid}").get_json()['schedule'] == points[2]['schedule']
+
+    chosen = client.post(f"/choose-pareto/{uid}/1").get_json()
+    assert chosen['schedule'] == {'2021/06/01': 40., '2021/06/15': 60.}
+    assert client.get(f"/get-simulation/{uid}").get_json()['schedule'] == chosen['schedule']
+    assert client.post(f"/choose-pareto/{uid}/3").status_code == 404
+
+
+def test_batch_stores_and_streams_every_field_as_it_finishes(client, monkeypatch):
+    def find_best_schedules(batch, pool=None, cancel=None):
+        for i in reversed(range(len(batch))):
+            results = levels()[i:]
+            yield i, irr_simulations.select_best(results, batch[i]['field_size']), \
+                irr_simulations.pareto_front(results)
+
+    upserts = []
+    upsert_simulations = database.upsert_simulations
+    monkeypatch.setattr(irr_simulations, 'find_best_schedules', find_best_schedules)
+    monkeypatch.setattr(irr_api, 'upsert_simulations', lambda session, sims, pareto: upserts.append(sims) or
+                        upsert_simulations(session, sims, pareto))
+
+    response = client.post('/create-simulations', json={'fields': [FIELD, {**FIELD, 'crop_type': 'Maize'}]})
+    assert response.status_code == 202
+
+    job_id = response.get_json()['id']
+    job = wait(client, job_id)
+    assert job['status'] == 'done'
+    assert job['progress']['done'] == 2
+    assert job['progress']['simulations'] == job['result']
+    assert [len(sims) for sims in upserts] == [1, 1]
+
+    # The finished job replays its last state, which holds every field
+    events = client.get(f"/jobs/{job_id}/events").get_data(as_text=True).strip().split('\n\n')
+    assert events[-1].startswith('event: done\n')
+    assert json.loads(events[-1].split('data: ', 1)[1])['progress']['simulations'] == job['result']
+
+    maize = client.get(f"/get-simulation/{job['result'][1]}").get_json()
+    assert maize['crop_type'] == 'Maize'
+    assert [point['total_liters'] for point in client.get(f"/get-pareto/{job['result'][1]}").get_json()] == [100, 300]
+
+
+def test_fields_finished_before_a_failure_stay_stored(client, monkeypatch):
+    def find_best_schedules(batch, pool=None, cancel=None):
+        results = levels()
+        yield 1, irr_simulations.select_best(results, batch[1]['field_size']), irr_simulations.pareto_front(results)
+        raise RuntimeError('worker died')
+
+    monkeypatch.setattr(irr_simulations, 'find_best_schedules', find_best_schedules)
+    job = wait(client, client.post('/create-simulations', json={'fields': [FIELD, FIELD]}).get_json()['id'])
+    assert job['status'] == 'failed'
+
+    first, second = job['progress']['simulations']
+    assert first is None
+    assert client.get(f"/get-simulation/{second}").status_code == 200
+
+
+def test_listing_revalidates_and_is_invalidated_on_write(client, monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'find_best_schedule', find_best_schedule)
+    listing = client.get('/get-simulations')
+    assert listing.get_json() == []
+
+    etag = listing.headers['ETag']
+    assert client.get('/get-simulations', headers={'If-None-Match': etag}).status_code == 304
+
+    uid = wait(client, client.post('/create-simulation', json=FIELD).get_json()['id'])['result']
+    listing = client.get('/get-simulations', headers={'If-None-Match': etag})
+    assert listing.status_code == 200
+    assert [sim['id'] for sim in listing.get_json()] == [uid]
+    assert listing.headers['ETag'] != etag
+
+    # Choosing from the Pareto set writes the simulation as well
+    etag = client.get(f"/get-simulation/{uid}").headers['ETag']
+    client.post(f"/choose-pareto/{uid}/0")
+    simulation = client.get(f"/get-simulation/{uid}", headers={'If-None-Match': etag})
+    assert simulation.status_code == 200
+    assert simulation.get_json()['schedule'] == {}
+
+
+def events(client, job_id: str) -> list:
+    """ (name, job) of every Server-Sent Event of a job until the stream ends """
+    stream = client.get(f"/jobs/{job_id}/events").get_data(as_text=True)
+    return [(event.split('\n')[0][len('event: '):], json.loads(event.split('data: ', 1)[1]))
+            for event in stream.strip().split('\n\n') if event.startswith('event: ')]
+
+
+def counting(steps: int, fail: bool = False, pool=None, job=None):
+    for step in range(1, steps + 1):
+        time.sleep(.05)
+        job.report({'step': step})
+    if fail:
+        raise RuntimeError('simulation failed')
+    return steps
+
+
+@pytest.mark.parametrize('fail, final', [(False, 'done'), (True, 'failed')])
+def test_events_stream_progress_in_order_and_end_with_the_status(client, fail, final):
+    job = irr_api.jobs.submit(counting, 5, fail=fail)
+    names, jobs = zip(*events(client, job.id))
+
+    assert names[-1] == final
+    assert set(names[:-1]) <= {'progress'}
+    steps = [job['progress']['step'] for job in jobs if job['progress']]
+    assert steps == sorted(steps) and steps[-1] == 5
+    assert jobs[-1]['result'] == (None if fail else 5)
+
+
+def waiting(pool=None, job=None):
+    job.report({'started': True})
+    job.cancel_event.wait(10)
+    raise irr_simulations.Cancelled()
+
+
+def test_cancel_queued_and_running_jobs(client, monkeypatch):
+    monkeypatch.setattr(irr_api, 'jobs', JobQueue(max_jobs=1, pool=SerialPool()))
+    running = irr_api.jobs.submit(waiting)
+    queued = irr_api.jobs.submit(counting, 1)
+    while running.progress is None:
+        time.sleep(.01)
+
+    # A queued job is cancelled right away and never runs
+    response = client.post(f"/jobs/{queued.id}/cancel")
+    assert response.status_code == 202
+    assert response.get_json()['status'] == 'cancelled'
+
+    # A running job stops at its next check of the cancel event
+    assert client.post(f"/jobs/{running.id}/cancel").status_code == 202
+    assert events(client, running.id)[-1][0] == 'cancelled'
+    assert wait(client, queued.id)['progress'] is None
+    assert client.post('/jobs/unknown/cancel').status_code == 404
+    irr_api.jobs.shutdown()
+
+
+def test_warm_start_seeds_are_the_closest_simulations(client):
+    def sim(id_, liters, crop='Potato', start='2021/06/01', max_water=400, mac='127.0.0.1'):
+        return database.Simulation(id=id_, mac_address=mac, crop_type=crop, crop_stage=0, start_date=start,
+                                   end_date='2021/10/01', max_water=max_water, field_size=2,
+                                   schedule={'2021/06/11': liters} if liters else {})
+
+    with database.Session() as session:
+        database.upsert_simulations(session, [
+            sim('empty', 0), sim('same', 60.), sim('later', 70., start='2021/06/20'),
+            sim('cheaper', 80., max_water=300), sim('other-crop', 90., crop='Maize'),
+            sim('other-user', 90., mac='10.0.0.1'), sim('too-late', 90., start='2021/08/01'),
+            sim('too-much-water', 90., max_water=2000),
+        ])
+
+        loads = []
+
+        @event.listens_for(session.get_bind(), 'before_cursor_execute')
+        def count_schedule_loads(conn, cursor, statement, *args):
+            if statement.startswith('SELECT simulations.schedule'):
+                loads.append(statement)
+
+        seeds = irr_api.warm_start_seeds(session, '127.0.0.1', FIELD, limit=2)
+        event.remove(session.get_bind(), 'before_cursor_execute', count_schedule_loads)
+
+    # Liters over the 2 m2 of the field, 10 days after planting
+    assert [seed.to_dict() for seed in seeds] == [{10: 30.}, {10: 40.}]
+    # The candidates are chosen without their schedules, only those of the chosen ones and the empty one are loaded
+    assert len(loads) == 3
+
+
+def test_api_imports_without_the_simulation_modules():
+    # A fresh interpreter, the tests already imported everything
+    code = "import sys, irr_api; print(sorted({'scipy', 'pandas', 'aquacrop', 'pyarrow'} & set(sys.modules)))"
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
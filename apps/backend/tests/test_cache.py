@@ -0,0 +1,52 @@
+import irr_cache
+from irr_cache import ResultCache, counter_stats, make_key
+from irr_tracing import traced_call, tracer
+
+
+def test_keys_do_not_depend_on_the_order_of_the_inputs():
+    assert make_key(crop='Potato', budget=100) == make_key(budget=100, crop='Potato')
+    assert make_key(crop='Potato', budget=100) != make_key(crop='Potato', budget=200)
+
+
+def test_memory_tier_evicts_least_recently_used_first():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', (1., 10., '2021-09-01'))
+    cache.put('b', (2., 20., '2021-09-02'))
+    assert cache.get('a') == (1., 10., '2021-09-01')
+
+    cache.put('c', (3., 30., '2021-09-03'))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.stats() == {'entries': 2, 'hits': 2, 'disk_hits': 0, 'misses': 1, 'hit_rate': 2 / 3}
+
+
+def test_disk_tier_is_shared_between_caches(tmp_path):
+    ResultCache(directory=tmp_path).put('a', (1., 10., '2021-09-01'))
+
+    other = ResultCache(directory=tmp_path)
+    assert other.get('a') == (1., 10., '2021-09-01')
+    assert other.get('a') == (1., 10., '2021-09-01')
+    assert (other.stats()['disk_hits'], other.stats()['hits']) == (1, 1)
+
+
+def test_version_bump_invalidates_stored_results(tmp_path, monkeypatch):
+    key = make_key(crop='Potato', budget=100)
+    ResultCache(directory=tmp_path).put(key, (1., 10., '2021-09-01'))
+
+    monkeypatch.setattr(irr_cache, 'CACHE_VERSION', irr_cache.CACHE_VERSION + 1)
+    bumped = make_key(crop='Potato', budget=100)
+    assert bumped != key
+    assert ResultCache(directory=tmp_path).get(bumped) is None
+
+
+def test_lookups_of_workers_add_up_in_the_tracer(monkeypatch):
+    monkeypatch.setattr(tracer, 'enabled', True)
+    tracer.drain()
+    cache = ResultCache()
+    cache.put('a', (1., 10., '2021-09-01'))
+
+    # What a pool worker sends back with its result
+    _, trace = traced_call(lambda: [cache.get('a'), cache.get('b')], ())
+    tracer.merge(trace)
+    tracer.merge(trace)
+    assert counter_stats(tracer.drain()['counters']) == {'hits': 2, 'disk_hits': 0, 'misses': 2, 'hit_rate': .5}
@@ -0,0 +1,101 @@
+import json
+import zlib
+
+import pytest
+from sqlalchemy import event
+
+import database
+from database import SCHEDULE_HEADER, SCHEDULE_MAGIC, Simulation, decode_schedule, encode_schedule, \
+    get_all_simulations, get_pareto_points, upsert_simulations
+
+SCHEDULE = {'2021/06/01': 100., '2021/06/08': 0., '2021/06/15': 37.5}
+
+
+@pytest.mark.parametrize('schedule', [SCHEDULE, {'2021/06/01': 12.}, {}])
+def test_schedules_round_trip_in_the_binary_layout(schedule):
+    value = encode_schedule(schedule)
+    assert value.startswith(SCHEDULE_MAGIC)
+    assert len(value) == SCHEDULE_HEADER.size + 6 * len(schedule)
+    assert decode_schedule(value) == schedule
+
+
+def test_wide_schedules_fall_back_to_compressed_json():
+    schedule = {'1800/01/01': 10., '2021/06/01': 20.}  # More than 0xFFFF days apart
+    value = encode_schedule(schedule)
+    assert not value.startswith(SCHEDULE_MAGIC)
+    assert decode_schedule(value) == schedule
+
+
+def test_rows_written_as_compressed_json_still_decode():
+    legacy = zlib.compress(json.dumps({'2021/06/01': 100, '2021/06/08': 50}).encode('utf-8'))
+    assert decode_schedule(legacy) == {'2021/06/01': 100, '2021/06/08': 50}
+
+
+def test_unknown_versions_are_rejected():
+    value = bytearray(encode_schedule(SCHEDULE))
+    value[len(SCHEDULE_MAGIC)] = 99
+    with pytest.raises(ValueError):
+        decode_schedule(bytes(value))
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE_URL', f"sqlite:///{tmp_path / 'simulations.db'}")
+    monkeypatch.setattr(database, '_engine', None)
+    database.init_database()
+    with database.Session() as session:
+        yield session
+
+
+def simulation(id_: str, max_water: int = 400, schedule: dict = None) -> Simulation:
+    return Simulation(id=id_, mac_address='127.0.0.1', crop_type='Potato', crop_stage=0, start_date='2021/06/01',
+                      end_date='2021/10/01', max_water=max_water, field_size=2, schedule=schedule or SCHEDULE,
+                      harvest_date='2021/09/20')
+
+
+def point(total_liters: float) -> dict:
+    return {'yield': 7., 'total_liters': total_liters, 'events': 2, 'harvest_date': '2021-09-20',
+            'schedule': {'2021/06/01': total_liters}}
+
+
+def test_upsert_inserts_new_and_updates_existing_simulations(session):
+    assert upsert_simulations(session, [simulation('a'), simulation('b')]) == ['a', 'b']
+    assert upsert_simulations(session, [simulation('b', max_water=800, schedule={'2021/06/02': 5.}),
+                                        simulation('c')]) == ['b', 'c']
+    session.expire_all()
+
+    sims = {sim.id: sim for sim in get_all_simulations(session, '127.0.0.1')}
+    assert sorted(sims) == ['a', 'b', 'c']
+    assert (sims['a'].max_water, sims['b'].max_water) == (400, 800)
+    assert sims['b'].schedule == {'2021/06/02': 5.}
+
+
+def test_upsert_splits_batches_at_the_sqlite_parameter_limit(session):
+    batch = 999 // len(Simulation.__table__.columns)
+    ids = [f"sim-{i:04d}" for i in range(2 * batch + 1)]
+    inserts = []
+
+    @event.listens_for(session.get_bind(), 'before_cursor_execute')
+    def count_inserts(conn, cursor, statement, *args):
+        if statement.startswith('INSERT INTO simulations'):
+            inserts.append(statement)
+
+    assert upsert_simulations(session, [simulation(id_) for id_ in ids]) == ids
+    assert len(inserts) == 3
+    assert session.query(Simulation).count() == len(ids)
+
+
+def test_upsert_replaces_the_pareto_set(session):
+    upsert_simulations(session, [simulation('a'), simulation('b')],
+                       pareto={'a': [point(0.), point(100.), point(300.)], 'b': [point(50.)]})
+    upsert_simulations(session, [simulation('a')], pareto={'a': [point(200.)]})
+
+    assert [(p.position, p.total_liters) for p in get_pareto_points(session, 'a')] == [(0, 200.)]
+    assert [p.schedule for p in get_pareto_points(session, 'b')] == [{'2021/06/01': 50.}]
+
+
+def test_writes_notify_the_listeners(session, monkeypatch):
+    writes = []
+    monkeypatch.setattr(database, '_write_listeners', [lambda ids, macs: writes.append((ids, macs))])
+    upsert_simulations(session, [simulation('a')])
+    assert writes == [(['a'], ['127.0.0.1'])]
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import irr_jobs
+from irr_jobs import JobQueue, QueueFull
+
+from test_simulations import SerialPool
+
+
+@pytest.fixture
+def queue():
+    jobs = JobQueue(max_jobs=1, max_queued=2, pool=SerialPool())
+    yield jobs
+    jobs.shutdown()
+
+
+def blocked(gate: threading.Event, pool=None, job=None):
+    gate.wait(10)
+    return 'done'
+
+
+def finish(job, timeout: float = 10):
+    version = job.version
+    while job.finished is None:
+        version = job.wait(version, timeout)
+    return job
+
+
+def test_job_runs_with_the_shared_pool(queue):
+    job = finish(queue.submit(lambda x, pool=None, job=None: (x, pool, job), 1))
+    assert job.status == 'done'
+    assert job.result == (1, queue.pool, job)
+    assert job.to_dict()['run_seconds'] >= 0
+
+
+def test_failed_job_keeps_its_error(queue):
+    def fail(pool=None, job=None):
+        raise RuntimeError('no weather')
+
+    job = finish(queue.submit(fail))
+    assert (job.status, job.error) == ('failed', "RuntimeError('no weather')")
+
+
+def test_jobs_queue_behind_the_running_ones_up_to_the_maximum(queue):
+    gate = threading.Event()
+    running = queue.submit(blocked, gate)
+    while running.status != 'running':
+        running.wait(running.version, .1)
+    queued = [queue.submit(blocked, gate), queue.submit(blocked, gate)]
+    with pytest.raises(QueueFull):
+        queue.submit(blocked, gate)
+
+    stats = queue.stats()
+    assert (stats['running'], stats['queued']) == (1, 2)
+    assert [job['id'] for job in stats['jobs']] == [running.id, *(job.id for job in queued)]
+
+    gate.set()
+    assert [finish(job).status for job in [running, *queued]] == ['done'] * 3
+    assert queue.stats()['done'] == 3
+
+
+def test_cancelled_jobs_do_not_run(queue):
+    gate = threading.Event()
+    running = queue.submit(blocked, gate)
+    queued = queue.submit(blocked, gate)
+
+    assert queue.cancel(queued.id) is queued
+    assert queued.status == 'cancelled'
+    gate.set()
+    finish(running)
+    assert queued.started is None
+    assert queue.cancel('unknown') is None
+
+
+def test_finished_jobs_are_evicted_oldest_first(queue, monkeypatch):
+    monkeypatch.setattr(irr_jobs, 'MAX_FINISHED', 2)
+    jobs = [finish(queue.submit(lambda pool=None, job=None: None)) for _ in range(4)]
+
+    # Eviction happens on submit, so the last job finished after the last eviction
+    assert [queue.get(job.id) for job in jobs] == [None, jobs[1], jobs[2], jobs[3]]
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from irr_lookup import ENSEMBLE_YEAR, LookupTable, last_measured_year
+from weather_store import WeatherStore
+
+from test_weather_store import REPO_CSV
+
+
+def level(start, depths):
+    solution = pd.DataFrame({'Date': pd.date_range(start, periods=len(depths), freq='7D'), 'Depth': depths})
+    return solution, (5., float(sum(depths)), str(np.datetime64(start + timedelta(days=100), 'ns')))
+
+
+def test_levels_match_on_the_weather_year(tmp_path):
+    table = LookupTable(str(tmp_path / 'lookup.sqlite'), readonly=False)
+    start = datetime(2021, 6, 1)
+    table.put('Maize', 'SandyLoam', start, start + timedelta(days=120), 100, level(start, [50, 50]), 2021)
+
+    request = datetime(2021, 6, 2), datetime(2021, 10, 1)
+    (solution, (_, total_irr, harvest)), = table.lookup('Maize', 'SandyLoam', *request, 100, 2021)
+    assert solution.Date.tolist() == [pd.Timestamp(2021, 6, 2), pd.Timestamp(2021, 6, 9)]
+    assert total_irr == 100
+    assert pd.Timestamp(harvest) == pd.Timestamp(2021, 9, 10)
+
+    # The same days of another year had other weather
+    assert table.lookup('Maize', 'SandyLoam', datetime(2020, 6, 2), datetime(2020, 10, 1), 100, 2020) is None
+
+
+def test_ensemble_levels_serve_every_year(tmp_path):
+    table = LookupTable(str(tmp_path / 'lookup.sqlite'), readonly=False)
+    start = datetime(2020, 12, 30)
+    table.put('Maize', 'SandyLoam', start, start + timedelta(days=120), 100, level(start, [100]), ENSEMBLE_YEAR)
+
+    (solution, _), = table.lookup('Maize', 'SandyLoam', datetime(2024, 1, 1), datetime(2024, 5, 1), 100,
+                                  ENSEMBLE_YEAR)
+    assert solution.Date.tolist() == [pd.Timestamp(2024, 1, 1)]
+
+
+def test_last_measured_year(tmp_path):
+    station = WeatherStore(tmp_path / 'store', {'tamale': str(REPO_CSV)}).station('tamale')
+
+    # 2022 was copied forward from 2021
+    assert station.last_date == datetime(2022, 12, 31)
+    assert last_measured_year(station) == 2021
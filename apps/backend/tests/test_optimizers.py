@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import irr_optimizers
+from irr_optimizers import CMAES, NSGA2, Optimizer, derive_seed, make_optimizer, make_rng, seed_process
+
+
+@pytest.fixture
+def root_seed(monkeypatch):
+    monkeypatch.setattr(irr_optimizers, 'ROOT_SEED', 42)
+    monkeypatch.setattr(irr_optimizers, '_seed_sequence', irr_optimizers._seed_sequence)  # Restored afterwards
+    return 42
+
+
+def test_derived_seeds(root_seed):
+    assert derive_seed(1, 2) == derive_seed(1, 2)
+    assert derive_seed(1, 2) != derive_seed(2, 1)
+    assert make_rng(derive_seed(3)).random(4).tolist() == make_rng(derive_seed(3)).random(4).tolist()
+
+
+def test_no_derived_seed_without_root_seed(monkeypatch):
+    monkeypatch.setattr(irr_optimizers, 'ROOT_SEED', None)
+    assert derive_seed(1) is None
+
+
+def test_seeded_processes(root_seed):
+    seed_process(1)
+    first = [make_rng().random(), make_rng().random(), np.random.random()]
+    seed_process(1)
+    assert [make_rng().random(), make_rng().random(), np.random.random()] == first
+
+    # Other workers and later streams of a worker differ
+    seed_process(2)
+    assert make_rng().random() != first[0]
+    assert first[0] != first[1]
+
+
+@pytest.mark.parametrize('sampler', ['random', 'sobol', 'halton'])
+def test_samples_are_on_the_simplex(sampler):
+    samples = Optimizer(6, 100, sampler=sampler, rng=make_rng(0)).sample(20)
+
+    assert samples.shape == (20, 6)
+    assert (samples >= 0).all()
+    np.testing.assert_allclose(samples.sum(axis=1), 1)
+    np.testing.assert_array_equal(Optimizer(6, 100, sampler=sampler, rng=make_rng(0)).sample(20), samples)
+
+
+def test_unknown_sampler():
+    with pytest.raises(ValueError):
+        Optimizer(6, 100, sampler='grid')
+
+
+def test_seeded_optimizers_ask_the_same(root_seed):
+    optimizers = [CMAES(6, 100, rng=make_rng(derive_seed(5))) for _ in range(2)]
+    for _ in range(3):
+        xs = [optimizer.ask() for optimizer in optimizers]
+        np.testing.assert_array_equal(*xs)
+        for optimizer, x in zip(optimizers, xs):
+            optimizer.tell(x, (x[:, 0] - 30) ** 2)
+
+
+@pytest.mark.parametrize('method', ['cmaes', 'de', 'bayes'])
+def test_flat_objective_stops_early(method):
+    optimizer = make_optimizer(method, 10, 100, rng=make_rng(0))
+    while not optimizer.converged and optimizer.evaluations < 100:
+        xs = optimizer.ask()
+        optimizer.tell(xs, np.zeros(len(xs)))
+
+    assert optimizer.converged
+    assert optimizer.evaluations < 100
+
+
+def test_improving_objective_does_not_stop():
+    optimizer = make_optimizer('de', 10, 100, rng=make_rng(0))
+    while optimizer.evaluations < 100:
+        assert not optimizer.converged
+        xs = optimizer.ask()
+        optimizer.tell(xs, -optimizer.evaluations - np.arange(1, len(xs) + 1))
+
+
+def test_nsga2_starts_from_the_seeds_with_their_budget():
+    seeds = [np.array([20., 20., 0., 0.]), np.array([0., 0., 0., 100.])]
+    xs = NSGA2(4, 100, popsize=8, rng=make_rng(0), seeds=seeds).ask()
+
+    assert xs.shape == (8, 4)
+    np.testing.assert_allclose(xs[:2], seeds)
+    assert (xs.sum(axis=1) <= 100 + 1e-9).all()
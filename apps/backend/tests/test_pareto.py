@@ -0,0 +1,59 @@
+import numpy as np
+
+from irr_pareto import ParetoArchive, crowding_distance, dominates, non_dominated_sort
+
+# Minimized: (1, 4), (2, 2) and (4, 1) are on the first front, (3, 3) and (5, 2) behind those, (4, 4) last
+F = np.array([[3, 3], [1, 4], [4, 4], [2, 2], [5, 2], [4, 1]])
+
+
+def test_dominates():
+    assert dominates([1, 2], [1, 3])
+    assert not dominates([1, 2], [1, 2])
+    assert not dominates([1, 3], [2, 2])
+
+
+def test_non_dominated_sort():
+    assert non_dominated_sort(F).tolist() == [1, 0, 2, 0, 1, 0]
+
+
+def test_missing_objectives_are_worst():
+    assert non_dominated_sort([[np.nan, 1], [1, 2], [2, 1]]).tolist() == [1, 0, 0]
+
+
+def test_crowding_distance():
+    distance = crowding_distance([[1, 4], [2, 2], [4, 1], [3, 1.5]])
+
+    # The extremes of both objectives are kept, of the others the one with the most room around it is preferred
+    assert np.isinf(distance[[0, 2]]).all()
+    np.testing.assert_allclose(distance[[1, 3]], [(3 - 1) / 3 + (4 - 1.5) / 3, (4 - 2) / 3 + (2 - 1) / 3])
+    assert np.isinf(crowding_distance([[1, 2], [2, 1]])).all()
+
+
+def test_archive_keeps_the_front():
+    archive = ParetoArchive()
+    added = [archive.add(f, i) for i, f in enumerate(F)]
+
+    assert added == [True, True, False, True, False, True]
+    assert archive.objectives.tolist() == [[1, 4], [2, 2], [4, 1]]
+    assert archive.items == [1, 3, 5]
+
+    # Equal points are not added twice
+    assert not archive.add([2, 2], 'again')
+    assert len(archive) == 3
+
+
+def test_dominating_point_removes_the_front():
+    archive = ParetoArchive()
+    archive.update((f, i) for i, f in enumerate(F))
+
+    assert archive.add([1, 1], 'best')
+    assert archive.items == ['best']
+    assert archive.objectives.tolist() == [[1, 1]]
+
+
+def test_archive_maximizes():
+    archive = ParetoArchive(names=('irrigation', 'yield'), maximize=(False, True))
+    archive.update([((100, 7.), 'a'), ((300, 9.), 'b'), ((200, 6.), 'c'), ((0, np.nan), 'd')])
+
+    assert archive.items == ['d', 'a', 'b']
+    assert archive.to_list()[1] == {'irrigation': 100, 'yield': 7.}
@@ -0,0 +1,39 @@
+from irr_response_cache import ResponseCache
+
+
+def test_entries_are_evicted_least_recently_used_first():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    assert cache.get('a')[0] == b'1'
+
+    cache.put('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a')[0] == b'1'
+    assert cache.get('c')[0] == b'3'
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr('irr_response_cache.monotonic', lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    cache.put('a', b'1')
+    cache.put('forever', b'2', ttl=0)
+
+    now[0] = 11.
+    assert cache.get('a') is None
+    assert cache.get('forever')[0] == b'2'
+
+
+def test_body_built_before_an_invalidation_is_not_stored():
+    cache = ResponseCache()
+
+    def build():
+        # A write commits and invalidates while the old rows are being serialized
+        cache.invalidate('simulations')
+        return b'stale'
+
+    assert cache.get_or_create('simulations', build)[0] == b'stale'
+    assert cache.get('simulations') is None
+    assert cache.get_or_create('simulations', lambda: b'fresh')[0] == b'fresh'
+    assert cache.get('simulations')[0] == b'fresh'
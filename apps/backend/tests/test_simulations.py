@@ -0,0 +1,238 @@
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import irr_simulations
+from irr_simulations import Cancelled, budget_sweep, create_initial_irr_schedule, objective, refine_levels, result_key
+from irr_surrogate import Surrogate
+from weather_store import DEFAULT_STATION, weather_store
+
+from test_weather_store import REPO_CSV
+
+START, END = datetime(2021, 6, 1), datetime(2021, 10, 1)
+
+
+@pytest.fixture
+def dry_station(tmp_path, monkeypatch):
+    """ The repo's weather without any rain, as a second station """
+    df = pd.read_csv(REPO_CSV)
+    df['Precipitation'] = 0.
+    df.to_csv(tmp_path / 'dry.csv', index=False)
+    monkeypatch.setitem(weather_store.sources, 'dry', str(tmp_path / 'dry.csv'))
+    monkeypatch.setattr(weather_store, 'directory', tmp_path / 'store')
+    monkeypatch.setattr(irr_simulations, 'warehouse', None)
+    yield 'dry'
+    weather_store.reload('dry')
+
+
+def test_result_key_depends_on_the_station():
+    schedule = create_initial_irr_schedule(START, END, 100)
+    default = result_key(schedule, START, 'Potato', 'SandyLoam', 100)
+
+    assert result_key(schedule, START, 'Potato', 'SandyLoam', 100, station=DEFAULT_STATION) == default
+    assert result_key(schedule, START, 'Potato', 'SandyLoam', 100, station='dry') != default
+
+
+def test_simulations_use_the_weather_of_their_station(dry_station):
+    schedule = create_initial_irr_schedule(START, END, 0)
+    args = (schedule.Depth.values, schedule, START, END, 'Potato', 'SandyLoam', 0, True)
+
+    wet_yield, _, _ = objective(*args)
+    dry_yield, _, _ = objective(*args, station=dry_station)
+    assert dry_yield < wet_yield
+
+
+class SerialPool:
+    """ Runs every task right away in this process """
+    size = 2
+
+    def apply_async(self, fn, args=(), kwds=None, callback=None, error_callback=None):
+        callback(fn(*args, **(kwds or {})))
+
+    def starmap(self, fn, iterable):
+        return [fn(*args) for args in iterable]
+
+
+def test_seeded_sweeps_find_the_same_front(monkeypatch):
+    # A surrogate which is trusted early and discards all but the most promising candidates, shared by both sweeps
+    surrogate = Surrogate(min_samples=5, max_error=np.inf, kappa=0.)
+    monkeypatch.setattr(irr_simulations, 'get_surrogate', lambda *args: surrogate)
+    monkeypatch.setattr(irr_simulations, 'SURROGATE_ENABLED', True)
+    monkeypatch.setattr(irr_simulations, 'BATCH_ENABLED', False)
+    monkeypatch.setattr(irr_simulations, 'warehouse', None)
+
+    fronts = [budget_sweep(START, END, 'Potato', 'SandyLoam', 100, num_searches=16, pool=SerialPool(),
+                           max_evaluations=48, seed=7) for _ in range(2)]
+
+    assert surrogate.trusted
+    assert surrogate.screened == 0
+    assert fronts[0].to_list() == fronts[1].to_list()
+    for (a, _), (b, _) in zip(fronts[0].items, fronts[1].items):
+        assert a.Depth.tolist() == b.Depth.tolist()
+
+
+def test_equal_candidates_are_simulated_once(monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'BATCH_ENABLED', False)
+    monkeypatch.setattr(irr_simulations, 'warehouse', None)
+
+    # Without any water every candidate is the same schedule
+    search = irr_simulations.LevelSearch(START, END, 'Potato', 'SandyLoam', 0, num_searches=40,
+                                         rng=np.random.default_rng(0))
+    simulations = 0
+    args = search.ask()
+    while args:
+        simulations += len(args)
+        search.tell([objective(*a) for a in args])
+        args = search.ask()
+
+    assert simulations == 1
+    assert search.duplicates == search.evaluations - 1
+
+
+@pytest.mark.parametrize('selection, expected', [('efficiency', 10), ('yield', 300), ('knee', 100)])
+def test_selections(selection, expected):
+    results = [(None, (yield_, total_irr, None)) for yield_, total_irr in [(4, 0), (6, 10), (8, 100), (9, 300)]]
+    assert irr_simulations.best_result(results, selection)[1][1] == expected
+
+
+def test_unknown_selection():
+    with pytest.raises(ValueError):
+        irr_simulations.best_result([(None, (4, 0, None))], 'cheapest')
+
+
+def levels(yields: dict) -> dict:
+    """ `optimize_level` results of budget levels with the given yields """
+    return {budget: (None, (yield_, float(budget), None)) for budget, yield_ in yields.items()}
+
+
+def test_refine_levels_splits_the_steepest_gaps():
+    results = levels({0: 2., 100: 8., 200: 9., 300: 9.1, 315: 12.})
+    # The gap of 15 mm is too close to split, the one of 200 to 300 changes too little
+    assert refine_levels(results, 5) == [50, 150]
+    assert refine_levels(results, 1) == [50]
+    assert refine_levels(results, 5, active=[60]) == [150]
+    assert refine_levels(results, 0) == []
+
+
+@pytest.fixture
+def fake_simulations(monkeypatch):
+    """ Yield which saturates with the water, instead of AquaCrop """
+    def curve(water):
+        return 10 * (1 - np.exp(-water / 60))
+
+    def fake_objective(x, *args, **kwargs):
+        return curve(x.sum()), float(x.sum()), None
+
+    def fake_evaluate(solution, start_date, end_date, crop, soil, level, station):
+        return solution, (curve(level), float(level), None)
+
+    monkeypatch.setattr(irr_simulations, 'objective', fake_objective)
+    monkeypatch.setattr(irr_simulations, 'evaluate_solution', fake_evaluate)
+    monkeypatch.setattr(irr_simulations, 'SURROGATE_ENABLED', False)
+    monkeypatch.setattr(irr_simulations, 'BATCH_ENABLED', False)
+    monkeypatch.setattr(irr_simulations, 'warehouse', None)
+    return curve
+
+
+@pytest.mark.parametrize('seed', [None, 3])
+def test_sweep_refines_where_the_yield_changes_steeply(fake_simulations, seed):
+    fronts = []
+    front = budget_sweep(START, END, 'Potato', 'SandyLoam', 400, num_searches=10, pool=SerialPool(),
+                         max_evaluations=100, progress=lambda front, evaluations: fronts.append(evaluations),
+                         seed=seed)
+
+    # The coarse grid of 5 levels and 5 refined ones within the budget of 100 candidates, all in the steep part
+    budgets = {int(irrigation) for irrigation, _ in front.objectives}
+    assert {0, 100, 200, 300, 400} <= budgets
+    assert len(budgets) == len(fronts) == 10
+    assert max(budgets - {0, 100, 200, 300, 400}) < 200
+    assert fronts == sorted(fronts) and fronts[-1] <= 100
+
+
+def test_sweep_stops_refining_flat_yields(fake_simulations, monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'evaluate_solution',
+                        lambda solution, *args: (solution, (5., float(args[-2]), None)))
+    levels_done = []
+    budget_sweep(START, END, 'Potato', 'SandyLoam', 400, num_searches=10, pool=SerialPool(), max_evaluations=1000,
+                 progress=lambda front, evaluations: levels_done.append(evaluations))
+    assert len(levels_done) == 5
+
+
+def test_cancelled_sweep_raises(fake_simulations):
+    cancel = threading.Event()
+    with pytest.raises(Cancelled):
+        budget_sweep(START, END, 'Potato', 'SandyLoam', 400, num_searches=10, pool=SerialPool(), max_evaluations=100,
+                     progress=lambda front, evaluations: cancel.set(), cancel=cancel)
+
+
+def test_horizon_covers_maturity_and_the_schedule(monkeypatch):
+    monkeypatch.setitem(irr_simulations.crop_params, 'Fast', {'MaturityCD': 90, 'CalendarType': 1})
+    monkeypatch.setitem(irr_simulations.crop_params, 'Thermal', {'MaturityCD': 90, 'CalendarType': 2})
+    horizon = irr_simulations.simulation_horizon
+
+    assert horizon('Fast', START, START + pd.Timedelta(days=30)) == 90 + irr_simulations.HORIZON_MARGIN
+    assert horizon('Fast', START, START + pd.Timedelta(days=120)) == 120 + irr_simulations.HORIZON_MARGIN
+    assert horizon('Thermal', START, START + pd.Timedelta(days=30)) == 113 + irr_simulations.HORIZON_MARGIN
+    assert horizon('Unknown', START, END) == irr_simulations.MAX_HORIZON
+    assert horizon('Fast', START, START + pd.Timedelta(days=400)) == irr_simulations.MAX_HORIZON
+
+
+def test_simulation_without_harvest_is_rerun_over_the_full_horizon(monkeypatch):
+    runs = []
+
+    class FakeModel:
+        """ Only harvests when the whole year is simulated """
+        def __init__(self, sim_start_time, sim_end_time, **kwargs):
+            self.days = (pd.Timestamp(sim_end_time) - pd.Timestamp(sim_start_time)).days
+            runs.append(self.days)
+
+        def run_model(self, till_termination):
+            pass
+
+        def get_simulation_results(self):
+            if self.days < irr_simulations.MAX_HORIZON:
+                return pd.DataFrame(columns=['Yield (tonne/ha)', 'Seasonal irrigation (mm)',
+                                             'Harvest Date (YYYY/MM/DD)'])
+            return pd.DataFrame({'Yield (tonne/ha)': [8.], 'Seasonal irrigation (mm)': [100.],
+                                 'Harvest Date (YYYY/MM/DD)': ['2021-09-20']})
+
+    monkeypatch.setattr(irr_simulations, 'AquaCropModel', FakeModel)
+    schedule = create_initial_irr_schedule(START, END, 100)
+    result = irr_simulations.simulate(schedule, START, 'Potato', 'SandyLoam', 100, horizon=150)
+
+    assert result == (8., 100., '2021-09-20')
+    assert runs == [150, irr_simulations.MAX_HORIZON]
+
+
+def test_ensemble_evaluation_reports_the_scenarios_next_to_the_season(monkeypatch):
+    yields = {None: 9., 2015: 6., 2016: 8.}
+
+    def fake_objective(x, schedule, start_date, end_date, crop, soil, max_irr_season, evaluate=False, verbose=False,
+                       scenario=None, station=DEFAULT_STATION):
+        return yields[scenario], float(x.sum()), '2021-09-20'
+
+    monkeypatch.setattr(irr_simulations, 'objective', fake_objective)
+    monkeypatch.setattr(irr_simulations, 'ENSEMBLE_SIZE', 2)
+    monkeypatch.setattr(irr_simulations, 'ENSEMBLE_RISK', 1.)
+    monkeypatch.setattr(irr_simulations, 'weather_scenarios', lambda start_date, station: (2015, 2016))
+
+    solution = create_initial_irr_schedule(START, END, 100)
+    solution, (yield_, total_irr, _) = irr_simulations.evaluate_solution(solution, START, END, 'Potato', 'SandyLoam',
+                                                                         100)
+    # The yield the search scored the schedule by, the mean of 7 minus one standard deviation of 1
+    assert yield_ == 6.
+    assert solution.attrs['ensemble'] == {'years': [2015, 2016], 'score': 6., 'mean_yield': 7., 'std_yield': 1.,
+                                          'season_yield': 9.}
+    assert irr_simulations.select_best([(solution, (yield_, total_irr, None))], 2)[0].attrs['ensemble']['score'] == 6.
+
+
+def test_seeds_keep_their_total_within_the_budget():
+    seed = pd.Series([10., 30.], index=[7, 15])
+    days = np.array([0, 7, 14])
+
+    np.testing.assert_allclose(irr_simulations.seed_depths(seed, days, 80), [0, 20, 60])
+    np.testing.assert_allclose(irr_simulations.seed_depths(seed, days, 80, rescale=False), [0, 10, 30])
+    np.testing.assert_allclose(irr_simulations.seed_depths(seed, days, 20, rescale=False), [0, 5, 15])
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import numpy as np
+
+from irr_surrogate import BINS, Surrogate, schedule_features
+
+
+def train(surrogate: Surrogate, n: int = 40, seed: int = 0):
+    """ Observe a yield which grows linearly with the first feature """
+    for x in np.random.default_rng(seed).uniform(0, 1, size=(n, 2)):
+        surrogate.observe(x, 10 * x[0])
+
+
+def test_untrusted_surrogate_keeps_every_candidate():
+    surrogate = Surrogate(min_samples=30)
+    train(surrogate, 20)
+
+    keep, predicted = surrogate.screen(np.array([[0., 0.], [1., 1.]]), 5.)
+    assert keep.all()
+    assert predicted is None
+    assert not surrogate.trusted and surrogate.screened == 0
+
+
+def test_trusted_surrogate_discards_candidates_which_can_not_beat_the_incumbent():
+    surrogate = Surrogate(min_samples=10, kappa=1.)
+    train(surrogate)
+    assert surrogate.trusted
+
+    keep, predicted = surrogate.screen(np.array([[.05, .5], [.5, .5], [.95, .5]]), 8.)
+    assert keep.tolist() == [False, False, True]
+    np.testing.assert_allclose(predicted, [.5, 5., 9.5], atol=.5)
+    assert (surrogate.screened, surrogate.discarded) == (3, 2)
+
+    # The most promising candidate is always simulated, even if it can not beat the incumbent
+    keep, _ = surrogate.screen(np.array([[.1, .5], [.2, .5]]), 20.)
+    assert keep.tolist() == [False, True]
+
+
+def test_inaccurate_surrogate_is_not_trusted():
+    surrogate = Surrogate(min_samples=10, max_error=.01)
+    rng = np.random.default_rng(1)
+    for x in rng.uniform(0, 1, size=(40, 2)):
+        surrogate.observe(x, rng.uniform(0, 10))  # Noise which can not be learned
+
+    assert surrogate.error > .01
+    assert surrogate.screen(np.array([[.5, .5]]), 5.)[1] is None
+
+
+def test_observations_are_shared_through_the_file(tmp_path):
+    path = tmp_path / 'surrogate' / 'Potato-SandyLoam.jsonl'
+    train(Surrogate(path))
+
+    surrogate = Surrogate(path, min_samples=10)
+    assert len(surrogate.y) == 40
+    assert surrogate.predict([[.5, .5]])[0] is not None
+
+
+def test_schedule_features_have_a_fixed_length():
+    features = schedule_features(np.array([0, 20, 200]), np.array([10, 20, 30]), datetime(2021, 6, 1))
+    assert features.shape == (3 * BINS + 3,)
+    assert features[:BINS].tolist() == [10, 20] + [0] * (BINS - 3) + [30]
+    assert features[BINS] == 60
@@ -0,0 +1,54 @@
+from time import perf_counter
+
+import irr_tracing
+from irr_pool import TaskScheduler, WarmPool
+from irr_tracing import profile
+
+
+def busy_task(seconds):
+    t0 = perf_counter()
+    while perf_counter() - t0 < seconds:
+        pass
+    return seconds
+
+
+def test_profiles_include_the_stacks_of_pool_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(irr_tracing, 'PROFILE_DIR', str(tmp_path))
+    pool = WarmPool(size=1, crops=(), soils=())
+    try:
+        with profile('test.starmap') as profiler:
+            assert pool.starmap(busy_task, [(.1,)]) == [.1]
+        assert any('busy_task' in stack for stack in profiler.stacks)
+
+        scheduler = TaskScheduler(pool)
+        scheduler.submit('a', busy_task, .1)
+        with profile('test.scheduler') as outer:
+            with profile('test.inner') as inner:
+                assert list(scheduler.results()) == [('a', .1)]
+        assert any('busy_task' in stack for stack in inner.stacks)
+        assert not any('busy_task' in stack for stack in outer.stacks)
+    finally:
+        pool.shutdown()
+
+    folded = [path.read_text() for path in tmp_path.glob('*.folded')]
+    assert len(folded) == 3
+    assert any('busy_task' in text for text in folded)
+
+
+def test_forked_workers_do_not_send_back_the_parent_trace(monkeypatch):
+    monkeypatch.setattr(irr_tracing.tracer, 'enabled', True)
+    irr_tracing.tracer.drain()
+    for _ in range(5):
+        with irr_tracing.tracer.span('test.parent'):
+            pass
+
+    pool = WarmPool(size=4, crops=(), soils=())
+    try:
+        assert pool.starmap(busy_task, [(0.,)] * 8) == [0.] * 8
+    finally:
+        pool.shutdown()
+
+    spans = irr_tracing.tracer.drain()['spans']
+    assert spans['test.parent']['count'] == 5
+    assert spans['pool.start']['count'] == 1
+    assert spans['pool.worker_init']['count'] <= 4
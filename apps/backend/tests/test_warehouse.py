@@ -0,0 +1,65 @@
+import pytest
+
+from irr_pool import WarmPool
+from irr_warehouse import ResultsWarehouse
+
+pytest.importorskip('pyarrow')
+
+warehouse = None  # Of the pool test, inherited by the forked workers
+
+
+def record(warehouse, budget, yield_, scenario=None, start='2021-06-01', station='tamale'):
+    warehouse.record('Potato', 'SandyLoam', start, budget, [7, 14], [budget // 2, budget // 2], yield_, budget,
+                     '2021-09-20', .1, scenario=scenario, station=station)
+
+
+def test_rows_are_partitioned_by_crop_and_planting_date(tmp_path):
+    store = ResultsWarehouse(tmp_path, flush_rows=1000, flush_seconds=60)
+    record(store, 100, 7.)
+    record(store, 100, 6., start='2021-07-01')
+    store.flush()
+
+    assert sorted(str(path.relative_to(tmp_path).parent) for path in tmp_path.rglob('*.parquet')) == \
+        ['crop=Potato/start=2021-06-01', 'crop=Potato/start=2021-07-01']
+    assert store.stats() == {'written': 2, 'files': 2, 'pending': 0}
+
+    table = store.scan(crop='Potato', start='2021-06-01')
+    assert table.num_rows == 1
+    assert table.column('days').to_pylist() == [[7, 14]]
+    with pytest.raises(ValueError):
+        store.scan(soil='SandyLoam')
+
+
+def test_yield_curve_has_the_best_single_season_result_per_budget(tmp_path):
+    store = ResultsWarehouse(tmp_path, flush_rows=1000, flush_seconds=60)
+    record(store, 100, 7.)
+    record(store, 100, 8.)
+    record(store, 100, 9.5, scenario=2015)
+    record(store, 200, 9.)
+    record(store, 200, 1., station='dry')
+    store.flush()
+
+    curve = store.yield_curve('Potato', '2021-06-01')
+    assert curve.budget.tolist() == [100, 200]
+    assert curve['yield'].tolist() == [8., 9.]
+    assert store.yield_curve('Potato', '2021-06-01', station='dry')['yield'].tolist() == [1.]
+
+
+def record_in_worker(budget):
+    record(warehouse, budget, 7.)
+    return budget
+
+
+def test_terminated_workers_flush_their_rows(tmp_path):
+    global warehouse
+    warehouse = ResultsWarehouse(tmp_path, flush_rows=1000, flush_seconds=60)
+    pool = WarmPool(size=2, crops=(), soils=())
+    try:
+        assert sorted(pool.starmap(record_in_worker, [(budget,) for budget in range(10, 110, 10)])) == \
+            list(range(10, 110, 10))
+    finally:
+        pool.shutdown(wait=False)
+        warehouse = None
+
+    assert sorted(ResultsWarehouse(tmp_path).scan(columns=['budget']).column('budget').to_pylist()) == \
+        list(range(10, 110, 10))
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import irr_simulations
+from irr_simulations import batch_engine, create_initial_irr_schedule, objective
+from irr_waterbalance import TOLERANCE
+
+START, END = datetime(2021, 6, 1), datetime(2021, 10, 1)
+BUDGET = 300
+
+
+@pytest.fixture
+def season(monkeypatch):
+    monkeypatch.setattr(irr_simulations, 'warehouse', None)
+    schedule = create_initial_irr_schedule(START, END, BUDGET)
+    return schedule, START, END, 'Potato', 'SandyLoam', BUDGET
+
+
+def test_engine_follows_aquacrop(season):
+    engine = batch_engine(*season)
+    assert engine is not None
+    assert engine.error <= TOLERANCE
+
+    # Schedules it was not calibrated on
+    X = np.random.default_rng(1).dirichlet(np.ones(len(season[0])), size=4) * BUDGET
+    reference = np.array([objective(x, *season, True)[0] for x in X])
+    assert np.mean(np.abs(engine.evaluate(X) - reference)) <= TOLERANCE * reference.mean()
+
+
+def test_calibration_error_is_measured_on_held_out_schedules(season):
+    engine = batch_engine(*season)
+    X = np.random.default_rng(2).dirichlet(np.ones(len(season[0])), size=4) * BUDGET
+    raw = engine.run(X)[0]
+
+    # Every other schedule is held out, a scale which fits the others perfectly is off by a third on those
+    error = engine.calibrate(X, raw * np.array([2, 3, 2, 3]))
+    assert error == pytest.approx(1 / 3)
+    assert engine.scale == pytest.approx(raw @ (raw * [2, 3, 2, 3]) / (raw @ raw))
@@ -0,0 +1,66 @@
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from weather_store import COLUMNS, WeatherStore
+
+REPO_CSV = Path(__file__).resolve().parents[1] / 'data' / 'tamale_weather.csv'
+
+
+def write_csv(path, rows):
+    pd.DataFrame(rows, columns=['Date', *COLUMNS]).to_csv(path, index=False)
+
+
+def test_first_row_of_a_duplicated_day_wins(tmp_path):
+    csv_path = tmp_path / 'weather.csv'
+    write_csv(csv_path, [
+        ('2021-01-01', 20., 35., 0., 5.),
+        ('2021-01-02', 27., 39.7, 0., 14.54),
+        ('2021-01-03', 25., 38.6, 0., 14.54),
+        # Copied forward after the measured days, these must never replace them
+        ('2021-01-02', 17., 32., 0., 14.77),
+        ('2021-01-03', 15.5, 30., 0., 14.77),
+        ('2021-01-04', 16., 31., 1., 14.77),
+    ])
+
+    store = WeatherStore(tmp_path / 'store', {'test': str(csv_path)})
+    df = store.window(datetime(2021, 1, 1), datetime(2021, 1, 4), station='test')
+
+    assert df.Date.tolist() == list(pd.date_range('2021-01-01', '2021-01-04'))
+    np.testing.assert_allclose(df.MinTemp, [20., 27., 25., 16.])
+    np.testing.assert_allclose(df.MaxTemp, [35., 39.7, 38.6, 31.])
+
+
+
+def test_repo_weather_keeps_the_measured_days(tmp_path):
+    store = WeatherStore(tmp_path / 'store', {'tamale': str(REPO_CSV)})
+    df = store.window(datetime(2021, 1, 2), datetime(2021, 1, 3), station='tamale')
+
+    np.testing.assert_allclose(df.MinTemp, [27., 25.])
+    np.testing.assert_allclose(df.MaxTemp, [39.7, 38.6])
+
+
+def test_analog_years_are_measured(tmp_path):
+    store = WeatherStore(tmp_path / 'store', {'tamale': str(REPO_CSV)})
+    station = store.station('tamale')
+
+    # 2022 was copied forward from 2021, and October 2015 is missing
+    years = station.analog_years(datetime(2021, 6, 1), datetime(2022, 6, 3))
+    assert years == [2010, 2011, 2012, 2013, 2014, 2016, 2017, 2018, 2019, 2020]
+    with pytest.raises(ValueError):
+        station.analog(datetime(2021, 6, 1), datetime(2021, 10, 1), 2022)
+
+    # The copies still serve as the weather of their own dates
+    assert len(station.window(datetime(2022, 6, 1), datetime(2022, 6, 30))) == 30
+
+
+def test_weather_without_measured_column_is_measured(tmp_path):
+    csv_path = tmp_path / 'weather.csv'
+    write_csv(csv_path, [(day.strftime('%Y-%m-%d'), 20., 30., 0., 5.)
+                         for day in pd.date_range('2019-01-01', '2021-12-31')])
+    station = WeatherStore(tmp_path / 'store', {'test': str(csv_path)}).station('test')
+
+    assert station.analog_years(datetime(2021, 3, 1), datetime(2021, 8, 1)) == [2019, 2020, 2021]
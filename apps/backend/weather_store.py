@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['MinTemp', 'MaxTemp', 'Precipitation', 'ReferenceET']
+STORE_DIR = os.getenv('IRR_WEATHER_DIR', './data/weather_store')
+DEFAULT_STATION = 'tamale'
+STORE_VERSION = 3  # stores of another version are rebuilt, e.g. because duplicated days are resolved differently
+
+# Stations as `name=csv_path` pairs separated by commas
+STATIONS = dict(pair.split('=', 1) for pair in
+                os.getenv('IRR_WEATHER_STATIONS', f'{DEFAULT_STATION}=./data/tamale_weather.csv').split(','))
+
+
+def _days(dates) -> np.ndarray:
+    """ Dates to days since the epoch """
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int32)
+
+
+def build_station(csv_path: str, directory: str):
+    """
+        Convert a weather CSV once into a columnar binary layout: one float32 `.npy` file per weather column, an
+        int32 day index and a boolean mask of measured days, which can be memory-mapped by every process without
+        parsing. Days are measured unless the CSV has a `Measured` column which says otherwise, e.g. for days that
+        were copied forward from another year.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # Of several rows of the same day the first one in the file wins, which is the measured one in files with days
+    # copied forward after it
+    df = pd.read_csv(csv_path, parse_dates=['Date']).sort_values('Date', kind='stable').drop_duplicates('Date')
+    arrays = {'Day': _days(df.Date.values), **{c: df[c].values.astype(np.float32) for c in COLUMNS},
+              'Measured': df.Measured.values.astype(bool) if 'Measured' in df else np.ones(len(df), dtype=bool)}
+
+    # Every file is moved in place atomically and the manifest last, such that readers never see a partial store
+    for name, values in arrays.items():
+        tmp_path = directory / f"{name}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, values)
+        os.replace(tmp_path, directory / f"{name}.npy")
+
+    stat = os.stat(csv_path)
+    tmp_path = directory / f"manifest.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as fp:
+        json.dump({'version': STORE_VERSION, 'source': str(csv_path), 'mtime_ns': stat.st_mtime_ns,
+                   'size': stat.st_size, 'rows': len(df)}, fp)
+    os.replace(tmp_path, directory / 'manifest.json')
+
+
+class Station:
+    """Memory-mapped weather of a single station"""
+
+    def __init__(self, name: str, directory: str):
+        directory = Path(directory)
+        self.name = name
+        self.days = np.load(directory / 'Day.npy', mmap_mode='r')
+        self.columns = {c: np.load(directory / f"{c}.npy", mmap_mode='r') for c in COLUMNS}
+        self.measured = np.load(directory / 'Measured.npy', mmap_mode='r')
+
+    @property
+    def first_date(self) -> datetime:
+        return pd.Timestamp(self.days[0], unit='D').to_pydatetime()
+
+    @property
+    def last_date(self) -> datetime:
+        return pd.Timestamp(self.days[-1], unit='D').to_pydatetime()
+
+    def _bounds(self, start: datetime, end: datetime) -> (int, int):
+        return (int(np.searchsorted(self.days, _days(start), side='left')),
+                int(np.searchsorted(self.days, _days(end), side='right')))
+
+    def arrays(self, start: datetime, end: datetime) -> dict:
+        """ Zero-copy views of the day index and weather columns between start and end (inclusive) """
+        lo, hi = self._bounds(start, end)
+        return {'Day': self.days[lo:hi], **{c: values[lo:hi] for c, values in self.columns.items()}}
+
+    def analog(self, start: datetime, end: datetime, year: int) -> dict:
+        """
+            Weather of the same calendar days in another year, dated as if it happened between start and end (inclusive)
+            :raises ValueError: if that year does not have the measured weather of every day
+        """
+        n = (end - start).days + 1
+        shifted = _days(pd.Timestamp(start) + pd.DateOffset(years=year - start.year))
+        lo = int(np.searchsorted(self.days, shifted, side='left'))
+        hi = lo + n
+        if hi > len(self.days) or self.days[lo] != shifted or self.days[hi - 1] - self.days[lo] != n - 1:
+            raise ValueError(f"Incomplete weather of {year} for the {n} days from {start:%m/%d}")
+        if not self.measured[lo:hi].all():
+            raise ValueError(f"Weather of {year} for the {n} days from {start:%m/%d} is not measured")
+
+        return {'Day': _days(start) + np.arange(n, dtype=np.int32),
+                **{c: values[lo:hi] for c, values in self.columns.items()}}
+
+    def analog_years(self, start: datetime, end: datetime) -> list:
+        """ Years with measured weather of all calendar days between start and end, see `analog` """
+        years = []
+        for year in range(self.first_date.year, self.last_date.year + 1):
+            try:
+                self.analog(start, end, year)
+            except ValueError:
+                continue
+            years.append(year)
+        return years
+
+    def window(self, start: datetime, end: datetime, year: int = None) -> pd.DataFrame:
+        """
+            Weather between start and end (inclusive) in the layout AquaCrop expects
+            :param year: take the weather of the same days in this year instead, see `analog`
+        """
+        arrays = self.arrays(start, end) if year is None else self.analog(start, end, year)
+        df = pd.DataFrame({c: arrays[c] for c in COLUMNS})
+        df['Date'] = arrays['Day'].astype('datetime64[D]').astype('datetime64[ns]')
+        return df
+
+
+class WeatherStore:
+    """
+        Weather of all stations. The binary layout of a station is (re)built from its CSV on first use when it is
+        missing or older than the CSV, after that it is only memory-mapped.
+    """
+
+    def __init__(self, directory: str = STORE_DIR, stations: dict = None):
+        self.directory = Path(directory)
+        self.sources = dict(STATIONS if stations is None else stations)
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def _is_stale(self, name: str) -> bool:
+        try:
+            with open(self.directory / name / 'manifest.json', 'r') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return True
+
+        stat = os.stat(self.sources[name])
+        return (manifest.get('version') != STORE_VERSION or manifest['mtime_ns'] != stat.st_mtime_ns
+                or manifest['size'] != stat.st_size)
+
+    def station(self, name: str = DEFAULT_STATION) -> Station:
+        with self._lock:
+            if name not in self._stations:
+                if name not in self.sources:
+                    raise KeyError(f"Unknown weather station '{name}'")
+
+                if self._is_stale(name):
+                    build_station(self.sources[name], self.directory / name)
+                self._stations[name] = Station(name, self.directory / name)
+
+            return self._stations[name]
+
+    def window(self, start: datetime, end: datetime, station: str = DEFAULT_STATION, year: int = None) -> pd.DataFrame:
+        return self.station(station).window(start, end, year)
+
+    def reload(self, name: str = None):
+        """ Drop the opened stations, such that they are rebuilt from their CSV when it changed """
+        with self._lock:
+            if name is None:
+                self._stations.clear()
+            else:
+                self._stations.pop(name, None)
+
+
+weather_store = WeatherStore()
@@ -10,6 +10,7 @@ from scipy.optimize import fmin_tnc, minimize
 
 # TODO: use actual climate from Tamale
 weather_file_path = get_filepath('champion_climate.txt')
+weather_df = prepare_weather(weather_file_path)  # Parsed once, every objective call gets its own copy
 
 
 # TODO: Use days instead of weeks for the simulation. Days now take to long if done for a whole week
@@ -43,7 +44,7 @@ def objective(x, schedule, start_date, end_date, max_irr_season):
     model = AquaCropModel(
         sim_start_time=start_date,
         sim_end_time=end_date,
-        weather_df=prepare_weather(weather_file_path),
+        weather_df=weather_df.copy(),
         soil=SOIL_TYPE,
         crop=CROP,
         initial_water_content=InitialWaterContent(value=['FC']),
@@ -4,11 +4,19 @@ from bs4 import BeautifulSoup
 import urllib.request
 from urllib.error import HTTPError
 from pathlib import Path
+import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
 from datetime import date
 from eto import ETo
 
+STATION = "654180"  # Tamale
+SOURCE = os.getenv("TUTIEMPO_SOURCE", "https://en.tutiempo.net/climate")
+RAW_DIR = Path(os.getenv("TUTIEMPO_RAW_DIR", "tutiempo/raw"))
+MAX_WORKERS = 8
+MONTHS = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
+
 
 def _float(s):
     try:
@@ -17,24 +25,51 @@ def _float(s):
         return None
 
 
-def _get_tutiempo_table(year, month, debug=False):
+def _page_name(year, month):
+    return f"weather_{month}-{year}.html"
+
+
+def _fetch_tutiempo_page(station, year, month, source=SOURCE, raw_dir=RAW_DIR):
     """
-    Fetch the webpage of the specified year and month, and scrape the data.
+    Get the HTML of the specified station, year and month. Pages are read from
+    the raw cache first, then from the source: the Tutiempo website, a mirror of
+    it, or a local directory with `weather_<month>-<year>.html` fixtures.
+    Returns None if the month is not available.
     """
-    # Get HTML code.
-    if debug:
-        with open(Path("tutiempo_debug/weather_01-2022.html"), "r") as fp:
-            soup = BeautifulSoup(fp, "html.parser")
+    cached = Path(raw_dir) / station / _page_name(year, month)
+    if cached.exists():
+        return cached.read_text()
+
+    if os.path.isdir(source):
+        fixture = Path(source) / _page_name(year, month)
+        if not fixture.exists():
+            print(f"\t[{year}-{month}]\tNo data available..  (no fixture)")
+            return
+        html = fixture.read_text()
     else:
-        url = f"https://en.tutiempo.net/climate/{month}-{year}/ws-654180.html"
-
+        url = f"{source}/{month}-{year}/ws-{station}.html"
         try:
-            page = urllib.request.urlopen(url)
+            with urllib.request.urlopen(url) as page:
+                html = page.read().decode("utf-8")
         except HTTPError as e:
             print(f"\t[{year}-{month}]\tNo data available..  ({e.code})")
             return
 
-        soup = BeautifulSoup(page.read(), "html.parser")
+    # Only finished months are cached, the current one still gets new days.
+    if date(int(year), int(month), 1) + relativedelta(months=1) <= date.today():
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(html)
+        os.replace(tmp_path, cached)
+
+    return html
+
+
+def _parse_tutiempo_table(html, year, month):
+    """
+    Scrape the daily weather of a single month from its webpage.
+    """
+    soup = BeautifulSoup(html, "html.parser")
 
     # Get the contents of the main table.
     tables = soup.find_all("table")
@@ -62,60 +97,149 @@ def _get_tutiempo_table(year, month, debug=False):
     return df
 
 
-def get_tutiempo(years):
+def _get_tutiempo_table(station, year, month, source=SOURCE, raw_dir=RAW_DIR):
     """
-    Download the Tutiempo dataset for the given years through a web scraper.
+    Fetch the webpage of the specified year and month, and scrape the data.
     """
-    full_df = pd.DataFrame()
-    for year in years:
-        print(f"\nProcessing year {year}..")
+    html = _fetch_tutiempo_page(station, year, month, source, raw_dir)
+    if html is not None:
+        return _parse_tutiempo_table(html, year, month)
 
-        # Create folder for the current years results.
-        os.makedirs(Path(f"tutiempo/{year}"), exist_ok=True)
 
-        # Fill year folder with data from all months.
-        df = pd.DataFrame()
-        for month in ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]:
-            df = df.append(_get_tutiempo_table(year, month))
+def _read_output(output):
+    """
+    Read the weather file with its `Measured` column, which is 0 for days that
+    are not measured. Files written by the original version of this script
+    have no such column and end with their last two years copied forward by
+    a year: those rows start at the first day which is not later than the day
+    before it. Copies of days which are measured as well are dropped.
+    Returns the weather and whether the file has to be rewritten in the
+    current layout, or (None, False) if there is no file yet.
+    """
+    if not os.path.exists(output):
+        return None, False
 
-        df = df[['Tm', 'TM', 'T', 'H', 'SLP', 'PP', 'V']]
-        df.rename(columns={
-            'Tm': 'T_min',  # Min temp
-            'TM': 'T_max',  # Max temp
-            'T': 'T_mean',  # Average temp
-            'H': 'RH_mean',  # Relative humidity
-            'SLP': 'P',  # Atmospheric pressure
-            'PP': 'Prcp(mm)',  # Total rainfall
-            'V': 'U_z'  # Average wind speed
-        }, inplace=True)
+    df = pd.read_csv(output, parse_dates=["Date"], float_precision="round_trip")
+    if "Measured" in df:
+        return df, False
 
-        df.interpolate(method='time', limit_direction='both', inplace=True)
+    copied = (df.Date <= df.Date.cummax().shift()).cummax()
+    df["Measured"] = (~copied).astype(int)
+    return df[~df.Date.duplicated()], True
 
-        # Calculate ETo based on FAO Penman-Monteith equation (z_msl, lat lon in Tamale)
-        et = ETo(df, freq='D', z_msl=168, lat=9.5, lon=-0.85)
-        df['Et0(mm)'] = et.eto_fao().interpolate(method='time', limit_direction='both').fillna(0)
 
-        # Finalize to output AquaCrop model kan use
-        df = df[['T_min', 'T_max', 'Prcp(mm)', 'Et0(mm)']]
+def _write_output(df, output):
+    """
+    Replace the weather file at once, such that readers never see a partial file.
+    """
+    tmp_path = Path(f"{output}.{os.getpid()}.tmp")
+    df.sort_values("Date").to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output)
+
+
+def _ingested_months(existing):
+    """
+    Months of which every day is measured in the weather file already.
+    """
+    if existing is None:
+        return set()
+
+    dates = existing.Date[existing.Measured == 1]
+    days = dates.groupby([dates.dt.year, dates.dt.month]).nunique()
+    return {(year, month) for (year, month), n in days.items()
+            if n == pd.Period(year=year, month=month, freq="M").days_in_month}
 
-        df.rename(columns={
-            'T_min': 'MinTemp',
-            'T_max': 'MaxTemp',
-            'Prcp(mm)': 'Precipitation',
-            'Et0(mm)': 'ReferenceET'
-        }, inplace=True)
 
-        df.index.name = 'Date'
-        df.ReferenceET.clip(lower=0.1, inplace=True)
-        full_df = full_df.append(df)
+def _to_aquacrop(df):
+    """
+    Convert the scraped columns into the daily weather AquaCrop uses.
+    """
+    df = df[['Tm', 'TM', 'T', 'H', 'SLP', 'PP', 'V']]
+    df = df.rename(columns={
+        'Tm': 'T_min',  # Min temp
+        'TM': 'T_max',  # Max temp
+        'T': 'T_mean',  # Average temp
+        'H': 'RH_mean',  # Relative humidity
+        'SLP': 'P',  # Atmospheric pressure
+        'PP': 'Prcp(mm)',  # Total rainfall
+        'V': 'U_z'  # Average wind speed
+    })
+
+    df = df.interpolate(method='time', limit_direction='both')
+
+    # Calculate ETo based on FAO Penman-Monteith equation (z_msl, lat lon in Tamale)
+    et = ETo(df, freq='D', z_msl=168, lat=9.5, lon=-0.85)
+    df['Et0(mm)'] = et.eto_fao().interpolate(method='time', limit_direction='both').fillna(0)
+
+    # Finalize to output AquaCrop model kan use
+    df = df[['T_min', 'T_max', 'Prcp(mm)', 'Et0(mm)']]
+
+    df = df.rename(columns={
+        'T_min': 'MinTemp',
+        'T_max': 'MaxTemp',
+        'Prcp(mm)': 'Precipitation',
+        'Et0(mm)': 'ReferenceET'
+    })
+
+    df.index.name = 'Date'
+    df['ReferenceET'] = df.ReferenceET.clip(lower=0.1)
+    return df
 
-    next_year = full_df.tail(730)
-    next_year.index += pd.offsets.DateOffset(months=12)
 
-    full_df = full_df.append(next_year)
-    full_df.to_csv('tamale_weather.csv')
+def get_tutiempo(years, output="tamale_weather.csv", station=STATION, source=SOURCE, raw_dir=RAW_DIR,
+                 max_workers=MAX_WORKERS):
+    """
+    Download the Tutiempo dataset for the given years through a web scraper.
+    Months which are already measured in the output are skipped, the others
+    are fetched concurrently and only their days are appended to the output.
+    Fetched days replace the days that were copied forward by earlier versions.
+    """
+    existing, migrate = _read_output(output)
+    if migrate:
+        _write_output(existing, output)
+        print(f"\nMarked {(existing.Measured == 0).sum()} copied days in {output} as not measured.")
+
+    ingested = _ingested_months(existing)
+    months = [(str(year), month) for year in years for month in MONTHS
+              if (int(year), int(month)) not in ingested and date(int(year), int(month), 1) <= date.today()]
+    if not months:
+        print("\nAll months are ingested already.")
+        return
+
+    print(f"\nFetching {len(months)} months..")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(lambda ym: _get_tutiempo_table(station, *ym, source, raw_dir), months))
+
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        print("\nNo new data available.")
+        return
+
+    df = _to_aquacrop(pd.concat(tables).sort_index())
+    df["Measured"] = 1
+    df = df.reset_index()
+
+    # Only the days which are not measured in the output yet are written, the
+    # weather store of the backend sorts the days again when it picks up the
+    # change. Days which were copied forward are replaced, which needs a rewrite.
+    if existing is None:
+        _write_output(df, output)
+    else:
+        df = df[~df.Date.isin(existing.Date[existing.Measured == 1])]
+        copied = existing.Date.isin(df.Date)
+        if copied.any():
+            _write_output(pd.concat([existing[~copied], df]), output)
+        else:
+            df.to_csv(output, mode="a", header=False, index=False)
+    print(f"\nAdded {len(df)} days to {output}.")
 
 
 if __name__ == "__main__":
-    get_tutiempo([f"201{y}" for y in range(10)] +
-                 [f"2020", "2021"])
+    parser = argparse.ArgumentParser(description="Ingest the daily weather of Tamale from Tutiempo.")
+    parser.add_argument("years", nargs="*", type=int, default=list(range(2010, date.today().year + 1)))
+    parser.add_argument("--output", default="tamale_weather.csv")
+    parser.add_argument("--source", default=SOURCE, help="website, mirror or local directory with the pages")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="pages fetched at the same time")
+    args = parser.parse_args()
+
+    get_tutiempo(args.years, args.output, source=args.source, max_workers=args.workers)
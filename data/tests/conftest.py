@@ -0,0 +1,5 @@
+import os
+import sys
+
+# get_data.py is a script in the data directory, imported by name like the backend modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,90 @@
+import shutil
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import get_data
+from get_data import get_tutiempo
+
+FIXTURE = Path(__file__).resolve().parents[1] / 'tutiempo_debug' / 'weather_01-2022.html'
+
+
+@pytest.fixture
+def source(tmp_path):
+    """ The offline fixture as the pages of two 31-day months of 2021, like `--source tutiempo_debug` """
+    directory = tmp_path / 'source'
+    directory.mkdir()
+    for month in ('01', '03'):
+        shutil.copy(FIXTURE, directory / f"weather_{month}-2021.html")
+    return directory
+
+
+def ingest(tmp_path, source, **kwargs):
+    output = tmp_path / 'weather.csv'
+    get_tutiempo([2021], output, source=str(source), raw_dir=tmp_path / 'raw', **kwargs)
+    return output
+
+
+def test_months_of_the_fixture_directory_are_ingested(tmp_path, source):
+    output = ingest(tmp_path, source)
+    df = pd.read_csv(output, parse_dates=['Date'])
+
+    assert df.columns.tolist() == ['Date', 'MinTemp', 'MaxTemp', 'Precipitation', 'ReferenceET', 'Measured']
+    assert df.Date.dt.month.value_counts().to_dict() == {1: 31, 3: 31}
+    assert (df.Measured == 1).all()
+    assert df.MinTemp.iloc[:3].tolist() == [20., 27., 25.]
+    # Finished months are cached for the next run
+    assert sorted(path.name for path in (tmp_path / 'raw' / get_data.STATION).iterdir()) == \
+        ['weather_01-2021.html', 'weather_03-2021.html']
+
+
+def test_months_are_fetched_concurrently(tmp_path, source, monkeypatch):
+    # Every fetch waits for a second one, which never comes if the months are fetched one by one
+    barrier = threading.Barrier(2, timeout=10)
+    fetch = get_data._fetch_tutiempo_page
+
+    def concurrent_fetch(*args):
+        barrier.wait()
+        return fetch(*args)
+
+    monkeypatch.setattr(get_data, '_fetch_tutiempo_page', concurrent_fetch)
+    output = ingest(tmp_path, source, max_workers=2)
+    assert len(pd.read_csv(output)) == 62
+
+
+def test_ingested_months_are_skipped_and_only_new_days_appended(tmp_path, source, monkeypatch):
+    output = ingest(tmp_path, source)
+    before = output.read_text()
+
+    fetched = []
+    table = get_data._get_tutiempo_table
+    monkeypatch.setattr(get_data, '_get_tutiempo_table',
+                        lambda station, year, month, *args: fetched.append(month) or table(station, year, month, *args))
+    shutil.copy(FIXTURE, source / 'weather_05-2021.html')
+    ingest(tmp_path, source)
+
+    assert '01' not in fetched and '03' not in fetched and '05' in fetched
+    after = output.read_text()
+    assert after.startswith(before)
+    df = pd.read_csv(output, parse_dates=['Date'])
+    assert df.Date.dt.month.value_counts().to_dict() == {1: 31, 3: 31, 5: 31}
+    assert not df.Date.duplicated().any()
+
+
+def test_copied_forward_days_are_marked_and_replaced(tmp_path, source):
+    # The layout of the original script: the measured days, followed by copies of earlier days dated a year later
+    measured = pd.DataFrame({'Date': pd.date_range('2021-01-01', '2021-01-31'), 'MinTemp': 1.})
+    copied = pd.DataFrame({'Date': pd.date_range('2021-01-01', '2021-03-31'), 'MinTemp': 2.})
+    output = tmp_path / 'weather.csv'
+    pd.concat([measured, copied]).assign(MaxTemp=30., Precipitation=0., ReferenceET=5.).to_csv(output, index=False)
+
+    ingest(tmp_path, source)
+    df = pd.read_csv(output, parse_dates=['Date']).set_index('Date')
+
+    assert not df.index.duplicated().any()
+    # January was measured already, February stays a copy until its month is fetched, March replaces the copies
+    assert (df.MinTemp['2021-01'] == 1.).all() and (df.Measured['2021-01'] == 1).all()
+    assert (df.MinTemp['2021-02'] == 2.).all() and (df.Measured['2021-02'] == 0).all()
+    assert df.MinTemp['2021-03'].iloc[:3].tolist() == [20., 27., 25.] and (df.Measured['2021-03'] == 1).all()